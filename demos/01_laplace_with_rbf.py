@@ -74,6 +74,10 @@ laplace_exact_sol = jax.vmap(laplace_exact_sol, in_axes=(0,), out_axes=0)
 exact_sol = laplace_exact_sol(cloud.sorted_nodes)
 error = jnp.mean((exact_sol-sol.vals)**2)
 
+## Cloud quality: the fill distance is the h of the convergence study (demo 02)
+fill_distance = float(cloud_metrics(cloud).fill_distance.max())
+print(f"MSE error: {error:.3e}    Fill distance: {fill_distance:.3e}")
+
 
 
 ## JNP SAVE solutions
@@ -98,7 +102,7 @@ plt.show()
 # run_name = str(datetime.datetime.now())[:19]        ##For tensorboard
 # writer = SummaryWriter("runs/"+run_name, comment='-Laplace')
 # hparams_dict = {"rbf":RBF.__name__, "max_degree":MAX_DEGREE, "nb_nodes":Nx*Ny, "support_size":SUPPORT_SIZE}      ## TODO Add local support
-# metrics_dict = {"metrics/mse_error":float(error), "metrics/wall_time":walltime}                                        ## TODO Add time
+# metrics_dict = {"metrics/mse_error":float(error), "metrics/wall_time":walltime, "metrics/fill_distance":fill_distance}                                        ## TODO Add time
 # writer.add_hparams(hparams_dict, metrics_dict, run_name="hp_params")
 # writer.add_figure("plots", fig)
 # writer.flush()
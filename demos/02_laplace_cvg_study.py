@@ -18,10 +18,12 @@ df
 
 ###
 df["h_avg"] = 1/ np.sqrt(df["nb_nodes"])
+if "metrics/fill_distance" in df:       ## Logged by demo 01 from updec.metrics.cloud_metrics
+    df["h_max"] = df["metrics/fill_distance"]
 df
 
 ###
-x = df["h_avg"]
+x = df["h_max"] if "h_max" in df else df["h_avg"]
 y = np.sqrt(df["metrics/mse_error"])
 
 from scipy.stats import linregress
@@ -30,7 +32,7 @@ res = linregress(np.log(x), np.log(y))
 ###
 fig, ax= plt.subplots(1,1, figsize=(8,5))
 ax.loglog(x,y, "x-", label="slope = "+(str(res.slope)[:5]))
-ax.set_xlabel("h")    ## Should be h_max here
+ax.set_xlabel("h_max" if "h_max" in df else "h")
 ax.set_ylabel("RMSE") ## Should be SUM of local error, not MEAN. USE INTERPOLATION !
 ax.set_title("Convergence analysis - Laplace problem")
 ax.legend();
@@ -43,7 +43,7 @@ facet_types_phi = {"Wall":"n", "Inflow":"n", "Outflow":"d"}
 
 cloud_vel = GmshCloud(filename="./meshes/channel.py", facet_types=facet_types_vel, mesh_save_location=DATAFOLDER)    ## TODO Pass the savelocation here
 # cloud_vel = GmshCloud(filename="./meshes/channel_cylinder.py", facet_types=facet_types_vel, mesh_save_location=DATAFOLDER)    ## TODO Pass the savelocation here
-cloud_phi = GmshCloud(filename=DATAFOLDER+"mesh.msh", facet_types=facet_types_phi)
+cloud_phi = cloud_vel.with_facet_types(facet_types_phi)
 
 fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(8.5,1.4*2), sharex=True)
 cloud_vel.visualize_cloud(ax=ax1, s=6, title="Cloud for velocity", xlabel=False);
@@ -74,15 +74,6 @@ def rhs_operator_u(x, centers=None, rbf=None, fields=None):
     return  u_prev - BETA*(DT*grad_px/RHO)
 
 
-
-@Partial(jax.jit, static_argnums=[2,3])
-def diff_operator_v(x, center=None, rbf=None, monomial=None, fields=None):
-    U_prev = jnp.array([fields[0], fields[1]])
-    v_val = nodal_value(x, center, rbf, monomial)
-    v_grad = nodal_gradient(x, center, rbf, monomial)
-    v_lap = nodal_laplacian(x, center, rbf, monomial)
-    return v_val + DT*jnp.dot(U_prev, v_grad) - DT*NU*v_lap
-
 @Partial(jax.jit, static_argnums=[2])
 def rhs_operator_v(x, centers=None, rbf=None, fields=None):
     v_prev = value(x, fields[:, 0], centers, rbf)
@@ -90,16 +81,6 @@ def rhs_operator_v(x, centers=None, rbf=None, fields=None):
     return  v_prev - BETA*(DT *grad_py/RHO)
 
 
-
-@Partial(jax.jit, static_argnums=[2,3])
-def diff_operator_phi(x, center=None, rbf=None, monomial=None, fields=None):
-    return nodal_laplacian(x, center, rbf, monomial)
-
-@Partial(jax.jit, static_argnums=[2])
-def rhs_operator_phi(x, centers=None, rbf=None, fields=None):
-    return RHO * divergence(x, fields[:, :2], centers, rbf) / DT
-
-
 ## Initial states, all defined on cloud_vel
 u = jnp.zeros((cloud_vel.N,))
 in_nodes = jnp.array(cloud_phi.facet_nodes["Inflow"])
@@ -126,64 +107,11 @@ bc_phi = {"Wall":zero, "Inflow":zero, "Outflow":atmospheric}
 # bc_phi = {"Wall":zero, "Inflow":zero, "Outflow":atmospheric, "Cylinder":zero}
 
 
-u_list = []
-v_list = []
-vel_list = []
-p_list = []
-
-for i in tqdm(range(NB_ITER)):
-    # print("Starting iteration %d" % i)
-
-    ## TODO Interpolate p and gradphi onto cloud_vel
-    p = interpolate_field(p_, cloud_phi, cloud_vel)
-
-    usol = pde_solver(diff_operator=diff_operator_u, 
-                    diff_args=[u, v],
-                    rhs_operator = rhs_operator_u, 
-                    rhs_args=[u, p], 
-                    cloud = cloud_vel, 
-                    boundary_conditions = bc_u,
-                    rbf=RBF,
-                    max_degree=MAX_DEGREE)
-
-    vsol = pde_solver(diff_operator=diff_operator_v,
-                    diff_args=[u, v],
-                    rhs_operator = rhs_operator_v,
-                    rhs_args=[v, p], 
-                    cloud = cloud_vel, 
-                    boundary_conditions = bc_v,
-                    rbf=RBF,
-                    max_degree=MAX_DEGREE)
-
-    ustar , vstar = usol.vals, vsol.vals     ## Star
-    Ustar = jnp.stack([ustar,vstar], axis=-1)
-
-    ## TODO Interpolate Ustar onto cloud_phi
-    u_ = interpolate_field(ustar, cloud_vel, cloud_phi)
-    v_ = interpolate_field(vstar, cloud_vel, cloud_phi)
-
-    phisol_ = pde_solver(diff_operator=diff_operator_phi,
-                    rhs_operator = rhs_operator_phi,
-                    rhs_args=[u_,v_], 
-                    cloud = cloud_phi, 
-                    boundary_conditions = bc_phi,
-                    rbf=RBF,
-                    max_degree=MAX_DEGREE)
-
-    p_ = BETA*p_ + phisol_.vals
-    gradphi_ = gradient_vec(cloud_phi.sorted_nodes, phisol_.coeffs, cloud_phi.sorted_nodes, RBF)        ## TODO use Pde_solver here instead ?
-
-    ## TODO Interpolate p and gradphi onto cloud_vel
-    gradphi = interpolate_field(gradphi_, cloud_phi, cloud_vel)
-
-    U = Ustar - (gradphi*DT/RHO)
-    u, v = U[:,0], U[:,1]
-    vel = jnp.linalg.norm(U, axis=-1)
+## The whole time loop is one compiled scan. The pressure matrix (which never changes) is only factorized once
+solver = ProjectionSolver(diff_operator_u, [rhs_operator_u, rhs_operator_v], cloud_vel, cloud_phi, [bc_u, bc_v, bc_phi], 
+                        RBF, MAX_DEGREE, DT, rho=RHO, beta=BETA)
 
-    u_list.append(u)
-    v_list.append(v)
-    vel_list.append(vel)
-    p_list.append(p_)
+(u, v, p_), (u_list, v_list, vel_list, p_list) = solver.run(u, v, p_, NB_ITER)
 
 
 
@@ -192,13 +120,13 @@ for i in tqdm(range(NB_ITER)):
 print("\nSimulation complete. Saving all files to %s" % DATAFOLDER)
 
 
-renum_map_vel = jnp.array(list(cloud_vel.renumbering_map.keys()))
-renum_map_p = jnp.array(list(cloud_phi.renumbering_map.keys()))
+renum_map_vel = cloud_vel.renumbering
+renum_map_p = cloud_phi.renumbering
 
-jnp.savez(DATAFOLDER+'u.npz', renum_map_vel, jnp.stack(u_list, axis=0))
-jnp.savez(DATAFOLDER+'v.npz', renum_map_vel, jnp.stack(v_list, axis=0))
-jnp.savez(DATAFOLDER+'vel.npz', renum_map_vel, jnp.stack(vel_list, axis=0))
-jnp.savez(DATAFOLDER+'p.npz', renum_map_p, jnp.stack(p_list, axis=0))
+jnp.savez(DATAFOLDER+'u.npz', renum_map_vel, u_list)
+jnp.savez(DATAFOLDER+'v.npz', renum_map_vel, v_list)
+jnp.savez(DATAFOLDER+'vel.npz', renum_map_vel, vel_list)
+jnp.savez(DATAFOLDER+'p.npz', renum_map_p, p_list)
 
 # plt.show()
 
@@ -37,7 +37,7 @@ facet_types_vel = {"Wall":"d", "Inflow":"d", "Outflow":"n"}
 facet_types_phi = {"Wall":"n", "Inflow":"n", "Outflow":"d"}
 
 cloud_vel = GmshCloud(filename="./meshes/channel.py", facet_types=facet_types_vel, mesh_save_location=DATAFOLDER)    ## TODO Pass the savelocation here
-cloud_phi = GmshCloud(filename=DATAFOLDER+"mesh.msh", facet_types=facet_types_phi)
+cloud_phi = cloud_vel.with_facet_types(facet_types_phi)
 
 fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(8.5,1.4*2), sharex=True)
 cloud_vel.visualize_cloud(ax=ax1, s=6, title="Cloud for velocity", xlabel=False);
@@ -64,15 +64,6 @@ def rhs_operator_u(x, centers=None, rbf=None, fields=None):
     return u_rhs/(2*DT) - grad_px
 
 
-
-@Partial(jax.jit, static_argnums=[2,3])
-def diff_operator_v(x, center=None, rbf=None, monomial=None, fields=None):
-    U = jnp.array([fields[0], fields[1]])
-    v_val = nodal_value(x, center, rbf, monomial)
-    v_grad = nodal_gradient(x, center, rbf, monomial)
-    v_lap = nodal_laplacian(x, center, rbf, monomial)
-    return 3*v_val/(2*DT) + jnp.dot(U, v_grad) - v_lap/Du
-
 @Partial(jax.jit, static_argnums=[2])
 def rhs_operator_v(x, centers=None, rbf=None, fields=None):
     v_rhs = value(x, fields[:, 0], centers, rbf)
@@ -80,16 +71,6 @@ def rhs_operator_v(x, centers=None, rbf=None, fields=None):
     return v_rhs/(2*DT) - grad_py
 
 
-
-@Partial(jax.jit, static_argnums=[2,3])
-def diff_operator_phi(x, center=None, rbf=None, monomial=None, fields=None):
-    return nodal_laplacian(x, center, rbf, monomial)
-
-@Partial(jax.jit, static_argnums=[2])
-def rhs_operator_phi(x, centers=None, rbf=None, fields=None):
-    return divergence(x, fields[:, :2], centers, rbf)
-
-
 ## Initial states, all defined on cloud_vel
 u_now = u_prev = jnp.zeros((cloud_vel.N,))
 v_now = v_prev = jnp.zeros((cloud_vel.N,))
@@ -111,87 +92,11 @@ bc_phi = {"Wall":zero, "Inflow":zero, "Outflow":zero}
 
 
 
-u_list = []
-v_list = []
-vel_list = []
-p_list = []
-
-for i in tqdm(range(NB_ITER)):
-    # print("Starting iteration %d" % i)
-
-    ## For all innner loop
-    u_rhs = 4*u_now - u_prev
-    v_rhs = 4*v_now - v_prev
-
-    ## Only for k=0
-    u_next_prev = 2*u_now - u_prev
-    v_next_prev = 2*v_now - v_prev
-    p_next_prev_ = 3*p_now_/2 - p_prev_/2
-
-    for k in range(NB_REFINEMENTS):
-        ## TODO Interpolate p and gradphi onto cloud_vel
-        p_next_prev = interpolate_field(p_next_prev_, cloud_phi, cloud_vel)
-
-        usol = pde_solver(diff_operator=diff_operator_u,
-                        diff_args=[u_next_prev, v_next_prev],
-                        rhs_operator = rhs_operator_u,
-                        rhs_args=[u_rhs, p_next_prev],
-                        cloud = cloud_vel,
-                        boundary_conditions = bc_u,
-                        rbf=RBF,
-                        max_degree=MAX_DEGREE)
-        u_star_now = usol.vals
-
-        vsol = pde_solver(diff_operator=diff_operator_v,
-                        diff_args=[u_next_prev, v_next_prev],
-                        rhs_operator = rhs_operator_v,
-                        rhs_args=[v_rhs, p_next_prev], 
-                        cloud = cloud_vel,
-                        boundary_conditions = bc_v,
-                        rbf=RBF,
-                        max_degree=MAX_DEGREE)
-
-        v_star_now = vsol.vals
-
-        U_star_now = jnp.stack([u_star_now, v_star_now], axis=-1)
-        ## TODO Interpolate Ustar onto cloud_phi
-        u_star_now_ = interpolate_field(u_star_now, cloud_vel, cloud_phi)
-        v_star_now_ = interpolate_field(v_star_now, cloud_vel, cloud_phi)
-
-        phisol_ = pde_solver(diff_operator=diff_operator_phi,
-                        rhs_operator = rhs_operator_phi,
-                        rhs_args=[u_star_now_,v_star_now_], 
-                        cloud = cloud_phi, 
-                        boundary_conditions = bc_phi,
-                        rbf=RBF,
-                        max_degree=MAX_DEGREE)
-
-        p_next_now_ = p_next_prev_ + 3*phisol_.vals/(2*DT)
-        gradphi_ = gradient_vec(cloud_phi.sorted_nodes, phisol_.coeffs, cloud_phi.sorted_nodes, RBF)        ## TODO use Pde_solver here instead ?
-
-        ## TODO Interpolate p and gradphi onto cloud_vel
-        gradphi = interpolate_field(gradphi_, cloud_phi, cloud_vel)
-
-        U_next_now = U_star_now - gradphi
-        u_next_now, v_next_now = U_next_now[:,0], U_next_now[:,1]
-        vel_next_now = jnp.linalg.norm(U_next_now, axis=-1)
-
-        u_next_prev = u_next_now 
-        v_next_prev = v_next_now 
-        p_next_prev_ = p_next_now_
-
-    u_prev = u_now.copy()
-    v_pref = v_now.copy()
-    p_prev_ = p_now_.copy()
-
-    u_now = u_next_now.copy()
-    v_now = v_next_now.copy()
-    p_now_ = p_next_now_.copy()
+## The whole time loop (with its fixed point refinements) is one compiled scan. The pressure matrix is only factorized once
+solver = BDF2ProjectionSolver(diff_operator_u, [rhs_operator_u, rhs_operator_v], cloud_vel, cloud_phi, [bc_u, bc_v, bc_phi], 
+                            RBF, MAX_DEGREE, DT, nb_refinements=NB_REFINEMENTS)
 
-    u_list.append(u_next_now)
-    v_list.append(v_next_now)
-    vel_list.append(vel_next_now)
-    p_list.append(p_next_now_)
+(u_now, v_now, p_now_), (u_list, v_list, vel_list, p_list) = solver.run(u_now, v_now, p_now_, NB_ITER)
 
 
 
@@ -200,13 +105,13 @@ for i in tqdm(range(NB_ITER)):
 print("\nSimulation complete. Saving all files to %s" % DATAFOLDER)
 
 
-renum_map_vel = jnp.array(list(cloud_vel.renumbering_map.keys()))
-renum_map_p = jnp.array(list(cloud_phi.renumbering_map.keys()))
+renum_map_vel = cloud_vel.renumbering
+renum_map_p = cloud_phi.renumbering
 
-jnp.savez(DATAFOLDER+'u.npz', renum_map_vel, jnp.stack(u_list, axis=0))
-jnp.savez(DATAFOLDER+'v.npz', renum_map_vel, jnp.stack(v_list, axis=0))
-jnp.savez(DATAFOLDER+'vel.npz', renum_map_vel, jnp.stack(vel_list, axis=0))
-jnp.savez(DATAFOLDER+'p.npz', renum_map_p, jnp.stack(p_list, axis=0))
+jnp.savez(DATAFOLDER+'u.npz', renum_map_vel, u_list)
+jnp.savez(DATAFOLDER+'v.npz', renum_map_vel, v_list)
+jnp.savez(DATAFOLDER+'vel.npz', renum_map_vel, vel_list)
+jnp.savez(DATAFOLDER+'p.npz', renum_map_p, p_list)
 
 # plt.show()
 
@@ -12,7 +12,7 @@ facet_types_vel = {"Wall":"d", "Inflow":"d", "Outflow":"n"}
 facet_types_phi = {"Wall":"n", "Inflow":"n", "Outflow":"d"}
 
 cloud_vel = GmshCloud(filename="./demos/meshes/channel.py", facet_types=facet_types_vel, support_size="max")
-cloud_phi = GmshCloud(filename="./demos/meshes/channel.msh", facet_types=facet_types_phi, support_size="max")
+cloud_phi = cloud_vel.with_facet_types(facet_types_phi)
 
 fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(8.5,1.4*2), sharex=True)
 cloud_vel.visualize_cloud(ax=ax1, s=6, title="Cloud for velocity", xlabel=False);
@@ -55,14 +55,6 @@ def rhs_operator_u(x, centers=None, rbf=None, fields=None):
 
 
 
-@Partial(jax.jit, static_argnums=[2,3])
-def diff_operator_v(x, center=None, rbf=None, monomial=None, fields=None):
-    U_prev = jnp.array([fields[0], fields[1]])
-    v_val = nodal_value(x, center, rbf, monomial)
-    v_grad = nodal_gradient(x, center, rbf, monomial)
-    v_lap = nodal_laplacian(x, center, rbf, monomial)
-    return v_val + DT*jnp.dot(U_prev, v_grad) - DT*NU*v_lap
-
 @Partial(jax.jit, static_argnums=[2])
 def rhs_operator_v(x, centers=None, rbf=None, fields=None):
     v_prev = value(x, fields[:, 0], centers, rbf)
@@ -103,33 +95,27 @@ bc_phi = {"Wall":zero, "Inflow":zero, "Outflow":atmospheric}
 
 
 
+## The inflow profile is the control: gradients of the rollout are taken with respect to its nodal values
+inflow_nodes = jnp.array(cloud_vel.facet_nodes["Inflow"])
+inflow = jax.vmap(parabolic)(cloud_vel.sorted_nodes[inflow_nodes])
+outflow_nodes = jnp.array(cloud_vel.facet_nodes["Outflow"])
+
 nb_iter = 20
-all_u = []
-all_v = []
-all_vel = []
-all_p = []
 
-for i in tqdm(range(nb_iter)):
-    # print("Starting iteration %d" % i)
+
+def simulation_step(state, inflow):
+    u, v, p_ = state
 
     ## TODO Interpolate p and gradphi onto cloud_vel
     p = interpolate_field(p_, cloud_phi, cloud_vel)
 
-    usol = pde_solver(diff_operator=diff_operator_u, 
-                    diff_args=[u, v],
-                    rhs_operator = rhs_operator_u, 
-                    rhs_args=[u, p], 
-                    cloud = cloud_vel, 
-                    boundary_conditions = bc_u,
-                    rbf=RBF,
-                    max_degree=MAX_DEGREE)
-
-    vsol = pde_solver(diff_operator=diff_operator_v,
+    ## u and v share the same operator: one assembly and one factorization for both
+    usol, vsol = pde_solver(diff_operator=diff_operator_u,
                     diff_args=[u, v],
-                    rhs_operator = rhs_operator_v,
-                    rhs_args=[v, p], 
-                    cloud = cloud_vel, 
-                    boundary_conditions = bc_v,
+                    rhs_operator = [rhs_operator_u, rhs_operator_v],
+                    rhs_args=[[u, p], [v, p]],
+                    cloud = cloud_vel,
+                    boundary_conditions = [{**bc_u, "Inflow":inflow}, bc_v],
                     rbf=RBF,
                     max_degree=MAX_DEGREE)
 
@@ -146,7 +132,8 @@ for i in tqdm(range(nb_iter)):
                     cloud = cloud_phi, 
                     boundary_conditions = bc_phi,
                     rbf=RBF,
-                    max_degree=MAX_DEGREE)
+                    max_degree=MAX_DEGREE,
+                    adjoint=True)           ## The phi operator never changes: no need to differentiate its assembly
 
     p_ = beta*p_ + phisol_.vals
     gradphi_ = gradient_vec(cloud_phi.sorted_nodes, phisol_.coeffs, cloud_phi.sorted_nodes, RBF)        ## TODO use Pde_solver here instead ?
@@ -158,17 +145,23 @@ for i in tqdm(range(nb_iter)):
     u, v = U[:,0], U[:,1]
     vel = jnp.linalg.norm(U, axis=-1)
 
-    # fig, ax = plt.subplots(4, 1, figsize=(9.5,1.4*4), sharex=True)
-    # iter_str = " at iteration " + str(i+1)
-    # cloud_vel.visualize_field(u, cmap="jet", title="Velocity along x"+iter_str, ax=ax[0], xlabel=False);
-    # cloud_vel.visualize_field(v, cmap="jet", title="Velocity along y"+iter_str, ax=ax[1], xlabel=False);
-    # cloud_vel.visualize_field(vel, cmap="jet", title="Velocity norm"+iter_str, ax=ax[2], xlabel=False);
-    # cloud_phi.visualize_field(p_, cmap="jet", title="Pressure"+iter_str, ax=ax[3]);
-    # plt.savefig('demos/temp/solutions_iter_'+str(i)+'.png')
-    all_u.append(u)
-    all_v.append(v)
-    all_vel.append(vel)
-    all_p.append(p_)
+    return (u, v, p_), (u, v, vel, p_)
+
+
+@jax.jit
+def simulate(inflow):
+    """ The whole rollout as one scan. Binomial checkpointing keeps the memory of reverse mode logarithmic in nb_iter """
+    return rollout(lambda state, _: simulation_step(state, inflow), (u, v, p_), nb_iter, checkpoint="binomial")
+
+def loss_fn(inflow):
+    (u_final, _, _), _ = simulate(inflow)
+    return jnp.mean((u_final[outflow_nodes] - 1.)**2)        ## Target a unit mean outflow velocity
+
+
+_, (all_u, all_v, all_vel, all_p) = simulate(inflow)
+
+loss, grad = jax.value_and_grad(loss_fn)(inflow)
+print("Outflow loss:", loss, "\t Gradient norm w.r.t. the inflow profile:", jnp.linalg.norm(grad))
 
 
 filename = 'demos/temp/video.mp4'
@@ -12,7 +12,7 @@ facet_types_vel = {"Wall":"d", "Square":"d", "Inflow":"d", "Outflow":"n"}
 facet_types_phi = {"Wall":"n", "Square":"n", "Inflow":"n", "Outflow":"d"}
 
 cloud_vel = GmshCloud(filename="./demos/meshes/cylinder.msh", facet_types=facet_types_vel, support_size="max")       ## TODO do not hardcode this path
-cloud_phi = GmshCloud(filename="./demos/meshes/cylinder.msh", facet_types=facet_types_phi, support_size="max")       ## TODO do not hardcode this path
+cloud_phi = cloud_vel.with_facet_types(facet_types_phi)
 
 
 fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(8.5,1.4*2), sharex=True)
@@ -58,12 +58,6 @@ def rhs_operator_u(x, centers=None, rbf=None, fields=None):
     return  u + DeltaT*(jnp.dot(U, grad_u) - grad_px + lap_u/Re)
 
 
-
-@Partial(jax.jit, static_argnums=[2,3])
-def diff_operator_v(x, center=None, rbf=None, monomial=None, fields=None):
-    v = nodal_value(x, center, rbf, monomial)
-    return  v
-
 @Partial(jax.jit, static_argnums=[2])
 def rhs_operator_v(x, centers=None, rbf=None, fields=None):
     u = value(x, fields[:, 0], centers, rbf) 
@@ -77,16 +71,6 @@ def rhs_operator_v(x, centers=None, rbf=None, fields=None):
     return v + DeltaT*(jnp.dot(U, grad_v) - grad_py + lap_v/Re)
 
 
-
-@Partial(jax.jit, static_argnums=[2,3])
-def diff_operator_phi(x, center=None, rbf=None, monomial=None, fields=None):
-    return nodal_laplacian(x, center, rbf, monomial)
-
-@Partial(jax.jit, static_argnums=[2])
-def rhs_operator_phi(x, centers=None, rbf=None, fields=None):
-    return divergence(x, fields[:, :2], centers, rbf) / DeltaT
-
-
 ## Initial states, all defined on cloud_vel
 u = jnp.zeros((cloud_vel.N,))
 v = jnp.zeros((cloud_vel.N,))
@@ -96,61 +80,19 @@ nb_iter = 5
 # plt.show()
 # exit()
 
-for i in tqdm(range(nb_iter)):
-    # print("Starting iteration %d" % i)
-
-    ## TODO Interpolate p and gradphi onto cloud_vel
-    p = interpolate_field(p_, cloud_phi, cloud_vel)
-
-    usol = pde_solver(diff_operator=diff_operator_u, 
-                    # diff_args=[v], 
-                    rhs_operator = rhs_operator_u, 
-                    rhs_args=[u,v,p], 
-                    cloud = cloud_vel, 
-                    boundary_conditions = bc_u,
-                    rbf=RBF,
-                    max_degree=MAX_DEGREE)
-
-    vsol = pde_solver(diff_operator=diff_operator_v,
-                    # diff_args=[v],
-                    rhs_operator = rhs_operator_v,
-                    rhs_args=[u,v,p], 
-                    cloud = cloud_vel, 
-                    boundary_conditions = bc_v,
-                    rbf=RBF,
-                    max_degree=MAX_DEGREE)
-
-    ustar , vstar = usol.vals, vsol.vals     ## Star
-    Ustar = jnp.stack([ustar,vstar], axis=-1)
-
-    ## TODO Interpolaate Ustar onto cloud_phi
-    u_ = interpolate_field(ustar, cloud_vel, cloud_phi)
-    v_ = interpolate_field(vstar, cloud_vel, cloud_phi)
-
-    phisol_ = pde_solver(diff_operator=diff_operator_phi,
-                    rhs_operator = rhs_operator_phi,
-                    rhs_args=[u_,v_], 
-                    cloud = cloud_phi, 
-                    boundary_conditions = bc_phi,
-                    rbf=RBF,
-                    max_degree=MAX_DEGREE)
-
-    p_ = p_ + phisol_.vals
-    gradphi_ = gradient_vec(cloud_phi.sorted_nodes, phisol_.coeffs, cloud_phi.sorted_nodes, RBF)        ## TODO use Pde_solver here instead ?
-
-    ## TODO Interpolate p and gradphi onto cloud_vel
-    gradphi = interpolate_field(gradphi_, cloud_phi, cloud_vel)
-
-    U = Ustar - gradphi*DeltaT
-    u, v = U[:,0], U[:,1]
-    vel = jnp.linalg.norm(U, axis=-1)
+## Explicit momentum step: no diff_args, so the velocity matrix is also assembled and factorized once
+solver = ProjectionSolver(diff_operator_u, [rhs_operator_u, rhs_operator_v], cloud_vel, cloud_phi, [bc_u, bc_v, bc_phi], 
+                        RBF, MAX_DEGREE, DeltaT, beta=1., momentum_args=lambda u, v, p: (None, [[u, v, p], [u, v, p]]))
+
+_, (all_u, all_v, all_vel, all_p) = solver.run(u, v, p_, nb_iter)
 
+for i in range(nb_iter):
     fig, ax = plt.subplots(4, 1, figsize=(9.5,1.4*4), sharex=True)
     iter_str = " at iteration " + str(i+1)
-    cloud_vel.visualize_field(u, cmap="jet", title="Velocity along x"+iter_str, ax=ax[0], xlabel=False);
-    cloud_vel.visualize_field(v, cmap="jet", title="Velocity along y"+iter_str, ax=ax[1], xlabel=False);
-    cloud_vel.visualize_field(vel, cmap="jet", title="Velocity norm"+iter_str, ax=ax[2], xlabel=False);
-    cloud_phi.visualize_field(p_, cmap="jet", title="Pressure"+iter_str, ax=ax[3]);
+    cloud_vel.visualize_field(all_u[i], cmap="jet", title="Velocity along x"+iter_str, ax=ax[0], xlabel=False);
+    cloud_vel.visualize_field(all_v[i], cmap="jet", title="Velocity along y"+iter_str, ax=ax[1], xlabel=False);
+    cloud_vel.visualize_field(all_vel[i], cmap="jet", title="Velocity norm"+iter_str, ax=ax[2], xlabel=False);
+    cloud_phi.visualize_field(all_p[i], cmap="jet", title="Pressure"+iter_str, ax=ax[3]);
     plt.savefig('demos/temp/solutions_iter_'+str(i)+'.png')
 
 plt.show()
@@ -2,6 +2,9 @@ import updec.config as UPDEC
 
 from updec.utils import *
 from updec.cloud import *
+from updec.metrics import *
 from updec.assembly import *
+from updec.solvers import *
 from updec.operators import *
+from updec.integrators import *
 from updec.visualise import *
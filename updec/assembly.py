@@ -1,11 +1,15 @@
 import jax
 import jax.numpy as jnp
 from jax.tree_util import Partial
+from jax.experimental import sparse
+from jax.experimental.sparse.linalg import spsolve
 
+import numpy as np
+from collections import OrderedDict, namedtuple
 from functools import cache, partial
 
 # from updec.config import RBF, MAX_DEGREE, DIM
-from updec.utils import make_nodal_rbf, make_monomial, compute_nb_monomials, make_all_monomials
+from updec.utils import make_nodal_rbf, make_rbf_gradient, make_rbf_laplacian, make_monomial, compute_nb_monomials, make_all_monomials, monomial_basis, monomial_basis_gradient, monomial_basis_laplacian
 from updec.cloud import Cloud
 
 
@@ -21,36 +25,21 @@ def assemble_Phi(cloud:Cloud, rbf:callable=None):
     rbf_vec = jax.vmap(rbf, in_axes=(None, 0), out_axes=0)
     nodes = cloud.sorted_nodes
 
-    for i in range(N):
-        # for j in cloud.local_supports[i]:
-        #     Phi = Phi.at[i, j].set(nodal_rbf(cloud.nodes[i], cloud.nodes[j]))
-
-        support_ids = jnp.array(cloud.local_supports[i])
-        Phi = Phi.at[i, support_ids].set(rbf_vec(nodes[i], nodes[support_ids]))
+    supports = cloud.local_supports
+    rows = jnp.broadcast_to(jnp.arange(N)[:, jnp.newaxis], supports.shape)
+    Phi = Phi.at[rows, supports].set(jax.vmap(rbf_vec)(nodes, nodes[supports]), mode="drop")
 
     return Phi
 
 
 def assemble_P(cloud:Cloud, nb_monomials:int):
     """ See (6) from Shanane """
-    N = cloud.N
     M = nb_monomials
-    P = jnp.zeros((N, M))
     nodes = cloud.sorted_nodes
 
-    for j in range(M):
-        # monomial = jax.jit(Partial(make_monomial, id=j))      ## IS
-        monomial = Partial(make_monomial, id=j)
-        monomial_vec = jax.vmap(monomial, in_axes=(0,), out_axes=0)
-        P = P.at[:, j].set(monomial_vec(nodes))
-
-        # for i in range(N):
-        #     P = P.at[i, j].set(monomial(cloud.nodes[i]))
+    return jax.vmap(monomial_basis, in_axes=(0, None))(nodes, M)
 
-    return P
 
-
-@cache        ## TODO Make caching work with jax.jit
 def assemble_A(cloud, rbf, nb_monomials=2):
     """ Assemble matrix A, see (4) from Shanane """
 
@@ -66,127 +55,188 @@ def assemble_A(cloud, rbf, nb_monomials=2):
 
     return A
 
-@cache          ## Turn this into assemble and LU decompose
-def assemble_invert_A(cloud, rbf, nb_monomials):
-    A = assemble_A(cloud, rbf, nb_monomials)
-    return jnp.linalg.inv(A)
+class FactorizationCache(object):
+    """ Bounded LRU cache of what is computed once per cloud: LU factors of A, differentiation matrices, etc. """
+    """ Keys are explicit: (cloud geometry hash, rbf, number of monomials, extra). Traced clouds (no geometry hash) are 
+        never cached: pass their factors explicitly instead, see cloud_factors """
 
+    def __init__(self, build:callable, maxsize=8):
+        self.build = build
+        self.maxsize = maxsize
+        self.factors = OrderedDict()
+        self.hits, self.misses = 0, 0
 
-def assemble_op_Phi_P(operator:callable, cloud:Cloud, rbf:callable, nb_monomials:int, args:list):
-    """ Assembles upper op(Phi): the collocation matrix to which a differential operator is applied """
-    ## Only the internal nodes (M, N)
+    def __len__(self):
+        return len(self.factors)
 
-    # operator = jax.jit(operator, static_argnums=2)
+    def clear(self):
+        self.factors.clear()
 
-    N = cloud.N
-    Ni = cloud.Ni
-    M = nb_monomials
-    opPhi = jnp.zeros((Ni, N))
-    opP = jnp.zeros((Ni, M))
+    def get(self, cloud:Cloud, rbf:callable, nb_monomials:int, *extra):
+        key = (cloud.geometry_key, rbf, nb_monomials) + extra if cloud.geometry_key is not None else None
+
+        if key is not None and key in self.factors:
+            self.factors.move_to_end(key)
+            self.hits += 1
+            return self.factors[key]
+
+        self.misses += 1
+        with jax.ensure_compile_time_eval():        ## Build eagerly, even when called under jax.jit
+            factors = self.build(cloud, rbf, nb_monomials, *extra)
+
+        if key is not None and not any(isinstance(leaf, jax.core.Tracer) for leaf in jax.tree_util.tree_leaves(factors)):
+            self.factors[key] = factors             ## Never cache tracers
+            if len(self.factors) > self.maxsize:
+                self.factors.popitem(last=False)
+
+        return factors
+
+
+FACTORIZATIONS = FactorizationCache(lambda cloud, rbf, nb_monomials: jax.scipy.linalg.lu_factor(assemble_A(cloud, rbf, nb_monomials)))
+
+
+def factorize_A(cloud:Cloud, rbf:callable, nb_monomials:int):
+    """ Returns the (cached) LU factorization of A """
+    return FACTORIZATIONS.get(cloud, rbf, nb_monomials)
+
+
+def solve_A(cloud:Cloud, rbf:callable, nb_monomials:int, rhs:jnp.ndarray, trans:int=0, factors=None):
+    """ Solves A x = rhs (or A^T x = rhs if trans=1) by triangular solves with the cached (or given) factors """
+    factors = factorize_A(cloud, rbf, nb_monomials) if factors is None else factors
+    return jax.scipy.linalg.lu_solve(factors, rhs, trans=trans)
+
+
+def operator_key(args):
+    """ Hashable identity of a list of arrays (e.g. diff_args): their ids, or None if any of them is traced """
+    """ Array contents are never read (no device to host copy). Jax arrays are immutable, and cache entries keep their 
+        args alive so ids are not reused: numpy args must not be modified in place """
+    if args is None:
+        return ()
+    if any(isinstance(arg, jax.core.Tracer) for arg in args):
+        return None
+    return tuple(id(arg) for arg in args)
+
+
+class LinearOperatorCache(object):
+    """ Bounded LRU cache of assembled (and factorized) linear operators, keyed by the diff_args they were built from """
+    """ Keys are a static key (e.g. the operator, cloud, rbf and degree of a problem) and the identity of the diff_args. 
+        Equal arrays that are different objects miss: pass the same arrays to reuse an operator """
+
+    def __init__(self, maxsize=1, static_key=()):
+        self.maxsize = maxsize
+        self.static_key = static_key
+        self.operators = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.operators)
+
+    def clear(self):
+        self.operators.clear()
+
+    def get(self, args, build:callable):
+        """ Returns the operator built from args, calling build(args) only on a cache miss """
+        args_key = operator_key(args) if self.maxsize > 0 else None
+        key = (self.static_key, args_key) if args_key is not None else None
+
+        if key is not None and key in self.operators:
+            self.operators.move_to_end(key)
+            self.hits += 1
+            return self.operators[key][1]
+
+        self.misses += 1
+        operator = build(args)
+
+        if key is not None:             ## Never cache operators built from tracers
+            self.operators[key] = (args, operator)          ## The args stay alive with their entry
+            if len(self.operators) > self.maxsize:
+                self.operators.popitem(last=False)
+
+        return operator
 
-    nodes = cloud.sorted_nodes
-    # if len(args) > 0:
-    #     # fields = jnp.stack(args, axis=-1)
-    #     fields = jnp.stack(args, axis=-1)
-    # else:
-    #     fields = jnp.ones((N,1))     ## TODO Won't be used tho. FIx this !
-    fields = jnp.stack(args, axis=-1) if args else jnp.ones((N,1))      ## TODO Find a better way. Will never be used
 
-    # operator_rbf = partial(operator, monomial=None)
-    # @jax.jit
-    def operator_rbf(x, center=None, args=None): 
+@Partial(jax.jit, static_argnums=[0,1,2])
+def _assemble_op_Phi_P_kernel(operator, rbf, nb_monomials, nodes, supports, fields):
+    """ Single batched kernel for op(Phi) and op(P): vmap over internal nodes, then over their stencils """
+    N, Ni = nodes.shape[0], supports.shape[0]
+
+    def operator_rbf(x, center=None, args=None):
         return operator(x, center, rbf, None, args)
-    operator_rbf_vec = jax.jit(jax.vmap(operator_rbf, in_axes=(None, 0, None), out_axes=0))
+    operator_rbf_vec = jax.vmap(jax.vmap(operator_rbf, in_axes=(None, 0, None)), in_axes=(0, 0, 0))
+
+    x_i, f_i = nodes[:Ni], fields[:Ni]
+    vals = operator_rbf_vec(x_i, nodes[supports], f_i)                   ## Padded entries are evaluated but dropped
+
+    rows = jnp.broadcast_to(jnp.arange(Ni)[:, jnp.newaxis], supports.shape)
+    opPhi = jnp.zeros((Ni, N)).at[rows, supports].set(vals, mode="drop")
 
-    # operator_mon = Partial(operator, node=None)
     def operator_mon(x, args=None, monomial=None):
         return operator(x, None, rbf, monomial, args)
-    monomials = make_all_monomials(M)
+    monomials = make_all_monomials(nb_monomials)
+    opP = jnp.stack([jax.vmap(Partial(operator_mon, monomial=monomial))(x_i, f_i) * jnp.ones((Ni,)) for monomial in monomials], axis=-1)
 
-    # coords = cloud.sorted_nodes
-    internal_ids = jnp.arange(Ni)
+    return opPhi, opP.reshape((Ni, nb_monomials))
 
-    for i in range(Ni):
-        assert cloud.node_types[i] == "i", "not an internal node"    ## Internal node
 
-        support_ids = jnp.array(cloud.local_supports[i])
-        opPhi = opPhi.at[i, support_ids].set(operator_rbf_vec(nodes[i], nodes[support_ids], fields[i]))
+def assemble_op_Phi_P(operator:callable, cloud:Cloud, rbf:callable, nb_monomials:int, args:list):
+    """ Assembles upper op(Phi): the collocation matrix to which a differential operator is applied """
+    ## Only the internal nodes (M, N)
 
-    for j in range(M):
-        operator_mon_func = Partial(operator_mon, monomial=monomials[j])
-        operator_mon_vec = jax.vmap(operator_mon_func, in_axes=(0, 0), out_axes=0)
-        opP = opP.at[internal_ids, j].set(operator_mon_vec(nodes[internal_ids], fields[internal_ids]))
+    N = cloud.N
+    Ni = cloud.Ni
+
+    nodes = cloud.sorted_nodes
+    fields = jnp.stack(args, axis=-1) if args else jnp.ones((N,1))      ## TODO Find a better way. Will never be used
+    supports = cloud.local_supports[:Ni]            ## Padded (Ni, k) array: missing entries are N, and are dropped
 
-    return opPhi, opP
+    return _assemble_op_Phi_P_kernel(operator, rbf, nb_monomials, nodes, supports, fields)
 
 
 
 def assemble_bd_Phi_P(cloud:Cloud, rbf:callable, nb_monomials:int):
     """ Assembles upper op(Phi): the collocation matrix to which a differential operator is applied """
-    ## Only the internal nodes (M, N)
-
-    # operator = jax.jit(operator, static_argnums=2)
+    ## Only the boundary nodes (Nd+Nn, N). Dirichlet rows come first, then Neumann rows
 
     N, Ni = cloud.N, cloud.Ni
     Nd, Nn, Nr = cloud.Nd, cloud.Nn, cloud.Nr
+    assert Nr == 0, "Robin boundaries are not supported yet"
     M = nb_monomials
-    bdPhi = jnp.zeros((Nd+Nn+Nr, N))
-    bdP = jnp.zeros((Nd+Nn+Nr, M))
 
     # rbf = Partial(make_rbf, rbf=rbf)                    ## TODO JIT THIS, and Use the prexisting rbf func
-    grad_rbf = jax.grad(rbf)
-    # grad_rbf = jax.jit(jax.grad(nodal_rbf))
+    grad_rbf = make_rbf_gradient(rbf)
 
-    rbf_vec = jax.vmap(rbf, in_axes=(None, 0), out_axes=0)
-    grad_rbf_vec = jax.vmap(grad_rbf, in_axes=(None, 0), out_axes=0)
+    rbf_vec = jax.vmap(jax.vmap(rbf, in_axes=(None, 0)), in_axes=(0, 0))
+    grad_rbf_vec = jax.vmap(jax.vmap(grad_rbf, in_axes=(None, 0)), in_axes=(0, 0))
 
     nodes = cloud.sorted_nodes
+    supports = cloud.local_supports
 
+    node_ids_d = jnp.arange(Ni, Ni+Nd)
+    node_ids_n = jnp.arange(Ni+Nd, Ni+Nd+Nn)
+    normals_n = cloud.outward_normals[node_ids_n]
 
-    ### Fill Matrix Phi with vectorisation from axis=1 ###
 
-    for i in range(Ni, N):
-        ii = i-Ni        ## Actual index in the matrices
-        assert cloud.node_types[i] in ["d", "n"], "not a boundary node"    ## Internal node
-
-        if cloud.node_types[i] == "d":
-            support_d = jnp.array(cloud.local_supports[i])
-            bdPhi = bdPhi.at[ii, support_d].set(rbf_vec(nodes[i], nodes[support_d]))
+    ### Fill Matrix Phi with vectorisation from axis=1 ###
+    vals_d = rbf_vec(nodes[node_ids_d], nodes[supports[node_ids_d]])
+    grads_n = grad_rbf_vec(nodes[node_ids_n], nodes[supports[node_ids_n]])
+    vals_n = jnp.einsum("ijk,ik->ij", grads_n, normals_n)
 
-        elif cloud.node_types[i] == "n":    ## Neumann node
-            support_n = jnp.array(cloud.local_supports[i])
-            grads = grad_rbf_vec(nodes[i], nodes[support_n])
-            # norm = cloud.outward_normals[i]     ### Remove this line
-            bdPhi = bdPhi.at[ii, support_n].set(jnp.dot(grads, cloud.outward_normals[i]))
+    bd_supports = supports[Ni:Ni+Nd+Nn]
+    rows = jnp.broadcast_to(jnp.arange(Nd+Nn)[:, jnp.newaxis], bd_supports.shape)
+    bdPhi = jnp.zeros((Nd+Nn, N)).at[rows, bd_supports].set(jnp.concatenate((vals_d, vals_n)), mode="drop")
 
 
     ### Fill Matrix P with vectorisation from axis=0 ###
-    node_ids_d = [k for k,v in cloud.node_types.items() if v == "d"]
-    node_ids_n = [k for k,v in cloud.node_types.items() if v == "n"]
-
-    monomials = make_all_monomials(M)
-    if len(node_ids_d) > 0:
-        node_ids_d = jnp.array(node_ids_d)
-        for j in range(M):
-            monomial_vec = jax.vmap(monomials[j], in_axes=(0,), out_axes=0)
-            bdP = bdP.at[node_ids_d-Ni, j].set(monomial_vec(nodes[node_ids_d]))
-
-    if len(node_ids_n) > 0:
-        normals_n = jnp.stack([cloud.outward_normals[i] for i in node_ids_n], axis=0)
-        node_ids_n = jnp.array(node_ids_n)
-
-        dot_vec = jax.vmap(jnp.dot, in_axes=(0,0), out_axes=0)
-        for j in range(M):
-            grad_monomial = jax.grad(monomials[j])
-            grad_monomial_vec = jax.vmap(grad_monomial, in_axes=(0,), out_axes=0)
-            grads = grad_monomial_vec(nodes[node_ids_n])
-            bdP = bdP.at[node_ids_n-Ni, j].set(dot_vec(grads, normals_n))
+    bdP_d = jax.vmap(monomial_basis, in_axes=(0, None))(nodes[node_ids_d], M)
+    grads_n = jax.vmap(monomial_basis_gradient, in_axes=(0, None))(nodes[node_ids_n], M)
+    bdP_n = jnp.einsum("ijk,ik->ij", grads_n, normals_n)
+    bdP = jnp.concatenate((bdP_d, bdP_n))
 
     return bdPhi, bdP
 
 
 
-def assemble_B(operator:callable, cloud:Cloud, rbf:callable, nb_monomials:int, diff_args:list):
+def assemble_B(operator:callable, cloud:Cloud, rbf:callable, nb_monomials:int, diff_args:list, factors=None):
     """ Assemble B using opPhi, P, and A """
 
     N, Ni = cloud.N, cloud.Ni
@@ -215,24 +265,268 @@ def assemble_B(operator:callable, cloud:Cloud, rbf:callable, nb_monomials:int, d
     # A = assemble_A(cloud, nodal_rbf, M)       ## TODO make this work for nodal_rbf
     # A = assemble_A(cloud, rbf, M)
 
-    inv_A = assemble_invert_A(cloud, rbf, M)
-    B = diffMat @ inv_A
+    B = solve_A(cloud, rbf, M, diffMat.T, trans=1, factors=factors).T        ## B = diffMat @ inv(A), without the inverse
 
     return B[:, :N]
 
 
+
+def assemble_stencils(cloud:Cloud):
+    """ RBF-FD stencils: each node followed by its local support, shape (N, support_size+1) """
+    return jnp.concatenate((jnp.arange(cloud.N)[:, jnp.newaxis], cloud.local_supports), axis=-1)
+
+
+def assemble_local_A(rbf:callable, nb_monomials:int, x_s:jnp.ndarray, mask:jnp.ndarray):
+    """ Local collocation matrix A over the stencil nodes x_s (n, dim). Padded nodes are decoupled by the mask """
+    n, M = x_s.shape[0], nb_monomials
+    Phi = jax.vmap(jax.vmap(rbf, in_axes=(None, 0)), in_axes=(0, None))(x_s, x_s)
+    Phi = jnp.where(mask[:, jnp.newaxis] & mask[jnp.newaxis, :], Phi, jnp.eye(n))
+    P = jax.vmap(monomial_basis, in_axes=(0, None))(x_s, M) * mask[:, jnp.newaxis]
+    return jnp.block([[Phi, P], [P.T, jnp.zeros((M, M))]])
+
+
+def assemble_local_weights(operator:callable, cloud:Cloud, rbf:callable, nb_monomials:int, diff_args:list):
+    """ Computes the RBF-FD weights by solving one small saddle-point system per node over its stencil """
+    ## Internal rows use the operator, Dirichlet rows the identity, Neumann rows the normal derivative
+
+    N, Ni = cloud.N, cloud.Ni
+    M = nb_monomials
+
+    nodes = cloud.sorted_nodes
+    stencils = assemble_stencils(cloud)
+    n = stencils.shape[1]
+    assert n >= M, "Stencils must contain at least as many nodes as there are monomials"
+
+    fields = jnp.stack(diff_args, axis=-1) if diff_args else jnp.ones((N,1))      ## TODO Find a better way. Will never be used
+    monomials = make_all_monomials(M)
+
+    def local_weights(x, stencil, op_rbf, op_mon):
+        mask = stencil < N                                              ## Padded entries get a zero weight
+        rhs = jnp.concatenate((op_rbf*mask, op_mon))
+        return jnp.linalg.solve(assemble_local_A(rbf, M, nodes[stencil], mask), rhs)[:n]
+
+    def operator_rbf(x, center=None, args=None):
+        return operator(x, center, rbf, None, args)
+    operator_rbf_vec = jax.vmap(jax.vmap(operator_rbf, in_axes=(None, 0, None)), in_axes=(0, 0, 0))
+
+    def operator_mon(x, args=None, monomial=None):
+        return operator(x, None, rbf, monomial, args)
+
+    weights = jnp.zeros((N, n))
+
+    ### Internal nodes ###
+    x_i, x_s, f_i = nodes[:Ni], nodes[stencils[:Ni]], fields[:Ni]
+    op_rbf = operator_rbf_vec(x_i, x_s, f_i)
+    op_mon = jnp.stack([jax.vmap(Partial(operator_mon, monomial=monomial))(x_i, f_i) * jnp.ones((Ni,)) for monomial in monomials], axis=-1)
+    weights = weights.at[:Ni].set(jax.vmap(local_weights)(x_i, stencils[:Ni], op_rbf, op_mon))
+
+    ### Dirichlet nodes: the node itself is the first in its stencil ###
+    weights = weights.at[Ni:Ni+cloud.Nd, 0].set(1.)
+
+    ### Neumann nodes ###
+    if cloud.Nn > 0:
+        n_ids = jnp.arange(Ni+cloud.Nd, Ni+cloud.Nd+cloud.Nn)
+        normals = cloud.outward_normals[n_ids]
+        x_n, x_s = nodes[n_ids], nodes[stencils[n_ids]]
+
+        grad_rbf_vec = jax.vmap(jax.vmap(make_rbf_gradient(rbf), in_axes=(None, 0)), in_axes=(0, 0))
+        op_rbf = jnp.einsum("ijk,ik->ij", grad_rbf_vec(x_n, x_s), normals)
+        op_mon = jnp.einsum("ijk,ik->ij", jax.vmap(monomial_basis_gradient, in_axes=(0, None))(x_n, M), normals)
+        weights = weights.at[n_ids].set(jax.vmap(local_weights)(x_n, stencils[n_ids], op_rbf, op_mon))
+
+    return weights, stencils
+
+
+def assemble_sparse_B(operator:callable, cloud:Cloud, rbf:callable, nb_monomials:int, diff_args:list):
+    """ Assemble the RBF-FD differentiation matrix B as a sparse BCOO matrix with O(N*k) entries """
+
+    weights, stencils = assemble_local_weights(operator, cloud, rbf, nb_monomials, diff_args)
+
+    return stencil_weights_to_bcoo(weights, stencils)
+
+
+def stencil_weights_to_bcoo(weights:jnp.ndarray, stencils:jnp.ndarray):
+    """ Sparse (N, N) BCOO matrix from per-node stencil weights. The same stencils always give the same indices """
+    """ The padding of radius supports (N) is kept, with zero weights: like JAX's own padded BCOO matrices, out of bound 
+        columns are ignored by products. The number of entries is then fixed, and the assembly traceable """
+    N, n = stencils.shape
+
+    order = jnp.argsort(stencils, axis=1)          ## Canonical (row-major, sorted columns) ordering. Padding sorts last
+    cols = jnp.take_along_axis(stencils, order, axis=1).reshape(-1)
+    data = jnp.take_along_axis(weights, order, axis=1).reshape(-1)
+
+    rows = jnp.repeat(jnp.arange(N), n)
+    data = jnp.where(cols < N, data, 0.)
+    indices = jnp.stack((rows, cols), axis=-1).astype(jnp.int32)
+
+    return sparse.BCOO((data, indices), shape=(N, N), indices_sorted=True, unique_indices=True)
+
+
+def sparse_solve(B:sparse.BCOO, rhs:jnp.ndarray):
+    """ Solves the sparse system B x = rhs. B's entries must be sorted, as built by assemble_sparse_B """
+
+    N = B.shape[0]
+    rows, cols = B.indices[:, 0], B.indices[:, 1]
+
+    valid = cols < N                        ## Padding entries (out of bounds, zero weights) are moved past the last row
+    order = jnp.argsort(~valid, stable=True)
+    data, cols = B.data[order], jnp.where(valid, cols, 0)[order]
+    counts = jnp.zeros((N,), dtype=jnp.int32).at[rows].add(valid.astype(jnp.int32))
+    indptr = jnp.concatenate((jnp.zeros((1,), dtype=jnp.int32), jnp.cumsum(counts)))
+
+    return spsolve(data, cols.astype(jnp.int32), indptr.astype(jnp.int32), rhs)
+
+
+DiffMatrices = namedtuple("DiffMatrices", ["I", "Dx", "Dy", "Lap"])
+
+
+
+def _assemble_global_diff_matrices(cloud:Cloud, rbf:callable, nb_monomials:int):
+    """ Dense (N, N) matrices mapping nodal values to their x, y derivatives and Laplacian, through the global interpolant """
+    N, M = cloud.N, nb_monomials
+    nodes = cloud.sorted_nodes
+    supports = cloud.local_supports
+    rows = jnp.broadcast_to(jnp.arange(N)[:, jnp.newaxis], supports.shape)
+
+    grad_rbf = jax.vmap(jax.vmap(make_rbf_gradient(rbf), in_axes=(None, 0)))(nodes, nodes[supports])
+    lap_rbf = jax.vmap(jax.vmap(make_rbf_laplacian(rbf), in_axes=(None, 0)))(nodes, nodes[supports])
+    grad_mon = jax.vmap(monomial_basis_gradient, in_axes=(0, None))(nodes, M)
+    lap_mon = jax.vmap(monomial_basis_laplacian, in_axes=(0, None))(nodes, M)
+
+    def diff_matrix(vals_rbf, vals_mon):
+        opPhi = jnp.zeros((N, N)).at[rows, supports].set(vals_rbf, mode="drop")
+        diffMat = jnp.concatenate((opPhi, vals_mon), axis=-1)
+        return solve_A(cloud, rbf, M, diffMat.T, trans=1).T[:, :N]
+
+    Dx = diff_matrix(grad_rbf[..., 0], grad_mon[..., 0])
+    Dy = diff_matrix(grad_rbf[..., 1], grad_mon[..., 1])
+    Lap = diff_matrix(lap_rbf, lap_mon)
+
+    return DiffMatrices(jnp.eye(N), Dx, Dy, Lap)
+
+
+def _assemble_rbffd_diff_matrices(cloud:Cloud, rbf:callable, nb_monomials:int):
+    """ Sparse (N, N) RBF-FD matrices, all sharing the sparsity pattern of the stencils """
+    N, M = cloud.N, nb_monomials
+    nodes = cloud.sorted_nodes
+    stencils = assemble_stencils(cloud)
+    n = stencils.shape[1]
+    assert n >= M, "Stencils must contain at least as many nodes as there are monomials"
+
+    grad_rbf, lap_rbf = make_rbf_gradient(rbf), make_rbf_laplacian(rbf)
+
+    def local_weights(x, stencil):
+        """ Weights for d/dx, d/dy and the Laplacian at once: one factorization, three right hand sides """
+        x_s, mask = nodes[stencil], stencil < N
+        op_rbf = jnp.concatenate((jax.vmap(grad_rbf, in_axes=(None, 0))(x, x_s),
+                                  jax.vmap(lap_rbf, in_axes=(None, 0))(x, x_s)[:, jnp.newaxis]), axis=-1)
+        op_mon = jnp.concatenate((monomial_basis_gradient(x, M),
+                                  monomial_basis_laplacian(x, M)[:, jnp.newaxis]), axis=-1)
+        rhs = jnp.concatenate((op_rbf*mask[:, jnp.newaxis], op_mon))
+        return jnp.linalg.solve(assemble_local_A(rbf, M, x_s, mask), rhs)[:n]
+
+    weights = jax.vmap(local_weights)(nodes, stencils)                ## (N, n, 3)
+    identity = jnp.zeros((N, n)).at[:, 0].set(1.)                     ## The node itself is first in its stencil
+
+    return DiffMatrices(*[stencil_weights_to_bcoo(w, stencils) for w in (identity, weights[...,0], weights[...,1], weights[...,2])])
+
+
+def _assemble_diff_matrices(cloud:Cloud, rbf:callable, nb_monomials:int, method:str):
+    assemble = _assemble_rbffd_diff_matrices if method == "rbffd" else _assemble_global_diff_matrices
+    return assemble(cloud, rbf, nb_monomials)
+
+DIFF_MATRICES = FactorizationCache(_assemble_diff_matrices)
+
+
+def assemble_diff_matrices(cloud:Cloud, rbf:callable, nb_monomials:int, method="global"):
+    """ Identity, d/dx, d/dy and Laplacian matrices over all nodes of the cloud. Built once per cloud, then cached """
+    """ method: "global" gives dense matrices, "rbffd" gives sparse BCOO matrices with identical indices """
+    return DIFF_MATRICES.get(cloud, rbf, nb_monomials, method)
+
+
+def combine_diff_matrices(matrices:DiffMatrices, cloud:Cloud, val=1., dx=0., dy=0., lap=0.):
+    """ Assembles B = diag(val) I + diag(dx) Dx + diag(dy) Dy + diag(lap) Lap on the internal rows """
+    """ Coefficients are scalars or nodal arrays. Dirichlet rows are the identity, Neumann rows the normal derivative.
+        For sparse matrices, this is an axpy over their (shared) data arrays
+    """
+    N, Ni, Nd = cloud.N, cloud.Ni, cloud.Nd
+    node_ids = jnp.arange(N)
+    internal, dirichlet = node_ids < Ni, (node_ids >= Ni) & (node_ids < Ni+Nd)
+    neumann = node_ids >= Ni+Nd
+    normals = cloud.outward_normals
+
+    broadcast = lambda c: jnp.broadcast_to(jnp.asarray(c, dtype=float), (N,))
+    c_I = jnp.where(internal, broadcast(val), jnp.where(dirichlet, 1., 0.))
+    c_x = jnp.where(internal, broadcast(dx), jnp.where(neumann, normals[:, 0], 0.))
+    c_y = jnp.where(internal, broadcast(dy), jnp.where(neumann, normals[:, 1], 0.))
+    c_L = jnp.where(internal, broadcast(lap), 0.)
+
+    I, Dx, Dy, Lap = matrices
+    if isinstance(I, sparse.BCOO):
+        rows = I.indices[:, 0]
+        data = c_I[rows]*I.data + c_x[rows]*Dx.data + c_y[rows]*Dy.data + c_L[rows]*Lap.data
+        return sparse.BCOO((data, I.indices), shape=I.shape, indices_sorted=True, unique_indices=True)
+    else:
+        return c_I[:, jnp.newaxis]*I + c_x[:, jnp.newaxis]*Dx + c_y[:, jnp.newaxis]*Dy + c_L[:, jnp.newaxis]*Lap
+
+
 def new_compute_coefficients(field:jnp.DeviceArray, cloud:Cloud, rbf:callable, nb_monomials:int):
     """ Find nodal and polynomial coefficients for scaar field s """ 
 
     rhs = jnp.concatenate((field, jnp.zeros((nb_monomials))))
-    inv_A = assemble_invert_A(cloud, rbf, nb_monomials)
 
-    return inv_A@rhs
+    return solve_A(cloud, rbf, nb_monomials, rhs)
+
+
+
+def compute_coefficients_batched(fields:jnp.ndarray, cloud:Cloud, rbf:callable, nb_monomials:int, factors=None):
+    """ Nodal and polynomial coefficients of several fields (N, k) at once: one multi-RHS solve with the cached factors """
+
+    rhs = jnp.concatenate((fields, jnp.zeros((nb_monomials, fields.shape[1]))), axis=0)
+
+    return solve_A(cloud, rbf, nb_monomials, rhs, factors=factors)
+
+
+def _factorize_local_A(cloud:Cloud, rbf:callable, nb_monomials:int):
+    N, Ni = cloud.N, cloud.Ni
+    stencils = assemble_stencils(cloud)[:Ni]
+    local_A = jax.vmap(lambda stencil: assemble_local_A(rbf, nb_monomials, cloud.sorted_nodes[stencil], stencil < N))(stencils)
+    return jax.vmap(jax.scipy.linalg.lu_factor)(local_A)
 
+LOCAL_FACTORS = FactorizationCache(_factorize_local_A)
 
 
-def assemble_q(operator:callable, boundary_conditions:dict, cloud:Cloud, rbf:callable, nb_monomials:int, rhs_args:list):
+def factorize_local_A(cloud:Cloud, rbf:callable, nb_monomials:int):
+    """ LU factors of the local collocation matrices over the stencils of the internal nodes, built once per cloud """
+    return LOCAL_FACTORS.get(cloud, rbf, nb_monomials)
+
+
+def cloud_factors(cloud:Cloud, rbf:callable, nb_monomials:int, method="global"):
+    """ The (cached) factors the solves on a cloud need: LU factors of A for global collocation, or of the local 
+        collocation matrices for RBF-FD. Pass them to traced solves, where the cloud cannot be looked up """
+    return factorize_local_A(cloud, rbf, nb_monomials) if method == "rbffd" else factorize_A(cloud, rbf, nb_monomials)
+
+
+def compute_local_coefficients(fields:jnp.ndarray, cloud:Cloud, rbf:callable, nb_monomials:int, factors=None):
+    """ RBF-FD counterpart of compute_coefficients_batched: coefficients (Ni, n+M, k) of the local interpolants of the 
+        fields (N, k) over the stencil of each internal node. Padded stencil entries get zero coefficients """
+    N, Ni, M = cloud.N, cloud.Ni, nb_monomials
+    stencils = assemble_stencils(cloud)[:Ni]
+    lu, piv = factorize_local_A(cloud, rbf, M) if factors is None else factors
+
+    def local_coefficients(stencil, lu, piv):
+        mask = (stencil < N)[:, jnp.newaxis]
+        rhs = jnp.concatenate((jnp.where(mask, fields[stencil], 0.), jnp.zeros((M, fields.shape[1]))), axis=0)
+        return jax.scipy.linalg.lu_solve((lu, piv), rhs)
+
+    return jax.vmap(local_coefficients)(stencils, lu, piv)
+
+
+def assemble_q(operator:callable, boundary_conditions:dict, cloud:Cloud, rbf:callable, nb_monomials:int, rhs_args:list, method="global", factors=None):
     """ Assemble the right hand side q using the operator """
+    """ With method="rbffd", the operator sees the local interpolant of each internal node: its stencil nodes as 
+        centers, and the fields' local coefficients. The global collocation matrix is never built
+        factors: the cloud_factors for method, looked up in the caches if not given """
     ### Boundary conditions should match all the types of boundaries
 
     N = cloud.N
@@ -240,31 +534,50 @@ def assemble_q(operator:callable, boundary_conditions:dict, cloud:Cloud, rbf:cal
     M = nb_monomials
     q = jnp.zeros((N,))
 
-    ## Compute coefficients here
-    if rhs_args != None:
-        fields_coeffs = [new_compute_coefficients(field, cloud, rbf, M) for field in rhs_args]
-        fields_coeffs = jnp.stack(fields_coeffs, axis=-1)
-    else:
-        fields_coeffs = None
-
-    ## Internal node
-    operator_vec = jax.vmap(operator, in_axes=(0, None, None, None), out_axes=(0))
     nodes = cloud.sorted_nodes
     internal_ids = jnp.arange(Ni)
-    q = q.at[internal_ids].set(operator_vec(nodes[internal_ids], nodes, rbf, fields_coeffs))
 
-
-    ## Facet nodes
+    ## Internal node
+    if callable(operator) and method == "rbffd":
+        stencils = assemble_stencils(cloud)[:Ni]
+        if rhs_args != None:
+            fields_coeffs = compute_local_coefficients(jnp.stack(rhs_args, axis=-1), cloud, rbf, M, factors)
+            operator_vec = jax.vmap(operator, in_axes=(0, 0, None, 0), out_axes=(0))
+        else:
+            fields_coeffs = None
+            operator_vec = jax.vmap(operator, in_axes=(0, 0, None, None), out_axes=(0))
+        q = q.at[internal_ids].set(operator_vec(nodes[internal_ids], nodes[stencils], rbf, fields_coeffs))
+    elif callable(operator):
+        ## Compute coefficients for all fields at once
+        if rhs_args != None:
+            fields_coeffs = compute_coefficients_batched(jnp.stack(rhs_args, axis=-1), cloud, rbf, M, factors)
+        else:
+            fields_coeffs = None
+
+        operator_vec = jax.vmap(operator, in_axes=(0, None, None, None), out_axes=(0))
+        q = q.at[internal_ids].set(operator_vec(nodes[internal_ids], nodes, rbf, fields_coeffs))
+    else:                   ## Precomputed nodal values (N,) then
+        q = q.at[internal_ids].set(operator[internal_ids])
+
+
+    ## Facet nodes: values are gathered per facet, then written with a single scatter
+    bd_ids, bd_vals = [], []
     for f_id in cloud.facet_types.keys():
         assert f_id in boundary_conditions.keys(), "facets and boundary functions don't match ids"
 
         bd_op = boundary_conditions[f_id]
-        bd_node_ids = jnp.array(cloud.facet_nodes[f_id])
+        bd_node_ids = jnp.asarray(cloud.facet_nodes[f_id])
 
         if callable(bd_op):      ## Is a (jitted) function 
             bd_op_vec = jax.vmap(bd_op, in_axes=(0,), out_axes=0)
-            q = q.at[bd_node_ids].set(bd_op_vec(nodes[bd_node_ids]))
-        else:                   ## Must be a jax array then
-            q = q.at[bd_node_ids].set(bd_op)
+            vals = bd_op_vec(nodes[bd_node_ids])
+        else:                   ## Must be a jax array (or a scalar) then
+            vals = bd_op
+
+        bd_ids.append(bd_node_ids)
+        bd_vals.append(jnp.broadcast_to(jnp.asarray(vals, dtype=q.dtype), bd_node_ids.shape))
+
+    if bd_ids:
+        q = q.at[jnp.concatenate(bd_ids)].set(jnp.concatenate(bd_vals))
 
     return q
@@ -2,45 +2,167 @@ import warnings
 import jax
 import jax.numpy as jnp
 from sklearn.neighbors import BallTree, KDTree
-from updec.utils import distance
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import pdist
+import updec.config as UPDEC
 
 import os
+import copy
+import shutil
+import hashlib
+import numpy as np
 from functools import cache
 
+NODE_TYPES = {"i":0, "d":1, "n":2, "r":3}       ## Node type codes: internal, dirichlet, neumann, robin. Also the renumbering order
+
+
+CLOUD_LEAVES = ("nodes", "outward_normals", "local_supports", "renumbering", "renumbering_map")      ## Traced in jitted code
+
+def _is_static(value):
+    """ Scalars, strings, and tuples or dicts of them: what a cloud's metadata can hold """
+    if isinstance(value, dict):
+        return all(_is_static(k) and _is_static(v) for k, v in value.items())
+    if isinstance(value, tuple):
+        return all(_is_static(v) for v in value)
+    return isinstance(value, (int, float, str, type(None)))
+
+
+class CloudMetadata(object):
+    """ Static part of a flattened cloud: its type, sizes, facets, support parameters, and its other static attributes """
+    """ It holds no arrays, nor the cloud itself: compilations keyed on it keep nothing alive. Clouds with equal metadata 
+        share compilations, whatever their coordinates. Arrays only needed to build a cloud (grid indices, mesh curves,
+        PRNG keys) are not carried over """
+
+    def __init__(self, cloud):
+        attributes = [(name, value) for name, value in vars(cloud).items() 
+                        if name not in CLOUD_LEAVES and name != "geometry_key" and _is_static(value)]     ## The key is recomputed from the leaves
+        self.attributes = tuple((name, isinstance(value, dict), tuple(value.items()) if isinstance(value, dict) else value) 
+                                for name, value in attributes)
+
+    def __hash__(self):
+        return hash(self.attributes)
+
+    def __eq__(self, other):
+        return isinstance(other, CloudMetadata) and self.attributes == other.attributes
+
+
 class Cloud(object):        ## TODO: implemtn len, get_item, etc.
-    def __init__(self, facet_types, support_size="max"):
+    """ Structure-of-arrays point cloud. After renumbering, all per-node data are arrays in the new numbering:
+        nodes (N, dim), node_types (N,) int8 codes, node_facets (N,) facet ids (-1 if internal),
+        local_supports (N, k) int32 (padded with N for radius supports), and outward_normals (N, dim), zero where not defined
+    """
+    def __init__(self, facet_types, support_size="max", support_radius=None):
         self.N = 0 
         self.Ni = 0
         self.Nd = 0
         self.Nr = 0
         self.Nn = 0
-        self.nodes = {}
-        self.outward_normals = {}
-        self.node_types = {}
+        self.nodes = None
+        self.outward_normals = None
+        self.node_types = None
+        self.node_facets = None
         self.facet_nodes = {}
+        self.facet_offsets = {}
         self.facet_types = facet_types
         self.support_size = support_size
+        self.support_radius = support_radius        ## If given, supports are all the nodes within this radius instead
         self.dim = 2                ## TODO: default problem dimension is 2
         # self.facet_names = {}
         self.facet_precedence = {k:i for i,(k,v) in enumerate(facet_types.items())}        ## Facet order of precedence usefull for corner nodes membership
 
 
     def average_spacing(self):
-        spacings = []
-        for i in range(self.N):
-            for j in range(i, self.N):
-                spacings.append(distance(self.nodes[i], self.nodes[j]))
-        return jnp.mean(jnp.array(spacings))
-
-    # @cache
-    def get_sorted_nodes(self):       ## LRU cache this, or turn it into @Property
-        """ Return numpy arrays """
-        sorted_nodes = sorted(self.nodes.items(), key=lambda x:x[0])
-        return jnp.stack(list(dict(sorted_nodes).values()), axis=-1).T
+        """ Mean distance over all node pairs, each node paired with itself included. Quadratic in the number of nodes """
+        """ For nearest neighbour spacings, see updec.metrics.separation_distances and fill_distances """
+        pair_distances = pdist(np.asarray(self.nodes))
+        return jnp.asarray(pair_distances.sum() / (self.N*(self.N+1)/2))
+
+    def get_sorted_nodes(self):
+        """ Nodes are stored contiguously in the new numbering already """
+        return self.nodes
+
+    def get_geometry_key(self):
+        """ Content hash of the (renumbered) node coordinates and local supports. Identifies the collocation matrix A """
+        digest = hashlib.sha1(np.asarray(self.nodes).tobytes())
+        digest.update(np.asarray(self.local_supports).tobytes())
+        return digest.hexdigest()
+
+    def static_key(self):
+        """ What identifies a cloud inside jitted code: its geometry and its facet types """
+        geometry_key = getattr(self, "geometry_key", None)
+        if geometry_key is None:            ## Not fully built yet: only equal to itself
+            return (id(self),)
+        return (type(self).__name__, geometry_key, tuple(self.facet_types.items()), self.dim)
+
+    def __hash__(self):
+        return hash(self.static_key())
+
+    def __eq__(self, other):
+        return isinstance(other, Cloud) and self.static_key() == other.static_key()
+
+    def tree_flatten(self):
+        """ The node coordinates, normals, local supports and renumbering are the leaves: jitted code traces them instead 
+            of baking them in as constants, and clouds with the same metadata (sizes, facets) share one compilation """
+        return tuple(getattr(self, name, None) for name in CLOUD_LEAVES), CloudMetadata(self)
+
+    @classmethod
+    def tree_unflatten(cls, metadata, children):
+        cloud = cls.__new__(cls)
+        for name, is_dict, value in metadata.attributes:
+            setattr(cloud, name, dict(value) if is_dict else value)
+        for name, child in zip(CLOUD_LEAVES, children):
+            setattr(cloud, name, child)
+        cloud.sorted_nodes = cloud.nodes
+
+        ## Node types and facets are contiguous ranges after renumbering
+        cloud.node_types = jnp.asarray(np.repeat(np.arange(4), [cloud.Ni, cloud.Nd, cloud.Nn, cloud.Nr]), dtype=jnp.int8)
+        node_facets = -np.ones((cloud.N,), dtype=np.int8)
+        cloud.facet_nodes = {}
+        for f_name, (start, stop) in cloud.facet_offsets.items():
+            node_facets[start:stop] = cloud.facet_precedence[f_name]
+            cloud.facet_nodes[f_name] = jnp.asarray(np.arange(start, stop))
+        cloud.node_facets = jnp.asarray(node_facets)
+
+        if all(isinstance(child, (np.ndarray, jax.Array)) and not isinstance(child, jax.core.Tracer) for child in children[:3]):
+            cloud.geometry_key = cloud.get_geometry_key()
+        else:           ## Traced (or placeholder) leaves: no geometry to cache anything against
+            cloud.geometry_key = None
+        return cloud
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        jax.tree_util.register_pytree_node_class(cls)
+
+    def count_node_types(self):
+        types = np.asarray(self.node_types)
+        self.Ni = int(np.sum(types == NODE_TYPES["i"]))
+        self.Nd = int(np.sum(types == NODE_TYPES["d"]))
+        self.Nn = int(np.sum(types == NODE_TYPES["n"]))
+        self.Nr = int(np.sum(types == NODE_TYPES["r"]))
 
     def define_local_supports(self):
-        ## finds the 'support_size' nearest neighbords of each node
-        self.local_supports = {}
+        ## finds the 'support_size' nearest neighbords of each node, or all its neighbours within 'support_radius'
+        ## Both are done with a single bulk query. Radius supports are padded with N (dropped in scatters)
+        coords = np.asarray(self.nodes)
+        kd_tree = cKDTree(coords, leafsize=40)
+
+        if self.support_radius is not None:
+            neighbours = kd_tree.query_ball_point(coords, r=self.support_radius, workers=-1)
+            lengths = np.array([len(nbs) for nbs in neighbours])
+            flat = np.concatenate(neighbours).astype(np.int32)
+            owners = np.repeat(np.arange(self.N), lengths)
+
+            not_self = flat != owners
+            flat, owners = flat[not_self], owners[not_self]
+            lengths = np.bincount(owners, minlength=self.N)
+            assert lengths.min() > 0, "Support radius is too small: some nodes have no neighbours"
+
+            self.support_size = int(lengths.max())
+            positions = np.arange(flat.shape[0]) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            self.local_supports = np.full((self.N, self.support_size), self.N, dtype=np.int32)
+            self.local_supports[owners, positions] = flat
+            return
+
         # if self.support_size < 0 or self.support_size==None or self.support_size>self.N-1:
         if self.support_size == "max":
             # warnings.warn("Support size is too big. Setting it to maximum")
@@ -48,56 +170,95 @@ class Cloud(object):        ## TODO: implemtn len, get_item, etc.
         assert self.support_size > 0, "Support size must be strictly greater than 0"
         assert self.support_size < self.N, "Support size must be strictly less than the number of nodes"
 
-        #### BALL TREE METHOD
-        renumb_map = {i:k for i,k in enumerate(self.nodes.keys())}
-        coords = jnp.stack(list(self.nodes.values()), axis=-1).T
-        # ball_tree = KDTree(coords, leaf_size=40, metric='euclidean')
-        ball_tree = BallTree(coords, leaf_size=40, metric='euclidean')
-        for i in range(self.N):
-            _, neighbours = ball_tree.query(coords[i:i+1], k=self.support_size+1)
-            neighbours = neighbours[0][1:]                    ## Result is a 2d list, with the first el itself
-            self.local_supports[renumb_map[i]] = [renumb_map[j] for j in neighbours]
+        _, neighbours = kd_tree.query(coords, k=self.support_size+1, workers=-1)
+        self.local_supports = neighbours[:, 1:].astype(np.int32)          ## The first neighbour is the node itself
 
     def renumber_nodes(self):
         """ Places the internal nodes at the top of the list, then the dirichlet, then neumann: good for matrix afterwards """
+        """ Within a type, nodes are grouped by facet, so each facet is a contiguous range. Done with one permutation gather """
 
-        i_nodes = []
-        d_nodes = []
-        n_nodes = []
-        r_nodes = []
-        for i in range(self.N):         
-            if self.node_types[i] == "i":
-                i_nodes.append(i)
-            elif self.node_types[i] == "d":
-                d_nodes.append(i)
-            elif self.node_types[i] == "n":
-                n_nodes.append(i)
-            elif self.node_types[i] == "r":
-                r_nodes.append(i)
-
-        new_numb = {v:k for k, v in enumerate(i_nodes+d_nodes+n_nodes+r_nodes)}       ## Reads as: node v is now node k
+        node_types = np.asarray(self.node_types)
+        node_facets = np.asarray(self.node_facets)
+        order = np.lexsort((np.arange(self.N), node_facets, node_types))     ## Reads as: node order[k] is now node k
+        new_numb = np.empty_like(order)
+        new_numb[order] = np.arange(self.N)                                    ## Reads as: node v is now node new_numb[v]
 
         if hasattr(self, "global_indices_rev"):
-            self.global_indices_rev = {new_numb[k]: v for k, v in self.global_indices_rev.items()}
+            self.global_indices_rev = np.asarray(self.global_indices_rev)[order]
         if hasattr(self, "global_indices"):
-            for i, (k, l) in self.global_indices_rev.items():
-                self.global_indices = self.global_indices.at[k, l].set(i)
+            self.global_indices = jnp.asarray(new_numb[np.asarray(self.global_indices)])
 
-        self.node_types = {new_numb[k]:v for k,v in self.node_types.items()}
-        self.nodes = {new_numb[k]:v for k,v in self.nodes.items()}
+        self.nodes = jnp.asarray(np.asarray(self.nodes)[order])
+        self.node_types = jnp.asarray(node_types[order], dtype=jnp.int8)
+        self.node_facets = jnp.asarray(node_facets[order], dtype=jnp.int8)
+        self.outward_normals = jnp.asarray(np.asarray(self.outward_normals)[order])
 
         if hasattr(self, 'local_supports'):
-            self.local_supports = jax.tree_util.tree_map(lambda i:new_numb[i], self.local_supports)
-            self.local_supports = {new_numb[k]:v for k,v in self.local_supports.items()}
+            padded_numb = np.append(new_numb, self.N)          ## Padding entries (N) stay N
+            self.local_supports = jnp.asarray(padded_numb[np.asarray(self.local_supports)[order]], dtype=jnp.int32)
+
+        self.define_facet_ranges()
 
-        self.facet_nodes = jax.tree_util.tree_map(lambda i:new_numb[i], self.facet_nodes)
         if hasattr(self, 'facet_tag_nodes'):
-            self.facet_tag_nodes = jax.tree_util.tree_map(lambda i:new_numb[i], self.facet_tag_nodes)
+            self.facet_tag_nodes = {k:jnp.asarray(new_numb[np.asarray(v, dtype=int)]) for k,v in self.facet_tag_nodes.items()}
+
+        self.renumbering = jnp.asarray(order)              ## New node id -> original node id
+        self.renumbering_map = jnp.asarray(new_numb)       ## Original node id -> new node id
+        self.count_node_types()
+
+    def permutation_to(self, other):
+        """ Indices p such that field_other = field_self[p], for a cloud with the same nodes in another numbering """
+        return np.asarray(self.renumbering_map)[np.asarray(other.renumbering)]
+
+    def node_facet_names(self):
+        """ The facet name of each node, "" for internal nodes """
+        names = np.array(list(self.facet_precedence.keys()) + [""])
+        return names[np.asarray(self.node_facets)]          ## Internal nodes (-1) pick the trailing ""
+
+    def with_facet_types(self, facet_types:dict):
+        """ The same geometry with other facet types, e.g. a pressure cloud from a velocity cloud """
+        """ Coordinates, local supports and the normals of unchanged facets are reused: only node types, the missing normals,
+            and the renumbering are computed. Transfers between the two clouds are gathers with permutation_to """
+
+        cloud = copy.copy(self)
+        cloud.facet_types = facet_types
+        cloud.facet_precedence = {k:i for i,(k,v) in enumerate(facet_types.items())}
+        cloud.facet_nodes, cloud.facet_offsets = {}, {}
+
+        ## Back to the original numbering
+        new_numb, order = np.asarray(self.renumbering_map), np.asarray(self.renumbering)
+        cloud.nodes = np.asarray(self.nodes)[new_numb]
+        cloud.local_supports = np.append(order, self.N)[np.asarray(self.local_supports)[new_numb]]      ## Padding (N) stays N
+        if hasattr(self, "global_indices_rev"):
+            cloud.global_indices_rev = np.asarray(self.global_indices_rev)[new_numb]
+        if hasattr(self, "global_indices"):
+            cloud.global_indices = order[np.asarray(self.global_indices)]
+        old_normals = np.asarray(self.outward_normals)[new_numb]
+        old_facets = self.node_facet_names()[new_numb]
 
-        if hasattr(self, 'outward_normals'):
-            self.outward_normals = {new_numb[k]:v for k,v in self.outward_normals.items()}
+        cloud.define_node_types()
+        cloud.node_types, cloud.node_facets = np.asarray(cloud.node_types), np.asarray(cloud.node_facets)
 
-        self.renumbering_map = new_numb
+        needs_normal = cloud.node_types >= NODE_TYPES["n"]
+        reused = needs_normal & (old_facets == cloud.node_facet_names()) & np.any(old_normals != 0., axis=-1)
+        cloud.outward_normals = np.where(reused[:, np.newaxis], old_normals, 0.)
+        missing = np.flatnonzero(needs_normal & ~reused)
+        if len(missing) > 0:
+            cloud.define_outward_normals(node_ids=missing)
+
+        cloud.renumber_nodes()
+        cloud.sorted_nodes = cloud.get_sorted_nodes()
+        cloud.geometry_key = cloud.get_geometry_key()
+        return cloud
+
+    def define_facet_ranges(self):
+        """ Each facet is a contiguous range of the (renumbered) nodes """
+        node_facets = np.asarray(self.node_facets)
+        for f_name, f_id in self.facet_precedence.items():
+            f_nodes = np.flatnonzero(node_facets == f_id)
+            start, stop = (int(f_nodes[0]), int(f_nodes[-1])+1) if len(f_nodes) > 0 else (0, 0)
+            self.facet_offsets[f_name] = (start, stop)
+            self.facet_nodes[f_name] = jnp.asarray(np.arange(start, stop))        ## Not jnp.arange: it compiles for each new size
 
 
 
@@ -140,12 +301,12 @@ class Cloud(object):        ## TODO: implemtn len, get_item, etc.
             fig = plt.figure(figsize=figsize)
             ax = fig.add_subplot(1, 1, 1)
 
-        concerned_nodes = [i for i in range(self.N) if self.node_types[i] in ["n", "r"]]
-        if len(concerned_nodes)==0:  ## Nothing to plot 
+        concerned_nodes = slice(self.Ni+self.Nd, self.N)        ## Neumann and Robin nodes come last
+        if self.Nn+self.Nr == 0:  ## Nothing to plot 
             return ax
 
-        coords = jnp.stack([self.nodes[node_id] for node_id in concerned_nodes], axis=0)
-        normals = jnp.stack([self.outward_normals[node_id] for node_id in concerned_nodes], axis=0)/100     ## Devide by 100 for better visualization
+        coords = self.nodes[concerned_nodes]
+        normals = self.outward_normals[concerned_nodes]/100     ## Devide by 100 for better visualization
 
         q = ax.quiver(coords[:,0], coords[:,1], normals[:,0], normals[:,1], color="w",label="normals", **kwargs)
         ax.quiverkey(q, X=0.5, Y=1.1, U=1, label='Normals', labelpos='E')
@@ -260,6 +421,8 @@ class Cloud(object):        ## TODO: implemtn len, get_item, etc.
 
 
 
+jax.tree_util.register_pytree_node_class(Cloud)
+
 
 class SquareCloud(Cloud):
     def __init__(self, Nx=7, Ny=5, noise_key=None, **kwargs):
@@ -278,128 +441,275 @@ class SquareCloud(Cloud):
         self.renumber_nodes()
 
         self.sorted_nodes = self.get_sorted_nodes()
+        self.geometry_key = self.get_geometry_key()
 
         # self.visualise_cloud()        ## TODO Finsih this properly
 
 
     def define_global_indices(self):
-        ## defines the 2d to 1d indices and vice-versa
-
-        self.global_indices = jnp.zeros((self.Nx, self.Ny), dtype=int)
-        self.global_indices_rev = {}
-
-        count = 0
-        for i in range(self.Nx):
-            for j in range(self.Ny):
-                self.global_indices = self.global_indices.at[i,j].set(count)
-                self.global_indices_rev[count] = (i,j)
-                count += 1
+        ## defines the 2d to 1d indices and vice-versa: node (i,j) is node i*Ny + j
+        self.global_indices = np.arange(self.N).reshape((self.Nx, self.Ny))
+        ii, jj = np.meshgrid(np.arange(self.Nx), np.arange(self.Ny), indexing="ij")
+        self.global_indices_rev = np.stack([ii.ravel(), jj.ravel()], axis=-1)
 
 
     def define_node_coordinates(self, noise_key):
         """ Can be used to redefine coordinates for performance study """
-        x = jnp.linspace(0, 1., self.Nx)
-        y = jnp.linspace(0, 1., self.Ny)
-        xx, yy = jnp.meshgrid(x, y)
+        """ The noise is drawn in one batch, from the same per node keys as a node by node loop """
+        x = np.linspace(0, 1., self.Nx)
+        y = np.linspace(0, 1., self.Ny)
 
         # if noise_key is None:
         #     noise_key = jax.random.PRNGKey(42)
- 
+
+        self.nodes = np.stack([x[self.global_indices_rev[:, 0]], y[self.global_indices_rev[:, 1]]], axis=-1)
+
         if noise_key is not None:
-            key = jax.random.split(noise_key, self.N)
+            keys = jax.random.split(noise_key, self.N)
             delta_noise = min((x[1]-x[0], y[1]-y[0])) / 2.   ## To make sure nodes don't go into each other
 
-        self.nodes = {}
+            uniform = lambda key: jax.random.uniform(key, (2,), minval=-delta_noise, maxval=delta_noise)
+            noise = np.asarray(jax.vmap(uniform)(keys))         ## Just add some noisy noise !!
+            noisy = ~np.isin(self.node_types, [NODE_TYPES["d"], NODE_TYPES["n"]])
+            self.nodes = self.nodes + np.where(noisy[:, np.newaxis], noise, 0.)
 
-        for i in range(self.Nx):
-            for j in range(self.Ny):
-                global_id = int(self.global_indices[i,j])
 
-                if (self.node_types[global_id] not in ["d", "n"]) and (noise_key is not None):
-                    noise = jax.random.uniform(key[global_id], (2,), minval=-delta_noise, maxval=delta_noise)         ## Just add some noisy noise !!
-                else:
-                    noise = jnp.zeros((2,))
+    def define_node_types(self):
+        """ Makes the boundaries for the square domain. Corners go to the West, then North, then East facets """
 
-                self.nodes[global_id] = jnp.array([xx[j,i], yy[j,i]]) + noise
+        self.node_types = np.zeros((self.N,), dtype=np.int8)            ## Coding structure: see NODE_TYPES. Internal nodes are 0
+        self.node_facets = -np.ones((self.N,), dtype=np.int8)          ## Facet each node belongs to. Internal nodes are -1
 
+        k, l = self.global_indices_rev[:, 0], self.global_indices_rev[:, 1]
+        west = k == 0
+        north = ~west & (l == self.Ny-1)
+        east = ~west & ~north & (k == self.Nx-1)
+        south = ~west & ~north & ~east & (l == 0)
 
-    def define_node_types(self):
-        """ Makes the boundaries for the square domain """
-
-        self.facet_nodes = {k:[] for k in self.facet_types.keys()}     ## List of nodes belonging to each facet
-        self.node_types = {}                              ## Coding structure: internal="i", dirichlet="d", neumann="n", external="e" (not supported yet)
-
-        for i in range(self.N):
-            [k, l] = list(self.global_indices_rev[i])
-            if k == 0:
-                self.facet_nodes["West"].append(i)
-                self.node_types[i] = self.facet_types["West"]
-            elif l == self.Ny-1:
-                self.facet_nodes["North"].append(i)
-                self.node_types[i] = self.facet_types["North"]
-            elif k == self.Nx-1:
-                self.facet_nodes["East"].append(i)
-                self.node_types[i] = self.facet_types["East"]
-            elif l == 0:
-                self.facet_nodes["South"].append(i)
-                self.node_types[i] = self.facet_types["South"]
-            else:
-                self.node_types[i] = "i"       ## Internal node (not a boundary). But very very important!
+        for facet, on_facet in zip(["West", "North", "East", "South"], [west, north, east, south]):
+            self.node_facets[on_facet] = self.facet_precedence[facet]
+            self.node_types[on_facet] = NODE_TYPES[self.facet_types[facet]]
 
-        self.Nd = 0
-        self.Nn = 0
-        for f_id, f_type in self.facet_types.items():
-            if f_type == "d":
-                self.Nd += len(self.facet_nodes[f_id])
-            if f_type == "n":
-                self.Nn += len(self.facet_nodes[f_id])
+        self.count_node_types()
+
+    def define_outward_normals(self, node_ids=None):
+        ## Makes the outward normal vectors to boundaries. If node_ids are given, only their normals are (re)computed
+        if node_ids is None:
+            bd_nodes = np.flatnonzero(self.node_types >= NODE_TYPES["n"])     ## Neumann or Robin nodes
+            self.outward_normals = np.zeros((self.N, 2))
+        else:
+            bd_nodes = np.asarray(node_ids)
+
+        k, l = self.global_indices_rev[bd_nodes, 0], self.global_indices_rev[bd_nodes, 1]
+        self.outward_normals[bd_nodes] = np.select([(k==0)[:, np.newaxis], (k==self.Nx-1)[:, np.newaxis], (l==0)[:, np.newaxis], (l==self.Ny-1)[:, np.newaxis]], 
+                                                    [np.array([-1., 0.]), np.array([1., 0.]), np.array([0., -1.]), np.array([0., 1.])])
 
-        self.Ni = self.N - self.Nd - self.Nn
 
-    def define_outward_normals(self):
-        ## Makes the outward normal vectors to boundaries
-        bd_nodes = [k for k,v in self.node_types.items() if v in ["n", "r"]]   ## Neumann or Robin nodes
-        self.outward_normals = {}
 
-        for i in bd_nodes:
-            k, l = self.global_indices_rev[i]
-            if k==0:
-                n = jnp.array([-1., 0.])
-            elif k==self.Nx-1:
-                n = jnp.array([1., 0.])
-            elif l==0:
-                n = jnp.array([0., -1.])
-            elif l==self.Ny-1:
-                n = jnp.array([0., 1.])
 
-            # self.outward_normals[int(self.global_indices[k,l])] = jnp.array([nx, ny])
-            self.outward_normals[int(self.global_indices[k,l])] = n
 
 
 
 
 
 
+MSH_ELEMENT_NODES = {1:2, 2:3, 3:4, 4:4, 5:8, 6:6, 7:5, 8:3, 9:6, 10:9, 11:10, 15:1, 16:8, 21:10, 26:4, 27:5, 28:6}     ## Nodes per element type
 
 
+def _parse_msh_entities(body:bytes, version:float, binary:bool, size_t:str):
+    """ Physical tag of each curve, from the $Entities section """
+    curve_physical_tags = {}
+
+    if binary:
+        counts = np.frombuffer(body, dtype=size_t, count=4)
+        pos = 4*np.dtype(size_t).itemsize
+        for dim, count in enumerate(counts[:3]):
+            for _ in range(int(count)):
+                tag = int(np.frombuffer(body, dtype="<i4", count=1, offset=pos)[0])
+                pos += 4 + 8*(3 if dim == 0 else 6)
+                nb_phys = int(np.frombuffer(body, dtype=size_t, count=1, offset=pos)[0])
+                pos += np.dtype(size_t).itemsize
+                phys = np.frombuffer(body, dtype="<i4", count=nb_phys, offset=pos)
+                pos += 4*nb_phys
+                if dim == 1 and nb_phys > 0:
+                    curve_physical_tags[tag] = int(phys[0])
+                if dim > 0:
+                    nb_bounds = int(np.frombuffer(body, dtype=size_t, count=1, offset=pos)[0])
+                    pos += np.dtype(size_t).itemsize + 4*nb_bounds
+        return curve_physical_tags
+
+    lines = body.decode().split("\n")
+    nb_points, nb_curves = [int(n) for n in lines[0].split()[:2]]
+    for line in lines[1+nb_points:1+nb_points+nb_curves]:
+        splitline = line.split()
+        nb_phys = int(splitline[7])
+        if nb_phys > 0:
+            curve_physical_tags[int(splitline[0])] = int(splitline[8])
+    return curve_physical_tags
+
+
+def _parse_msh_blocks(body:bytes, version:float, binary:bool, size_t:str, elements:bool):
+    """ The entity blocks of a $Nodes or $Elements section: (dim, tag, node_ids, coords) or (dim, tag, connectivity) """
+    """ Only the few block headers are read one by one: all node and element data are bulk reshapes of one array """
+    blocks = []
+
+    if binary:
+        st = np.dtype(size_t).itemsize
+        nb_blocks = int(np.frombuffer(body, dtype=size_t, count=1)[0])
+        pos = 4*st
+        for _ in range(nb_blocks):
+            dim, tag, kind = [int(v) for v in np.frombuffer(body, dtype="<i4", count=3, offset=pos)]
+            n = int(np.frombuffer(body, dtype=size_t, count=1, offset=pos+12)[0])
+            pos += 12 + st
+            if elements:
+                k = 1 + MSH_ELEMENT_NODES[kind]
+                data = np.frombuffer(body, dtype=size_t, count=n*k, offset=pos).reshape((n, k))
+                pos += n*k*st
+                blocks.append((dim, tag, data[:, 1:].astype(np.int64) - 1))
+            else:
+                assert kind == 0, "parametric nodes are not supported"
+                ids = np.frombuffer(body, dtype=size_t, count=n, offset=pos).astype(np.int64) - 1
+                coords = np.frombuffer(body, dtype="<f8", count=3*n, offset=pos+n*st).reshape((n, 3))
+                pos += n*st + 3*n*8
+                blocks.append((dim, tag, ids, coords))
+        return blocks
+
+    values = np.fromstring(body.decode(), sep=" ")
+    new_format = version >= 4.1
+    nb_blocks = int(values[0])
+    pos = 4 if new_format else 2
+    for _ in range(nb_blocks):
+        a, b, kind, n = [int(v) for v in values[pos:pos+4]]
+        dim, tag = (a, b) if new_format else (b, a)
+        pos += 4
+        if elements:
+            k = 1 + MSH_ELEMENT_NODES[kind]
+            data = values[pos:pos+n*k].reshape((n, k))
+            pos += n*k
+            blocks.append((dim, tag, data[:, 1:].astype(np.int64) - 1))
+        else:
+            assert kind == 0, "parametric nodes are not supported"
+            if new_format:          ## All tags, then all coordinates
+                ids = values[pos:pos+n].astype(np.int64) - 1
+                coords = values[pos+n:pos+4*n].reshape((n, 3))
+            else:                   ## One "tag x y z" line per node
+                data = values[pos:pos+4*n].reshape((n, 4))
+                ids, coords = data[:, 0].astype(np.int64) - 1, data[:, 1:]
+            pos += 4*n
+            blocks.append((dim, tag, ids, coords))
+    return blocks
+
+
+def read_msh(filename:str):
+    """ Bulk reader for Gmsh MSH 4.0 and 4.1 files, in ASCII or binary """
+    """ Returns the physical names, the physical tag of each curve, and the node and element blocks (0-based node ids) """
+
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    def section(name, start=0):
+        begin = data.index(b"$"+name.encode(), start)
+        body_start = data.index(b"\n", begin) + 1
+        end = data.index(b"$End"+name.encode(), body_start)
+        return data[body_start:end], end
+
+    header, _ = section("MeshFormat")
+    version, file_type, data_size = header.split(b"\n")[0].split()
+    version, binary = float(version), int(file_type) == 1
+    assert version >= 4., "only the MSH 4.0 and 4.1 formats are supported"
+    assert not binary or version >= 4.1, "binary files must use the MSH 4.1 format"
+    size_t = "<u8" if int(data_size) == 8 else "<u4"
+
+    physical_names = {}
+    if b"$PhysicalNames" in data:
+        names, _ = section("PhysicalNames")
+        for line in names.decode().split("\n")[1:]:
+            splitline = line.split(maxsplit=2)
+            if len(splitline) == 3:
+                physical_names[int(splitline[1])] = splitline[2].strip()[1:-1]    ## Removes quotes
+
+    entities, end = section("Entities")
+    nodes, end = section("Nodes", end)
+    elements, _ = section("Elements", end)
+
+    node_blocks = _parse_msh_blocks(nodes, version, binary, size_t, elements=False)
+
+    return {"physical_names": physical_names,
+            "curve_physical_tags": _parse_msh_entities(entities, version, binary, size_t),
+            "nb_nodes": sum(block[2].shape[0] for block in node_blocks),
+            "node_blocks": node_blocks,
+            "element_blocks": _parse_msh_blocks(elements, version, binary, size_t, elements=True)}
+
+
+
+CLOUD_CACHE_VERSION = 3         ## Bump when the cached bundles change
+
+
+def file_hash(filename:str):
+    """ Content hash of a file """
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1<<20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _atomic_savez(filename:str, **arrays):
+    """ Writes the bundle next to its destination first, so concurrent readers never see a partial file """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = filename+".tmp"+str(os.getpid())
+    with open(tmp, "wb") as f:
+        np.savez(f, **{k:np.asarray(v) for k, v in arrays.items()})
+    os.replace(tmp, filename)
+
+def _atomic_copy(source:str, destination:str):
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    tmp = destination+".tmp"+str(os.getpid())
+    shutil.copyfile(source, tmp)
+    os.replace(tmp, destination)
+
 
 
 class GmshCloud(Cloud):
-    """ Parses gmsh format 4.0.8, not the newer version """
+    """ Parses gmsh formats 4.0 and 4.1, in ASCII or binary """
+    """ cache: opt-in, store the built cloud on disk in UPDEC.CACHE_DIR (~/.cache/updec, or $UPDEC_CACHE_DIR), keyed by 
+            the mesh file's content, the support parameters and the facet types. The mesh geometry and its supports are 
+            shared by clouds that only differ in their facet types. For gmsh python scripts, the generated mesh is cached
+            too and the script is not rerun. Bundles are uncompressed .npz files, read whole: they are not memory-mapped
+        normals: "nearest" or "elements", see define_outward_normals
+    """
 
-    def __init__(self, filename, mesh_save_location=None, **kwargs):
+    def __init__(self, filename, mesh_save_location=None, cache=False, normals="nearest", **kwargs):
 
         super().__init__(**kwargs)
 
+        assert normals in ["nearest", "elements"], "unknown normals method "+str(normals)
+        self.normals = normals
+        self.cache_dir = UPDEC.CACHE_DIR if cache else None
+
         self.get_meshfile(filename, mesh_save_location)
         # self.facet_types = facet_types
 
-        self.extract_nodes_and_boundary_type()
-        self.define_outward_normals()
-        self.define_local_supports()
-        self.renumber_nodes()
+        geometry_file, cloud_file = self.get_cache_files()
+
+        if cloud_file is not None and os.path.exists(cloud_file):
+            self.load_cloud(cloud_file)
+        else:
+            if geometry_file is not None and os.path.exists(geometry_file):
+                self.load_geometry(geometry_file)
+            else:
+                self.read_geometry()
+                self.define_local_supports()
+                if geometry_file is not None:
+                    self.save_geometry(geometry_file)
+
+            self.define_node_types()
+            self.define_outward_normals()
+            self.renumber_nodes()
+            if cloud_file is not None:
+                self.save_cloud(cloud_file)
 
         self.sorted_nodes = self.get_sorted_nodes()
+        self.geometry_key = self.get_geometry_key()
 
 
     def get_meshfile(self, filename, mesh_save_location):
@@ -407,160 +717,220 @@ class GmshCloud(Cloud):
         if extension == "msh":   ## Gmsh Geo file
             self.filename = filename
         elif extension == "py":  ## Gmsh Python API
-            os.system("python "+filename + " " + mesh_save_location +" --nopopup")
             self.filename = mesh_save_location+"mesh.msh"
+            cached_mesh = None if self.cache_dir is None else os.path.join(self.cache_dir, "mesh_"+file_hash(filename)+".msh")
 
-
-    def extract_nodes_and_boundary_type(self):
-        """ Extract nodes and all boundary types """
-
-        f = open(self.filename, "r")
-
-        #--- Facet names ---#
-        line = f.readline()
-        while line.find("$PhysicalNames") < 0: line = f.readline()
-        splitline = f.readline().split()
-
-        facet_physical_names = {}
-        nb_facets = int(splitline[0]) - 1
-        for facet in range(nb_facets):
-            splitline = f.readline().split()
-            facet_physical_names[int(splitline[1])] = (splitline[2])[1:-1]    ## Removes quotes
-
-        #--- Physical names to entities ---#
-        self.facet_names = {}
-        line = f.readline()
-        while line.find("$Entities") < 0: line = f.readline()
-        splitline = f.readline().split()
-        n_vertices, n_facets = int(splitline[0]), int(splitline[1])
-        for _ in range(n_vertices):
-            line = f.readline()     ## Skip the vertices
-        for _ in range(n_facets):
-            splitline = f.readline().split()     ## Skip the vertices
-            self.facet_names[int(splitline[0])] = facet_physical_names[int(splitline[-4])]
-
-        #--- Reading mesh nodes ---#
-        line = f.readline()
-        while line.find("$Nodes") < 0: line = f.readline()
-        splitline = f.readline().split()
-
-        self.N = int(splitline[1])
-        self.nodes = {}
-        self.facet_nodes = {v:[] for v in self.facet_names.values()}
-        self.facet_tag_nodes = {k:[] for k in self.facet_names.keys()}        ## Useful for normals
-        self.node_types = {}
-        corner_membership = {}
-
-        line = f.readline()
-        while line.find("$EndNodes") < 0:
-            splitline = line.split()
-            entity_id = int(splitline[0])
-            dim = int(splitline[1])
-            nb = int(splitline[-1])
-            facet_nodes = []
-
-            for i in range(nb):
-                splitline = f.readline().split()
-                node_id = int(splitline[0]) - 1
-                x = float(splitline[1])
-                y = float(splitline[2])
-                z = float(splitline[3])
-
-                self.nodes[node_id] = jnp.array([x, y])
-
-                if dim==0: ## A corner point
-                    corner_membership[node_id] = []
-
-                elif dim==1:  ## A curve
-                    self.node_types[node_id] = self.facet_types[self.facet_names[entity_id]]
-                    facet_nodes.append(node_id)
-
-                elif dim==2:  ## A surface
-                    self.node_types[node_id] = "i"
-
-            if dim==1:
-                self.facet_nodes[self.facet_names[entity_id]] += facet_nodes
-                self.facet_tag_nodes[entity_id] += facet_nodes
-
-            line = f.readline()
-
-        # --- Read mesh elements for corner nodes ---#
-        while line.find("$Elements") < 0: line = f.readline()
-        f.readline()
-
-        line = f.readline()
-        while line.find("$EndElements") < 0:
-            splitline = line.split()
-            entity_id = int(splitline[0])
-            dim = int(splitline[1])
-            nb = int(splitline[-1])
-
-            if dim == 1:                ## Only considering elements of dim=DIM-1
-                for i in range(nb):
-                    splitline = [int(n_id)-1 for n_id in f.readline().split()[1:]]
-
-                    for c_node_id in corner_membership.keys():
-                        if c_node_id in splitline:
-                            for neighboor in splitline:
-                                if neighboor != c_node_id:
-                                    corner_membership[c_node_id].append(entity_id)
-                                    break
-
+            if cached_mesh is not None and os.path.exists(cached_mesh):
+                shutil.copyfile(cached_mesh, self.filename)
             else:
-                for i in range(nb): f.readline()
-
-            line = f.readline()
-
-        f.close()
+                os.system("python "+filename + " " + mesh_save_location +" --nopopup")
+                if cached_mesh is not None:
+                    _atomic_copy(self.filename, cached_mesh)
+
+
+    def get_cache_files(self):
+        """ Bundles for the geometry (mesh and supports), and for the whole cloud (geometry and facet types) """
+        if self.cache_dir is None:
+            return None, None
+
+        geometry_key = hashlib.sha1(repr((CLOUD_CACHE_VERSION, file_hash(self.filename), self.support_size, self.support_radius)).encode()).hexdigest()
+        cloud_key = hashlib.sha1(repr((geometry_key, tuple(self.facet_types.items()), self.normals)).encode()).hexdigest()
+
+        return os.path.join(self.cache_dir, "geometry_"+geometry_key+".npz"), os.path.join(self.cache_dir, "cloud_"+cloud_key+".npz")
+
+
+    def save_geometry(self, filename):
+        curve_tags = np.array(list(self.facet_names.keys()), dtype=np.int64)
+        _atomic_savez(filename, nodes=self.nodes, node_curves=self.node_curves, corner_ids=self.corner_ids, 
+                        corner_curves=self.corner_curves, curve_tags=curve_tags, curve_names=np.array(list(self.facet_names.values()), dtype=str),
+                        local_supports=self.local_supports, support_size=self.support_size,
+                        curve_segments=self.curve_segments, segment_curves=self.segment_curves)
+
+    def load_geometry(self, filename):
+        with np.load(filename) as bundle:
+            self.nodes = bundle["nodes"]
+            self.N = self.nodes.shape[0]
+            self.node_curves = bundle["node_curves"]
+            self.corner_ids, self.corner_curves = bundle["corner_ids"], bundle["corner_curves"]
+            self.facet_names = dict(zip(bundle["curve_tags"].tolist(), bundle["curve_names"].tolist()))
+            self.local_supports = bundle["local_supports"]
+            self.support_size = int(bundle["support_size"])
+            self.curve_segments, self.segment_curves = bundle["curve_segments"], bundle["segment_curves"]
+
+
+    def save_cloud(self, filename):
+        tags = list(self.facet_tag_nodes.keys())
+        lengths = np.array([len(self.facet_tag_nodes[tag]) for tag in tags], dtype=np.int64)
+        tag_nodes = np.concatenate([np.asarray(self.facet_tag_nodes[tag], dtype=np.int64) for tag in tags]) if tags else np.zeros((0,), dtype=np.int64)
+        _atomic_savez(filename, nodes=self.nodes, node_types=self.node_types, node_facets=self.node_facets, 
+                        outward_normals=self.outward_normals, local_supports=self.local_supports, 
+                        renumbering=self.renumbering, renumbering_map=self.renumbering_map, 
+                        curve_tags=np.array(list(self.facet_names.keys()), dtype=np.int64), curve_names=np.array(list(self.facet_names.values()), dtype=str),
+                        tag_ids=np.array(tags, dtype=np.int64), tag_nodes=tag_nodes, tag_lengths=lengths, support_size=self.support_size,
+                        node_curves=self.node_curves, corner_ids=self.corner_ids, corner_curves=self.corner_curves,
+                        curve_segments=self.curve_segments, segment_curves=self.segment_curves)
+
+    def load_cloud(self, filename):
+        """ Everything renumber_nodes would have produced, from a single read """
+        with np.load(filename) as bundle:
+            self.nodes = jnp.asarray(bundle["nodes"])
+            self.N = self.nodes.shape[0]
+            self.node_types = jnp.asarray(bundle["node_types"], dtype=jnp.int8)
+            self.node_facets = jnp.asarray(bundle["node_facets"], dtype=jnp.int8)
+            self.outward_normals = jnp.asarray(bundle["outward_normals"])
+            self.local_supports = jnp.asarray(bundle["local_supports"], dtype=jnp.int32)
+            self.renumbering = jnp.asarray(bundle["renumbering"])
+            self.renumbering_map = jnp.asarray(bundle["renumbering_map"])
+            self.facet_names = dict(zip(bundle["curve_tags"].tolist(), bundle["curve_names"].tolist()))
+            tag_nodes = np.split(bundle["tag_nodes"], np.cumsum(bundle["tag_lengths"])[:-1])
+            self.facet_tag_nodes = {tag:jnp.asarray(nodes) for tag, nodes in zip(bundle["tag_ids"].tolist(), tag_nodes)}
+            self.support_size = int(bundle["support_size"])
+            self.node_curves = bundle["node_curves"]            ## Original numbering, for with_facet_types
+            self.corner_ids, self.corner_curves = bundle["corner_ids"], bundle["corner_curves"]
+            self.curve_segments, self.segment_curves = bundle["curve_segments"], bundle["segment_curves"]
+
+        self.define_facet_ranges()
+        self.count_node_types()
 
-        ## Sort the entity ids by precedence
-        for c_id, f_ids in corner_membership.items():
-            sorted_f_ids = sorted(f_ids, key=lambda f_id:self.facet_precedence[self.facet_names[f_id]])
-            choosen_facet_id = sorted_f_ids[0]   ## The corner node belongs to this facet exclusively
-            choosen_facet_name = self.facet_names[choosen_facet_id]
 
-            self.node_types[c_id] = self.facet_types[choosen_facet_name]
-            self.facet_nodes[choosen_facet_name].append(c_id)
-            self.facet_tag_nodes[choosen_facet_id].append(c_id)
-
-
-        self.Ni = len({k:v for k,v in self.node_types.items() if v=="i"})
-        self.Nd = len({k:v for k,v in self.node_types.items() if v=="d"})
-        self.Nr = len({k:v for k,v in self.node_types.items() if v=="r"})
-        self.Nn = len({k:v for k,v in self.node_types.items() if v=="n"})
+    def extract_nodes_and_boundary_type(self):
+        """ Extract nodes and all boundary types """
+        self.read_geometry()
+        self.define_node_types()
 
 
+    def read_geometry(self):
+        """ Nodes, and the curves (facets) they lie on, from a bulk read of the mesh file. Independent of the facet types """
 
-    def define_outward_normals(self):
-        ## Use the Gmesh API        https://stackoverflow.com/a/59279502/8140182
+        mesh = read_msh(self.filename)
 
-        ## To get the closes internal point
-        in_coords = jnp.stack([self.nodes[node_id] for node_id in range(self.N) if self.node_types[node_id] == "i"], axis=0)
-        in_ball_tree = BallTree(in_coords, leaf_size=40, metric='euclidean')
-        # in_ball_tree = KDTree(in_coords, leaf_size=40, metric='euclidean')
+        ## Curves (facets) and their physical names
+        self.facet_names = {tag:mesh["physical_names"][phys] for tag, phys in mesh["curve_physical_tags"].items()}
 
-        for f_tag, f_nodes in self.facet_tag_nodes.items():
+        self.N = mesh["nb_nodes"]
+        self.nodes = np.zeros((self.N, 2))
+        self.node_curves = -np.ones((self.N,), dtype=np.int64)          ## The curve each node lies on, -1 for surface nodes and corners
+        corners = []
 
-            if self.facet_types[self.facet_names[f_tag]] in ["n", "r"]:      ### Only Neuman and Robin need normals !
-                assert len(f_nodes) >= 2, " Mesh not fine enough for normal computation "
+        for dim, entity_id, node_ids, coords in mesh["node_blocks"]:
+            self.nodes[node_ids] = coords[:, :2]
 
-                ## Sort the nodes in this facet
-                f_coords = jnp.stack([self.nodes[node_id] for node_id in f_nodes], axis=0)
-                f_ball_tree = BallTree(f_coords, leaf_size=40, metric='euclidean')
+            if dim==0: ## Corner points
+                corners.append(node_ids)
+            elif dim==1:  ## A curve
+                self.node_curves[node_ids] = entity_id
 
-                for node_id in f_nodes:
-                    current = self.nodes[node_id]
-                    _, neighbours = f_ball_tree.query(current[jnp.newaxis], k=2)
-                    closest_f = f_coords[neighbours[0][1]]      ## The closest point on the same facet
+        ## Candidate curves for each corner: those whose elements touch it. And the line elements (end nodes) of each curve
+        corners = np.concatenate(corners) if corners else np.zeros((0,), dtype=np.int64)
+        corner_ids, corner_curves = [np.zeros((0,), dtype=np.int64)], [np.zeros((0,), dtype=np.int64)]
+        segments, segment_curves = [np.zeros((0, 2), dtype=np.int64)], [np.zeros((0,), dtype=np.int64)]
+        for dim, entity_id, connectivity in mesh["element_blocks"]:
+            if dim == 1 and entity_id in self.facet_names:
+                c_ids = np.intersect1d(connectivity, corners)
+                corner_ids.append(c_ids)
+                corner_curves.append(np.full(c_ids.shape, entity_id))
+                segments.append(connectivity[:, :2])
+                segment_curves.append(np.full((connectivity.shape[0],), entity_id))
 
-                    _, neighbours = in_ball_tree.query(current[jnp.newaxis], k=2)
-                    closest_in = in_coords[neighbours[0][1]]    ## The closest point in the domain
+        self.corner_ids, self.corner_curves = np.concatenate(corner_ids), np.concatenate(corner_curves)
+        self.curve_segments, self.segment_curves = np.concatenate(segments), np.concatenate(segment_curves)
 
-                    invector = closest_in - current         ## An inward pointing vector
-                    tangent = closest_f - current           ## A tangent vector
 
-                    normal = jnp.array([-tangent[1], tangent[0]])
-                    if jnp.dot(normal, invector) > 0:       ## The normal is pointing inward
-                        self.outward_normals[node_id] = -normal / jnp.linalg.norm(normal)
-                    else:                                   ## The normal is pointing outward
-                        self.outward_normals[node_id] = normal / jnp.linalg.norm(normal)
+    def define_node_types(self):
+        """ Node types and facets from the facet types. Each corner belongs exclusively to its candidate curve of highest precedence """
+
+        self.node_types = np.zeros((self.N,), dtype=np.int8)            ## Coding structure: see NODE_TYPES. Surface nodes are internal
+        self.node_facets = -np.ones((self.N,), dtype=np.int8)
+        self.facet_tag_nodes = {}           ## Useful for normals
+
+        for f_id, facet_name in self.facet_names.items():
+            facet_nodes = np.flatnonzero(self.node_curves == f_id)
+            self.node_types[facet_nodes] = NODE_TYPES[self.facet_types[facet_name]]
+            self.node_facets[facet_nodes] = self.facet_precedence[facet_name]
+            self.facet_tag_nodes[f_id] = facet_nodes
+
+        precedences = np.array([self.facet_precedence[self.facet_names[f_id]] for f_id in self.corner_curves.tolist()], dtype=np.int64)
+        order = np.lexsort((precedences, self.corner_ids))
+        c_ids, first = np.unique(self.corner_ids[order], return_index=True)
+        choosen_facet_ids = self.corner_curves[order][first]
+
+        for c_id, f_id in zip(c_ids.tolist(), choosen_facet_ids.tolist()):
+            choosen_facet_name = self.facet_names[f_id]
+            self.node_types[c_id] = NODE_TYPES[self.facet_types[choosen_facet_name]]
+            self.node_facets[c_id] = self.facet_precedence[choosen_facet_name]
+            self.facet_tag_nodes[f_id] = np.append(self.facet_tag_nodes[f_id], c_id)
+
+        self.count_node_types()
+
+
+
+    def define_outward_normals(self, node_ids=None):
+        """ Outward normals of all Neumann and Robin nodes at once: bulk neighbour queries, and vectorized tangents and orientations """
+        """ The tangent at a node points to its closest node on the same curve (normals="nearest"), or is the mean direction of the 
+            curve's line elements around it (normals="elements"). Normals then point away from a close internal node. 
+            If node_ids are given, only their normals are (re)computed """
+
+        if node_ids is None:
+            self.outward_normals = np.zeros((self.N, 2))
+        nodes = np.asarray(self.nodes)
+
+        normal_tags = [f_tag for f_tag in self.facet_tag_nodes.keys() if self.facet_types[self.facet_names[f_tag]] in ["n", "r"]]     ### Only Neuman and Robin need normals !
+        if len(normal_tags) == 0:
+            return
+        for f_tag in normal_tags:
+            assert len(self.facet_tag_nodes[f_tag]) >= 2, " Mesh not fine enough for normal computation "
+
+        bd_nodes = np.concatenate([np.asarray(self.facet_tag_nodes[f_tag], dtype=np.int64) for f_tag in normal_tags])
+        bd_curves = np.concatenate([np.full((len(self.facet_tag_nodes[f_tag]),), f_tag, dtype=np.int64) for f_tag in normal_tags])
+        if node_ids is not None:
+            keep = np.isin(bd_nodes, np.asarray(node_ids))
+            bd_nodes, bd_curves = bd_nodes[keep], bd_curves[keep]
+            if len(bd_nodes) == 0:
+                return
+        current = nodes[bd_nodes]
+
+        if self.normals == "elements":
+            tangents = self.element_tangents(bd_nodes, bd_curves)
+        else:
+            tangents = np.zeros_like(current)
+            for f_tag in normal_tags:
+                on_facet = bd_curves == f_tag
+                if not np.any(on_facet):
+                    continue
+                f_coords = nodes[np.asarray(self.facet_tag_nodes[f_tag])]
+                _, neighbours = BallTree(f_coords, leaf_size=40, metric='euclidean').query(current[on_facet], k=2)
+                tangents[on_facet] = f_coords[neighbours[:, 1]] - current[on_facet]      ## Towards the closest point on the same facet
+
+        ## To get the closest internal point
+        in_coords = nodes[np.asarray(self.node_types) == NODE_TYPES["i"]]
+        _, neighbours = BallTree(in_coords, leaf_size=40, metric='euclidean').query(current, k=2)
+        invectors = in_coords[neighbours[:, 1]] - current          ## Inward pointing vectors
+
+        normals = np.stack([-tangents[:, 1], tangents[:, 0]], axis=-1)
+        normals /= np.linalg.norm(normals, axis=-1, keepdims=True)
+        inward = np.sum(normals*invectors, axis=-1) > 0             ## These normals are pointing inward
+        self.outward_normals[bd_nodes] = np.where(inward[:, np.newaxis], -normals, normals)
+
+
+    def element_tangents(self, bd_nodes, bd_curves):
+        """ Sum of the unit directions of the line elements touching each node, on the curve that node belongs to """
+        nodes = np.asarray(self.nodes)
+        segments, segment_curves = self.curve_segments, self.segment_curves
+
+        directions = nodes[segments[:, 1]] - nodes[segments[:, 0]]
+        directions /= np.linalg.norm(directions, axis=-1, keepdims=True)
+
+        ## Match (node, curve) pairs of the segment ends against those of the boundary nodes
+        nb_tags = max(int(bd_curves.max()), int(segment_curves.max(initial=0))) + 1
+        codes = bd_nodes*nb_tags + bd_curves
+        order = np.argsort(codes)
+        sorted_codes = codes[order]
+
+        tangents = np.zeros((len(bd_nodes), 2))
+        for end in range(2):
+            seg_codes = segments[:, end]*nb_tags + segment_curves
+            pos = np.minimum(np.searchsorted(sorted_codes, seg_codes), len(codes)-1)
+            match = sorted_codes[pos] == seg_codes
+            np.add.at(tangents, order[pos[match]], directions[match])
+
+        return tangents
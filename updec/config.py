@@ -11,5 +11,7 @@ if not PREALLOCATE:
     os.environ['XLA_PYTHON_CLIENT_PREALLOCATE'] = "false"       ## Preallocate 90% of memory
 
 
+CACHE_DIR = os.environ.get("UPDEC_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "updec"))     ## Where GmshCloud(cache=True) stores built clouds
+
 FLOAT64 = True
 jax.config.update("jax_enable_x64", FLOAT64)   ## Use double precision by default
@@ -0,0 +1,208 @@
+import jax
+import jax.numpy as jnp
+from jax.tree_util import tree_map
+
+import math
+
+from updec.cloud import Cloud
+from updec.operators import PDEProblem, DifferentialOperators, CloudTransfer, nodal_laplacian
+
+
+CHECKPOINT_SCHEDULES = [None, "step", "binomial"]
+
+
+def _masked_step(step, length):
+    """ Step that leaves the state untouched (and outputs zeros) past the requested number of steps """
+    """ A select rather than lax.cond: cond residuals would keep the step's constants for every step """
+    def masked(carry, ix):
+        i, x = ix
+        new_carry, y = step(carry, x)
+        keep = i < length
+        new_carry = tree_map(lambda new, old: jnp.where(keep, new, old), new_carry, carry)
+        return new_carry, tree_map(lambda a: jnp.where(keep, a, jnp.zeros_like(a)), y)
+    return masked
+
+
+def checkpoint_levels(nb_steps:int, branching:int=4):
+    """ Sizes of the nested scans for recursive checkpointing: about log(nb_steps)/log(branching) levels, whose product 
+        is the smallest that covers nb_steps """
+    depth = max(1, math.ceil(math.log(nb_steps) / math.log(branching) - 1e-9))
+
+    sizes, remaining = [], nb_steps
+    for level in range(depth, 0, -1):
+        size = math.ceil(remaining**(1./level) - 1e-9)
+        sizes.append(size)
+        remaining = math.ceil(remaining / size)
+    return sizes
+
+
+def _nested_scan(step, carry, xs, sizes:list):
+    """ Scans over prod(sizes) steps, as nested scans whose outer bodies are rematerialized """
+    if len(sizes) == 1:
+        return jax.lax.scan(step, carry, xs)
+
+    split = lambda a: a.reshape((sizes[0], -1) + a.shape[1:])
+    merge = lambda a: a.reshape((-1,) + a.shape[2:])
+
+    @jax.checkpoint
+    def outer_step(carry, xs_chunk):
+        return _nested_scan(step, carry, xs_chunk, sizes[1:])
+
+    carry, ys = jax.lax.scan(outer_step, carry, tree_map(split, xs))
+    return carry, tree_map(merge, ys)
+
+
+def rollout(step:callable, init_state, nb_steps:int, xs=None, checkpoint="binomial", branching:int=4):
+    """ Runs nb_steps of step(state, x) -> (state, output) with jax.lax.scan, and returns the final state and the stacked outputs """
+    """ checkpoint: the memory/recomputation trade-off for reverse mode differentiation through the rollout
+            None: plain scan, every intermediate of every step is kept
+            "step": each step is rematerialized, only the states are kept (memory linear in nb_steps)
+            "binomial": recursive checkpointing with nested scans of size branching. Only about branching*log(nb_steps)
+                states are kept, for about log(nb_steps) extra forward passes
+        xs: per-step inputs (a pytree of arrays with leading dimension nb_steps), or None
+    """
+    assert checkpoint in CHECKPOINT_SCHEDULES, "unknown checkpoint schedule "+str(checkpoint)
+
+    if checkpoint is None:
+        return jax.lax.scan(step, init_state, xs, length=nb_steps)
+    if checkpoint == "step":
+        return jax.lax.scan(jax.checkpoint(step), init_state, xs, length=nb_steps)
+
+    sizes = checkpoint_levels(nb_steps, branching)
+    total = math.prod(sizes)                   ## Steps past nb_steps are masked out
+
+    pad = lambda a: jnp.concatenate((a, jnp.zeros((total-nb_steps,)+a.shape[1:], a.dtype)), axis=0)
+    ixs = (jnp.arange(total), tree_map(pad, xs))
+
+    if total == nb_steps:
+        return _nested_scan(lambda carry, ix: step(carry, ix[1]), init_state, ixs, sizes)
+
+    state, ys = _nested_scan(_masked_step(step, nb_steps), init_state, ixs, sizes)
+    return state, tree_map(lambda a: a[:nb_steps], ys)
+
+
+
+def _laplacian_operator(x, center=None, rbf=None, monomial=None, fields=None):
+    return nodal_laplacian(x, center, rbf, monomial)
+
+def _chorin_momentum_args(u, v, p):
+    return [u, v], [[u, p], [v, p]]
+
+
+class ProjectionSolver(object):
+    """ Chorin's projection scheme for incompressible flows, with every time step compiled into one lax.scan body """
+    """ diff_operator: the momentum operator, shared by u and v
+        rhs_operators: [rhs_operator_u, rhs_operator_v]
+        boundary_conditions: [bc_u, bc_v, bc_phi]
+        momentum_args: (u, v, p) -> (diff_args, [rhs_args_u, rhs_args_v]), all on cloud_vel. Defaults to ([u, v], [[u, p], [v, p]])
+        The pressure correction solves Lap(phi) = rho*div(U*)/dt on cloud_phi, with a matrix factorized once. Then
+            p = beta*p + phi, and U = U* - grad(phi)*dt/rho
+    """
+
+    def __init__(self, 
+                diff_operator:callable,
+                rhs_operators:list,
+                cloud_vel:Cloud,
+                cloud_phi:Cloud,
+                boundary_conditions:list,
+                rbf:callable,
+                max_degree:int,
+                dt:float,
+                rho:float = 1.,
+                beta:float = 0.,
+                momentum_args:callable = None,
+                method = "global"):
+
+        self.cloud_vel = cloud_vel
+        self.cloud_phi = cloud_phi
+        self.bc_u, self.bc_v, self.bc_phi = boundary_conditions
+        self.dt, self.rho, self.beta = dt, rho, beta
+        self.momentum_args = momentum_args if momentum_args is not None else _chorin_momentum_args
+
+        self.problem_vel = PDEProblem(diff_operator, list(rhs_operators), cloud_vel, rbf, max_degree, method=method)
+        self.problem_phi = PDEProblem(_laplacian_operator, None, cloud_phi, rbf, max_degree, method=method)
+        self.ops_phi = DifferentialOperators(cloud_phi, rbf, max_degree, method)
+        self.to_phi = CloudTransfer(cloud_vel, cloud_phi)
+        self.to_vel = CloudTransfer(cloud_phi, cloud_vel)
+
+        self._run = jax.jit(self.run_steps, static_argnums=(1, 2, 3))
+
+    def momentum(self, u, v, p):
+        """ Intermediate velocity U* on cloud_vel: u and v are solved together, against the same operator """
+        diff_args, rhs_args = self.momentum_args(u, v, p)
+        usol, vsol = self.problem_vel.solve([self.bc_u, self.bc_v], diff_args=diff_args, rhs_args=rhs_args)
+        return jnp.stack([usol.vals, vsol.vals], axis=-1)
+
+    def pressure_correction(self, Ustar, scale):
+        """ phi on cloud_phi, solution of Lap(phi) = scale*div(U*), and its gradient back on cloud_vel """
+        Ustar_ = self.to_phi(Ustar)
+        phi_ = self.problem_phi.solve(self.bc_phi, rhs=scale*self.ops_phi.divergence(Ustar_)).vals
+        gradphi = self.to_vel(self.ops_phi.gradient(phi_))
+        return phi_, gradphi
+
+    def initial_state(self, u, v, p_):
+        return (u, v, p_)
+
+    def step(self, state):
+        """ One time step, from (u, v, p_) to (u, v, p_). The pressure p_ lives on cloud_phi """
+        u, v, p_ = state
+
+        Ustar = self.momentum(u, v, self.to_vel(p_))
+        phi_, gradphi = self.pressure_correction(Ustar, self.rho/self.dt)
+
+        U = Ustar - gradphi*self.dt/self.rho
+        return (U[:, 0], U[:, 1], self.beta*p_ + phi_)
+
+    def run_steps(self, state, nb_saves, save_every, checkpoint):
+        def saved_steps(state, _):
+            state = jax.lax.fori_loop(0, save_every, lambda i, state: self.step(state), state)
+            u, v, p_ = state[:3]
+            return state, (u, v, jnp.sqrt(u**2 + v**2), p_)
+
+        return rollout(saved_steps, state, nb_saves, checkpoint=checkpoint)
+
+    def run(self, u, v, p_, nb_steps:int, save_every:int=1, checkpoint=None):
+        """ Runs nb_steps as one compiled scan. Returns the final (u, v, p_) and the stacked (u, v, |U|, p_) of every 
+            save_every-th step, each of shape (nb_steps//save_every, N). checkpoint: see rollout """
+        assert nb_steps % save_every == 0, "the number of steps must be a multiple of save_every"
+
+        state, saved = self._run(self.initial_state(u, v, p_), nb_steps//save_every, save_every, checkpoint)
+        return state[:3], saved
+
+
+class BDF2ProjectionSolver(ProjectionSolver):
+    """ Gear's (BDF2) projection scheme, with nb_refinements fixed point iterations per time step """
+    """ momentum_args: (u, v, p, u_rhs, v_rhs) -> (diff_args, [rhs_args_u, rhs_args_v]), with u_rhs = 4u_now - u_prev.
+            Defaults to ([u, v], [[u_rhs, p], [v_rhs, p]])
+        The pressure correction solves Lap(phi) = div(U*), then p = p + 3*phi/(2dt) and U = U* - grad(phi)
+    """
+
+    def __init__(self, *args, nb_refinements:int=3, momentum_args:callable=None, **kwargs):
+        momentum_args = momentum_args if momentum_args is not None else (lambda u, v, p, u_rhs, v_rhs: ([u, v], [[u_rhs, p], [v_rhs, p]]))
+        super().__init__(*args, momentum_args=momentum_args, **kwargs)
+        self.nb_refinements = nb_refinements
+
+    def momentum(self, u, v, p, u_rhs, v_rhs):
+        diff_args, rhs_args = self.momentum_args(u, v, p, u_rhs, v_rhs)
+        usol, vsol = self.problem_vel.solve([self.bc_u, self.bc_v], diff_args=diff_args, rhs_args=rhs_args)
+        return jnp.stack([usol.vals, vsol.vals], axis=-1)
+
+    def initial_state(self, u, v, p_):
+        return (u, v, p_, u, v, p_)             ## Now, then previous step
+
+    def step(self, state):
+        u_now, v_now, p_now_, u_prev, v_prev, p_prev_ = state
+        u_rhs, v_rhs = 4*u_now - u_prev, 4*v_now - v_prev
+
+        def refinement(k, guess):
+            u, v, p_ = guess
+            Ustar = self.momentum(u, v, self.to_vel(p_), u_rhs, v_rhs)
+            phi_, gradphi = self.pressure_correction(Ustar, 1.)
+
+            U = Ustar - gradphi
+            return (U[:, 0], U[:, 1], p_ + 3*phi_/(2*self.dt))
+
+        guess = (2*u_now - u_prev, 2*v_now - v_prev, 3*p_now_/2 - p_prev_/2)        ## Extrapolations from the last two steps
+        u_next, v_next, p_next_ = jax.lax.fori_loop(0, self.nb_refinements, refinement, guess)
+
+        return (u_next, v_next, p_next_, u_now, v_now, p_now_)
@@ -0,0 +1,63 @@
+import jax.numpy as jnp
+
+from collections import namedtuple
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+CloudMetrics = namedtuple("CloudMetrics", ["fill_distance", "separation_distance", "mesh_ratio", "stencil_quality"])
+
+
+def neighbour_distances(nodes, nb_neighbours:int=1):
+    """ Distances to, and indices of, the nb_neighbours closest other nodes of each node: one bulk k-NN query """
+    coords = np.asarray(nodes)
+    distances, neighbours = cKDTree(coords, leafsize=40).query(coords, k=nb_neighbours+1, workers=-1)
+    return distances[:, 1:], neighbours[:, 1:]          ## The first neighbour is the node itself
+
+
+def separation_distances(cloud):
+    """ Per node separation distance: half the distance to its closest neighbour """
+    distances, _ = neighbour_distances(cloud.nodes, 1)
+    return jnp.asarray(distances[:, 0] / 2.)
+
+
+def fill_distances(cloud, nb_neighbours:int=8, neighbours=None):
+    """ Per node fill distance estimate: the largest distance to the cloud from the midpoints between the node and its
+        nb_neighbours closest neighbours. Exact on regular grids, and a lower bound otherwise """
+    coords = np.asarray(cloud.nodes)
+    if neighbours is None:
+        _, neighbours = neighbour_distances(coords, nb_neighbours)
+
+    midpoints = (coords[:, np.newaxis, :] + coords[neighbours]) / 2.
+    gaps, _ = cKDTree(coords, leafsize=40).query(midpoints.reshape((-1, coords.shape[-1])), k=1, workers=-1)
+    return jnp.asarray(gaps.reshape(neighbours.shape).max(axis=-1))
+
+
+def stencil_qualities(cloud):
+    """ Per node stencil balance, from its local support: 1 - |mean(x_j - x_i)| / mean(|x_j - x_i|) """
+    """ 1 for a symmetric stencil, 0 when all neighbours lie in the same direction (as expected at boundaries) """
+    coords = np.asarray(cloud.nodes)
+    supports = np.asarray(cloud.local_supports)
+    valid = supports < coords.shape[0]                  ## Radius supports are padded with N
+
+    offsets = coords[np.minimum(supports, coords.shape[0]-1)] - coords[:, np.newaxis, :]
+    offsets = np.where(valid[..., np.newaxis], offsets, 0.)
+    counts = np.maximum(valid.sum(axis=-1), 1)
+
+    mean_offset = np.linalg.norm(offsets.sum(axis=1), axis=-1) / counts
+    mean_distance = np.linalg.norm(offsets, axis=-1).sum(axis=-1) / counts
+    return jnp.asarray(1. - mean_offset / np.maximum(mean_distance, np.finfo(coords.dtype).tiny))
+
+
+def cloud_metrics(cloud, nb_neighbours:int=8):
+    """ Fill distance h, separation distance q, mesh ratio h/q and stencil quality of every node, as arrays in the cloud's numbering """
+    """ Reduce them for global figures, e.g. the fill distance of the cloud is about metrics.fill_distance.max() """
+    distances, neighbours = neighbour_distances(cloud.nodes, nb_neighbours)
+
+    separation = jnp.asarray(distances[:, 0] / 2.)
+    fill = fill_distances(cloud, neighbours=neighbours)
+
+    return CloudMetrics(fill_distance=fill,
+                        separation_distance=separation,
+                        mesh_ratio=fill/separation,
+                        stencil_quality=stencil_qualities(cloud))
@@ -3,12 +3,13 @@ import jax.numpy as jnp
 from jax.tree_util import Partial, tree_map
 
 from functools import cache, lru_cache, partial
+import numpy as np
 
 # from updec.config import RBF, MAX_DEGREE, DIM
-import updec.config as UPDEC
-from updec.utils import make_nodal_rbf, make_monomial, compute_nb_monomials, SteadySol, polyharmonic, gaussian, make_all_monomials
+from updec.utils import make_nodal_rbf, make_rbf_gradient, make_rbf_laplacian, make_monomial, compute_nb_monomials, SteadySol, polyharmonic, gaussian, make_all_monomials, monomial_basis, monomial_basis_gradient, monomial_basis_laplacian
 from updec.cloud import Cloud
-from updec.assembly import assemble_A, assemble_invert_A, assemble_B, assemble_q, new_compute_coefficients
+from updec.solvers import KRYLOV_SOLVERS, HOST_PRECONDITIONERS, krylov_solve, make_preconditioner, direct_solve, adjoint_solve, sparse_factors
+from updec.assembly import assemble_A, assemble_Phi, assemble_P, solve_A, assemble_B, assemble_q, new_compute_coefficients, compute_coefficients_batched, assemble_sparse_B, sparse_solve, LinearOperatorCache, assemble_diff_matrices, operator_key, cloud_factors
 
 
 @Partial(jax.jit, static_argnums=[2,3])
@@ -28,15 +29,17 @@ def nodal_value(x, center=None, rbf=None, monomial=None):
         return monomial(x)
 
 
-@cache
 def core_gradient_rbf(rbf):
-    return jax.grad(rbf)
+    return make_rbf_gradient(rbf)
 
 ## LRU cache this
 # @lru_cache(maxsize=32)
 @cache
 def core_gradient_mon(monomial):
     # monomial = Partial(make_monomial, id=monomial)
+    if getattr(monomial, "func", None) is make_monomial:        ## Closed form for our own monomials
+        id = monomial.keywords["id"]
+        return lambda x: monomial_basis_gradient(x, id+1)[id]
     return jax.grad(monomial)
 
 ## Does calling this all the time cause problems ?
@@ -63,27 +66,29 @@ def nodal_gradient(x, center=None, rbf=None, monomial=None):
 
 ## LRU cache this
 # @lru_cache(maxsize=32)
-@cache
 def core_laplacian_rbf(rbf):
-    return jax.jacfwd(jax.grad(rbf))
+    return make_rbf_laplacian(rbf)
 
 ## LRU cache this
 # @lru_cache(maxsize=32)
 @cache
 def core_laplacian_mon(monomial):
     # monomial = Partial(make_monomial, id=monomial)
-    return jax.jacfwd(jax.grad(monomial))
+    if getattr(monomial, "func", None) is make_monomial:        ## Closed form for our own monomials
+        id = monomial.keywords["id"]
+        return lambda x: monomial_basis_laplacian(x, id+1)[id]
+    return lambda x: jnp.trace(jax.jacfwd(jax.grad(monomial))(x))
 
 def nodal_laplacian(x, center=None, rbf=None, monomial=None):     ## TODO Jitt through this efficiently
     """ Computes the lapalcian of the RBF and polynomial functions """
     if center != None:
         # nodal_rbf = Partial(make_nodal_rbf, rbf=rbf)
         # nodal_rbf = rbf
-        return jnp.trace(core_laplacian_rbf(rbf)(x, center))      ## TODO: try reverse mode
+        return core_laplacian_rbf(rbf)(x, center)                 ## Closed-form if the rbf is registered
     elif monomial != None:
         # monomial = Partial(make_monomial, id=monomial)
         # monomial = monomial
-        return jnp.trace(core_laplacian_mon(monomial)(x))
+        return core_laplacian_mon(monomial)(x)
 
 
 
@@ -92,14 +97,10 @@ def compute_coefficients(field:jnp.DeviceArray, cloud:Cloud, rbf:callable, max_d
     N = cloud.N
     M = compute_nb_monomials(max_degree, 2)     ## Carefull with the problem dimension: 2
 
-    ##TODO solve the linear system quicker (store and cache LU decomp) 
     # nodal_rbf = Partial(make_nodal_rbf, rbf=rbf)
 
     rhs = jnp.concatenate((field, jnp.zeros((M))))
-    # A = assemble_A(cloud, nodal_rbf, M)
-    inv_A = assemble_invert_A(cloud, rbf, M)
-    # coefficients = jnp.linalg.solve(A, rhs)
-    coefficients = inv_A@rhs
+    coefficients = solve_A(cloud, rbf, M, rhs)          ## Reuses the cached LU factors of A
 
     lambdas = coefficients[:N]
     gammas = coefficients[N:]
@@ -108,25 +109,23 @@ def compute_coefficients(field:jnp.DeviceArray, cloud:Cloud, rbf:callable, max_d
 
 
 
+_nodal_value_rbf_vec = jax.vmap(nodal_value, in_axes=(None, 0, None, None), out_axes=0)
+
 def value(x, field, centers, rbf=None):
-    """ Computes the gradient of field quantity s at position x """
-    ## Find coefficients for s on the cloud
+    """ Computes the value of field quantity s at position x """
 
-    ## Now, compute the value of the field
     N = centers.shape[0]
     lambdas, gammas = field[:N], field[N:]
 
-    final_val = jnp.array([0.])
-    for j in range(lambdas.shape[0]):                                           ## TODO: Awwfull !! Vectorize this please !
-        rbf_val = nodal_value(x, center=centers[j], rbf=rbf)       ## TODO To account for non-differentiable case
-        final_val = final_val.at[:].add(lambdas[j] * rbf_val)
+    vals_rbf = _nodal_value_rbf_vec(x, centers, rbf, None)                  ## One batched kernel row, no loop over centers
+    rbf_val = jnp.dot(lambdas, vals_rbf)
 
-    for j in range(gammas.shape[0]):                                                   ### TODO: Use VMAP to vectorise this too !!
-        monomial = Partial(make_monomial, id=j)
-        polynomial_val = nodal_value(x, monomial=monomial)
-        final_val = final_val.at[:].add(gammas[j] * polynomial_val)
+    polynomial_val = jnp.dot(gammas, monomial_basis(x, gammas.shape[0]))
 
-    return final_val[0]
+    return rbf_val + polynomial_val
+
+
+value_vec = jax.vmap(value, in_axes=(0, None, None, None), out_axes=0)
 
 
 
@@ -152,12 +151,10 @@ def gradient(x, field, centers, rbf=None):
 
     grads_rbf = _nodal_gradient_rbf_vec(x, centers, rbf, None)              ## TODO remove all NaNs
     lambdas = jnp.stack([lambdas, lambdas], axis=-1)                        ## TODO Why is Jax unable to broadcast below ?
-    final_grad = jnp.sum(jnp.nan_to_num(lambdas*grads_rbf), axis=0)
+    final_grad = jnp.sum(lambdas*grads_rbf, axis=0)
 
-    all_monomials = make_all_monomials(gammas.shape[0])
-    for j in range(gammas.shape[0]):                                                   ### TODO: Use VMAP to vectorise this too !!
-        polynomial_grad = nodal_gradient(x, monomial=all_monomials[j])
-        final_grad = final_grad.at[:].add(gammas[j] * polynomial_grad)
+    polynomial_grad = jnp.dot(gammas, monomial_basis_gradient(x, gammas.shape[0]))
+    final_grad = final_grad.at[:].add(polynomial_grad)
 
     return final_grad
 
@@ -194,34 +191,231 @@ def laplacian(x, field, centers, rbf=None):
     #     final_lap = final_lap.at[:].add(lambdas[j] * rbf_lap)
 
     laps_rbf = _nodal_laplacian_rbf_vec(x, centers, rbf, None)              ## TODO remove all NaNs
-    rbf_lap = jnp.sum(jnp.nan_to_num(lambdas*laps_rbf), axis=0)
+    rbf_lap = jnp.sum(lambdas*laps_rbf, axis=0)
 
 
-    all_monomials = make_all_monomials(gammas.shape[0])
-    mon_lap = jnp.array([0.])
-    for j in range(gammas.shape[0]):
-        # monomial = Partial(make_monomial, id=j)
-        poly_lap = nodal_laplacian(x, monomial=all_monomials[j])
-        mon_lap = mon_lap.at[:].add(gammas[j] * poly_lap)
+    mon_lap = jnp.dot(gammas, monomial_basis_laplacian(x, gammas.shape[0]))
 
-    return rbf_lap + mon_lap[0]
+    return rbf_lap + mon_lap
 
 
-def interpolate_field(field, cloud1, cloud2):
-    """ Interpolates field from cloud1 to cloud2 """
+class DifferentialOperators(object):
+    """ Value, gradient, divergence and Laplacian at the nodes of a cloud, applied as (sparse) mat-vecs """
+    """ Fields are nodal values (N,), or global RBF coefficients (N+M,) which are evaluated at the nodes first
+        method: "rbffd" (default) for sparse BCOO matrices over the local supports, O(N k) per application. "global" 
+            gives the derivatives of the global interpolant, consistent with global collocation solves: every node 
+            depends on every center, so these matrices are dense (N, N)
+    """
+
+    def __init__(self, cloud:Cloud, rbf:callable, max_degree:int, method="rbffd"):
+        self.cloud = cloud
+        self.rbf = rbf
+        self.nb_monomials = compute_nb_monomials(max_degree, cloud.dim)
+        self.method = method
+        self.matrices = assemble_diff_matrices(cloud, rbf, self.nb_monomials, method)
+        self.evaluation = None              ## [Phi P], only built if coefficients are ever given
+
+    def nodal_values(self, field):
+        """ Nodal values of a field given either as nodal values or as coefficients """
+        N = self.cloud.N
+        if field.shape[0] == N:
+            return field
+        if self.evaluation is None:
+            self.evaluation = jnp.concatenate((assemble_Phi(self.cloud, self.rbf), assemble_P(self.cloud, self.nb_monomials)), axis=-1)
+        return self.evaluation @ field
+
+    def value(self, field):
+        return self.nodal_values(field)
+
+    def gradient(self, field):
+        """ Nodal gradients, shape (N, 2) """
+        field = self.nodal_values(field)
+        return jnp.stack((self.matrices.Dx @ field, self.matrices.Dy @ field), axis=-1)
+
+    def divergence(self, field):
+        """ Nodal divergence of a vector field of shape (N, 2) or (N+M, 2) """
+        return self.matrices.Dx @ self.nodal_values(field[..., 0]) + self.matrices.Dy @ self.nodal_values(field[..., 1])
+
+    def laplacian(self, field):
+        return self.matrices.Lap @ self.nodal_values(field)
+
+
+class CloudTransfer(object):
+    """ Transfers nodal fields between two clouds with the same nodes in different numberings, with one gather """
 
-    assert cloud1.N == cloud2.N, "the two clouds do not contain the same number of nodes"   ## TODO: Make sure only the renumbering differs
+    def __init__(self, cloud1:Cloud, cloud2:Cloud):
+        assert cloud1.N == cloud2.N, "the two clouds do not contain the same number of nodes"   ## TODO: Make sure only the renumbering differs
+        self.indices = jnp.asarray(cloud1.permutation_to(cloud2), dtype=jnp.int32)
 
-    sorted_map1 = sorted(cloud1.renumbering_map.items(), key=lambda x:x[0])
-    indexer1 = jnp.array(list(dict(sorted_map1).values()))
-    field_orig = field[indexer1]
+    def __call__(self, field, axis=0):
+        """ field has its nodes along axis: (N,), (N, k), or a time series (T, N) with axis=1 """
+        return jnp.take(field, self.indices, axis=axis, mode="clip")          ## Indices are in bounds: no fill masks
 
-    indexer2 = jnp.array(list(cloud2.renumbering_map.keys()))
 
-    return field_orig[indexer2]            ## TODO Think of a way to do this
+@lru_cache(maxsize=32)
+def cloud_transfer(cloud1:Cloud, cloud2:Cloud):
+    """ The CloudTransfer from cloud1 to cloud2, built once per pair of clouds """
+    return CloudTransfer(cloud1, cloud2)
+
+
+def interpolate_field(field, cloud1, cloud2, axis=0):
+    """ Interpolates field from cloud1 to cloud2 """
+    return cloud_transfer(cloud1, cloud2)(field, axis)
+
+
+@cache
+def jit_operator(operator:callable, static_argnums:tuple):
+    """ One jitted handle per operator: repeated problems and solves never re-wrap (nor retrace) the same function """
+    return jax.jit(operator, static_argnums=static_argnums)
+
+
+class PDEProblem(object):
+    """ A linear PDE whose operators are jitted once, and whose (factorized) matrix B is reused across solves """
+    """ method: "global" for dense global collocation, "rbffd" for sparse RBF-FD over the local supports.
+            B is only rebuilt for new diff_args arrays (e.g. not at all for a pressure Poisson problem). The arrays are 
+            compared by identity: their contents are never hashed
+        rhs_operator: one operator, or a list of them (one per right hand side) for multi-RHS solves
+        solver: "direct" (LU, or sparse direct for RBF-FD), or a Krylov method "gmres" or "bicgstab"
+        preconditioner: for Krylov methods, None, "jacobi", "block_jacobi", "multigrid", or a jax Partial x -> inv(B)x
+        warm_start: for Krylov methods, start from the previous solution
+        adjoint: for direct solvers, differentiate the solve by one transposed solve with the cached factors, instead
+            of through the factorization. Gradients with respect to diff_args go through the cotangent of B, -L X^T, 
+            and the assembly of B, which is not differentiated otherwise
+        factors: the cloud_factors for method, for clouds traced in jitted code. Looked up in the caches if not given
+    """
+
+    def __init__(self, 
+                diff_operator:callable,
+                rhs_operator:callable,
+                cloud:Cloud, 
+                rbf:callable,
+                max_degree:int,
+                method = "global",
+                cache_size = 1,
+                solver = "direct",
+                preconditioner = None,
+                warm_start = True,
+                solver_args = None,
+                adjoint = False,
+                factors = None):
+
+        self.diff_operator = jit_operator(diff_operator, (2,3)) if diff_operator is not None else None
+        jit_rhs = lambda op: jit_operator(op, (2,)) if callable(op) else op
+        self.rhs_operator = [jit_rhs(op) for op in rhs_operator] if isinstance(rhs_operator, (list, tuple)) else jit_rhs(rhs_operator)
+        self.cloud = cloud
+        self.rbf = rbf
+        self.max_degree = max_degree
+        self.nb_monomials = compute_nb_monomials(max_degree, cloud.dim)
+        self.method = method
+        self.factors = factors
+        self.operators = LinearOperatorCache(maxsize=cache_size, static_key=(self.diff_operator, cloud.static_key(), rbf, self.nb_monomials, method))
+
+        assert solver == "direct" or solver in KRYLOV_SOLVERS, "unknown solver "+str(solver)
+        self.solver = solver
+        self.preconditioner = preconditioner
+        self.warm_start = warm_start
+        self.solver_args = solver_args if solver_args is not None else {}
+        self.previous_solution = None
+
+        assert not adjoint or solver == "direct", "the adjoint mode requires a direct solver"
+        self.adjoint = adjoint
+
+    def assemble(self, diff_args=None):
+        """ Builds B, and prepares it for the solver """
+        if self.method == "rbffd":
+            B1 = assemble_sparse_B(self.diff_operator, self.cloud, self.rbf, self.nb_monomials, diff_args)
+        else:
+            B1 = assemble_B(self.diff_operator, self.cloud, self.rbf, self.nb_monomials, diff_args, self.factors)
+        return self.prepare(B1)
+
+    def prepare(self, B1):
+        """ LU factors for direct solves (host sparse factors for RBF-FD), or the operator and its preconditioner for Krylov solves """
+        """ The prepared operator is what the operator cache keeps: factorizations happen once per B """
+        if self.solver != "direct":
+            return B1, make_preconditioner(self.preconditioner, B1, self.cloud, self.rbf, self.max_degree)
+        factors = sparse_factors(B1) if self.method == "rbffd" else jax.scipy.linalg.lu_factor(B1)
+        return (B1, factors) if self.adjoint else factors           ## The adjoint also needs B, for its cotangent
+
+    def linear_solve(self, B1, Q):
+        """ Solves for all the columns of Q with the prepared operator """
+        if self.solver == "direct":         ## Two triangular solves with the cached factors, for all columns
+            if self.adjoint:
+                B, factors = B1
+                return adjoint_solve(direct_solve, jax.lax.stop_gradient(factors), B, Q)
+            return direct_solve(B1, Q)
+
+        B1, M = B1
+        X0 = self.previous_solution if self.warm_start else None
+        if X0 is not None and X0.shape != Q.shape:
+            X0 = None
+
+        solve = lambda q, x0: krylov_solve(B1, q, self.solver, M=M, x0=x0, **self.solver_args)
+        X = jax.vmap(solve, in_axes=(0, None if X0 is None else 0))(Q.T, None if X0 is None else X0.T).T        ## All columns at once
+
+        if not isinstance(X, jax.core.Tracer):          ## Never keep tracers around
+            self.previous_solution = X
+        return X
+
+    def diff_matrices(self):
+        """ The cached identity, d/dx, d/dy and Laplacian matrices of this problem's cloud, to be combined into B """
+        return assemble_diff_matrices(self.cloud, self.rbf, self.nb_monomials, self.method)
+
+    def solve(self, boundary_conditions:dict, diff_args=None, rhs_args=None, B=None, rhs=None):
+        """ Solves the PDE for new boundary conditions and fields. Reuses B if diff_args are the same arrays """
+        """ B: an explicitly assembled operator (e.g. from combine_diff_matrices), used instead of diff_operator
+            rhs: precomputed nodal values of the right hand side (e.g. from DifferentialOperators), used instead of rhs_operator
+            Multi-RHS: if boundary_conditions is a list of dicts, rhs_args (and rhs) are lists with one entry per
+                right hand side. All of them are solved against the same B, and a list of solutions is returned
+        """
+
+        batched = isinstance(boundary_conditions, (list, tuple))
+        if not batched:
+            boundary_conditions, rhs_args, rhs = [boundary_conditions], [rhs_args], [rhs]
+        nb_rhs = len(boundary_conditions)
+
+        rhs_args = [None]*nb_rhs if rhs_args is None else rhs_args
+        rhs = [None]*nb_rhs if rhs is None else rhs
+        rhs_operators = self.rhs_operator if isinstance(self.rhs_operator, list) else [self.rhs_operator]*nb_rhs
+        assert len(rhs_args) == len(rhs) == len(rhs_operators) == nb_rhs, "one entry per right hand side is needed"
+
+        Q = jnp.stack([assemble_q(op if vals is None else vals, bcs, self.cloud, self.rbf, self.nb_monomials, args, self.method, self.factors)
+                        for op, bcs, args, vals in zip(rhs_operators, boundary_conditions, rhs_args, rhs)], axis=-1)
+
+        if B is not None:
+            B1 = self.prepare(B)
+        elif operator_key(diff_args) is not None:
+            with jax.ensure_compile_time_eval():        ## Concrete operators are built (and cached) once, even under jax.jit
+                B1 = self.operators.get(diff_args, self.assemble)
+        else:
+            B1 = self.operators.get(diff_args, self.assemble)
+
+        sol_vals = self.linear_solve(B1, Q)
+
+        if self.method == "rbffd":
+            sols = [SteadySol(sol_vals[:, k], None) for k in range(nb_rhs)]
+        else:
+            sol_coeffs = compute_coefficients_batched(sol_vals, self.cloud, self.rbf, self.nb_monomials, self.factors)
+            sols = [SteadySol(sol_vals[:, k], sol_coeffs[:, k]) for k in range(nb_rhs)]
+
+        return sols if batched else sols[0]
+
+
+def _pde_solve(diff_operator, rhs_operator, cloud, rbf, max_degree, method, solver, preconditioner, adjoint, 
+                bc_functions, bc_values, diff_args, rhs_args, factors):
+    """ Pure solve: the operators and the callable boundary conditions are static. All arrays are traced, including the 
+        node arrays of the cloud (a pytree) and its factors: new clouds with the same metadata reuse the compiled solve """
+    boundary_conditions = [{f_id:(func if func is not None else vals[f_id]) for f_id, func in funcs} 
+                            for funcs, vals in zip(bc_functions, bc_values)]
+
+    problem = PDEProblem(diff_operator, list(rhs_operator) if isinstance(rhs_operator, tuple) else rhs_operator, 
+                        cloud, rbf, max_degree, method=method, cache_size=0, solver=solver, preconditioner=preconditioner, 
+                        adjoint=adjoint, factors=factors)
+
+    return problem.solve(boundary_conditions, diff_args, rhs_args)
+
+_pde_solve_jit = jax.jit(_pde_solve, static_argnums=(0,1,3,4,5,6,7,8,9))
 
 
-## Devise different LU, LDL decomposition strategies make functions here
 def pde_solver( diff_operator:callable,
                 rhs_operator:callable,
                 cloud:Cloud, 
@@ -229,29 +423,44 @@ def pde_solver( diff_operator:callable,
                 rbf:callable,
                 max_degree:int,
                 diff_args = None,
-                rhs_args = None):
+                rhs_args = None,
+                method = "global",
+                solver = "direct",
+                preconditioner = None,
+                adjoint = False):
     """ Solve a PDE """
+    """ method: "global" for dense global collocation, "rbffd" for sparse RBF-FD over the local supports.
+            The RBF-FD solution does not come with global RBF coefficients (coeffs=None)
+        solver: "direct", "gmres" or "bicgstab", with an optional preconditioner (see PDEProblem)
+        adjoint: for differentiable physics: the backward pass is one transposed solve with the same factors, and the 
+            assembly of B is only differentiated for gradients with respect to diff_args (see PDEProblem)
+        For repeated solves with the same operator, build a PDEProblem once instead
+        Several right hand sides can be solved with the same operator: pass lists of rhs operators (or one shared 
+            operator), boundary conditions, and rhs_args. A list of solutions is then returned
+        The whole solve is compiled once per (operators, cloud metadata, callable boundary conditions) and can be traced inside
+            jax.jit, vmap and scan: reuse the same function handles across calls. Only the "block_jacobi" and "multigrid" 
+            preconditioners need a concrete operator and run outside jit
+    """
 
-    # nodal_operator = jax.jit(nodal_operator, static_argnums=2)
-    diff_operator = jax.jit(diff_operator, static_argnums=[2,3])
-    rhs_operator = jax.jit(rhs_operator, static_argnums=2)
-
-    ### For rememmering purposes
-    UPDEC.BRF = rbf
-    UPDEC.MAX_DEGREE = max_degree
-    UPDEC.DIM = cloud.dim
-
+    batched = isinstance(boundary_conditions, (list, tuple))
+    all_bcs = boundary_conditions if batched else [boundary_conditions]
 
-    # 
-    # TODO Here
-    nb_monomials = compute_nb_monomials(max_degree, cloud.dim)
+    ## Callable boundary conditions are static, nodal values (arrays or scalars) are traced
+    bc_functions = tuple(tuple((f_id, bc if callable(bc) else None) for f_id, bc in bcs.items()) for bcs in all_bcs)
+    bc_values = [{f_id:bc for f_id, bc in bcs.items() if not callable(bc)} for bcs in all_bcs]
+    if batched:
+        rhs_args = [None]*len(all_bcs) if rhs_args is None else rhs_args
+    else:
+        rhs_args = [rhs_args]
+    rhs_operator = tuple(rhs_operator) if isinstance(rhs_operator, list) else rhs_operator
 
-    B1 = assemble_B(diff_operator, cloud, rbf, nb_monomials, diff_args)
-    rhs = assemble_q(rhs_operator, boundary_conditions, cloud, rbf, nb_monomials, rhs_args)
+    ## The cloud's factors are cached against its geometry, which traced clouds do not have: they are looked up here
+    factors = None
+    if getattr(cloud, "geometry_key", None) is not None and (method != "rbffd" or any(args is not None for args in rhs_args)):
+        factors = cloud_factors(cloud, rbf, compute_nb_monomials(max_degree, cloud.dim), method)
 
-    sol_vals = jnp.linalg.solve(B1, rhs)
-    # sol_coeffs = compute_coefficients(sol_vals, cloud, rbf, max_degree)
-    sol_coeffs = new_compute_coefficients(sol_vals, cloud, rbf, nb_monomials)
+    solve = _pde_solve if preconditioner in HOST_PRECONDITIONERS else _pde_solve_jit
+    sols = solve(diff_operator, rhs_operator, cloud, rbf, max_degree, method, solver, preconditioner, adjoint, 
+                bc_functions, bc_values, diff_args, rhs_args, factors)
 
-    # return sol_vals, jnp.concatenate(sol_coeffs)         ## TODO: return an object like solve_ivp
-    return SteadySol(sol_vals, sol_coeffs)
+    return sols if batched else sols[0]
@@ -0,0 +1,424 @@
+import jax
+import jax.numpy as jnp
+from jax.tree_util import Partial
+from jax.experimental import sparse
+
+from functools import partial
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from scipy.spatial import cKDTree
+
+from updec.utils import polyharmonic, monomial_basis, compute_nb_monomials
+from updec.cloud import Cloud
+from updec.assembly import assemble_local_A
+
+
+KRYLOV_SOLVERS = {"gmres": jax.scipy.sparse.linalg.gmres,
+                  "bicgstab": jax.scipy.sparse.linalg.bicgstab}
+
+
+@Partial(jax.jit, static_argnames=["method", "maxiter", "restart"])
+def _krylov_solve(B, rhs, x0, M, tol, atol, method, maxiter, restart):
+    kwargs = {"restart": restart} if (method == "gmres" and restart is not None) else {}
+    x, _ = KRYLOV_SOLVERS[method](lambda x: B @ x, rhs, x0=x0, tol=tol, atol=atol, M=M, maxiter=maxiter, **kwargs)
+    return x
+
+def krylov_solve(B, rhs:jnp.ndarray, method="gmres", M=None, x0=None, tol=1e-10, atol=0., maxiter=None, restart=None):
+    """ Solves B x = rhs with a Krylov method from jax.scipy.sparse.linalg. Only mat-vecs with B (dense or BCOO) are needed """
+    """ M: preconditioner (a jax Partial approximating inv(B)), x0: initial guess (e.g. the previous time step) """
+    if x0 is None:          ## Starting from zero makes BiCGStab break down when q only lives on Dirichlet rows
+        x0 = M(rhs) if M is not None else rhs
+
+    return _krylov_solve(B, rhs, x0, M, tol, atol, method=method, maxiter=maxiter, restart=restart)
+
+
+### Differentiable direct solves ###
+
+@jax.tree_util.register_pytree_node_class
+class SparseLU(object):
+    """ Host LU factors (scipy's SuperLU) of a concrete sparse (BCOO) B, computed once. Every later solve, for all the
+        columns of its right hand side at once, is two triangular solves """
+    def __init__(self, B:sparse.BCOO, lu=None):
+        self.B = B
+        self.lu = spla.splu(_to_scipy(B).tocsc()) if lu is None else lu
+
+    def tree_flatten(self):
+        return (self.B,), self.lu
+
+    @classmethod
+    def tree_unflatten(cls, lu, children):
+        return cls(children[0], lu)
+
+
+def sparse_factors(B:sparse.BCOO):
+    """ SparseLU of a concrete B. A traced B is returned as is, and factorized on the fly, once per solve """
+    if isinstance(B.data, jax.core.Tracer) or isinstance(B.indices, jax.core.Tracer):
+        return B
+    return SparseLU(B)
+
+def _host_lu_solve(lu, trans, Q):
+    return lu.solve(np.asarray(Q), trans="T" if trans else "N").astype(Q.dtype)
+
+def _host_factor_solve(shape, trans, data, indices, Q):
+    B = _coo_to_scipy(np.asarray(data), np.asarray(indices), shape).tocsc()
+    return _host_lu_solve(spla.splu(B), trans, Q)
+
+def _sparse_lu_solve(lu, Q, trans):
+    return jax.pure_callback(partial(_host_lu_solve, lu, trans), jax.ShapeDtypeStruct(Q.shape, Q.dtype), Q, vmap_method="sequential")
+
+def _sparse_factor_solve(B, Q, trans):
+    return jax.pure_callback(partial(_host_factor_solve, B.shape, trans), jax.ShapeDtypeStruct(Q.shape, Q.dtype), 
+                            B.data, B.indices, Q, vmap_method="sequential")
+
+
+def direct_solve(operator, Q:jnp.ndarray, trans:bool=False):
+    """ Solves B X = Q (or B^T X = Q) with LU factors of a dense B, or a sparse B (SparseLU factors, or a BCOO matrix) """
+    """ Sparse solves factorize at most once for all the columns of Q, and are differentiable with respect to Q and B """
+    if isinstance(operator, SparseLU):
+        B, solve = operator.B, partial(_sparse_lu_solve, operator.lu)
+    elif isinstance(operator, sparse.BCOO):
+        B, solve = operator, partial(_sparse_factor_solve, operator)
+    else:
+        return jax.scipy.linalg.lu_solve(operator, Q, trans=int(trans))
+
+    matvec = (lambda x: B.T @ x) if trans else (lambda x: B @ x)
+    return jax.lax.custom_linear_solve(matvec, Q, solve=lambda _, b: solve(b, trans), transpose_solve=lambda _, b: solve(b, not trans))
+
+
+def _zero_cotangent(x):
+    if jnp.issubdtype(x.dtype, jnp.inexact):
+        return jnp.zeros_like(x)
+    return np.zeros(x.shape, dtype=jax.dtypes.float0)           ## Integer leaves (pivots, sparse indices)
+
+def _outer_cotangent(B, L, X):
+    """ Cotangent of B X = Q with respect to B: -L X^T, restricted to the sparsity pattern of a BCOO B """
+    if isinstance(B, sparse.BCOO):
+        rows, cols = B.indices[:, 0], B.indices[:, 1]
+        data = -jnp.sum(L[rows] * jnp.take(X, cols, axis=0, mode="fill", fill_value=0.), axis=-1)    ## Padding (N) gets 0
+        return jax.tree_util.tree_unflatten(jax.tree_util.tree_structure(B), [data, _zero_cotangent(B.indices)])
+    return -L @ X.T
+
+@partial(jax.custom_vjp, nondiff_argnums=(0,))
+def adjoint_solve(solve:callable, operator, B, Q:jnp.ndarray):
+    """ Solves B X = Q as solve(operator, Q), with operator the factors of B (dense, or BCOO) """
+    """ Reverse mode costs one transposed solve L = solve(operator, G, True) with the same factors. The cotangent of Q 
+        is L, and that of B is -L X^T: the assembly of B is only differentiated if what it depends on is """
+    return solve(operator, Q)
+
+def _adjoint_solve_fwd(solve, operator, B, Q):
+    X = solve(operator, Q)
+    return X, (operator, B, X)
+
+def _adjoint_solve_bwd(solve, residuals, G):
+    operator, B, X = residuals
+    L = solve(operator, G, True)
+    return jax.tree_util.tree_map(_zero_cotangent, operator), _outer_cotangent(B, L, X), L
+
+adjoint_solve.defvjp(_adjoint_solve_fwd, _adjoint_solve_bwd)
+
+
+def extract_diagonal(B):
+    """ Diagonal of a dense or sparse (BCOO) matrix """
+    if isinstance(B, sparse.BCOO):
+        rows, cols = B.indices[:, 0], B.indices[:, 1]
+        return jnp.zeros((B.shape[0],)).at[rows].add(jnp.where(rows==cols, B.data, 0.))
+    return jnp.diag(B)
+
+
+def _apply_jacobi(inv_diag, x):
+    return inv_diag * x
+
+def jacobi_preconditioner(B, cloud:Cloud=None):
+    """ Point Jacobi preconditioner: x -> x / diag(B) """
+    diag = extract_diagonal(B)
+    inv_diag = jnp.where(diag != 0., 1./jnp.where(diag != 0., diag, 1.), 1.)
+    return Partial(_apply_jacobi, inv_diag)
+
+
+def extract_blocks(B, blocks:jnp.ndarray):
+    """ The dense local blocks B[S_i, S_i] for the padded (nb_blocks, n) index sets S_i. Padding (N) gives identity rows """
+    N = B.shape[0]
+    n = blocks.shape[1]
+    mask = blocks < N
+
+    if isinstance(B, sparse.BCOO):          ## Rows must be sorted, as built by assemble_sparse_B
+        rows, cols, data = B.indices[:, 0], B.indices[:, 1], B.data
+        counts = jnp.bincount(rows, length=N)
+        width = int(np.max(np.asarray(counts)))
+        indptr = jnp.concatenate((jnp.zeros((1,), dtype=counts.dtype), jnp.cumsum(counts)))
+        pos = jnp.arange(rows.shape[0]) - indptr[rows]
+
+        ## Padded row storage, with an extra empty row for the padding index N
+        cols_p = jnp.full((N+1, width), N, dtype=cols.dtype).at[rows, pos].set(cols)
+        vals_p = jnp.zeros((N+1, width)).at[rows, pos].set(data)
+
+        def entry(s, t):
+            j = jnp.minimum(jnp.searchsorted(cols_p[s], t), width-1)
+            return jnp.where(cols_p[s, j]==t, vals_p[s, j], 0.)
+        local = jax.vmap(jax.vmap(jax.vmap(entry, in_axes=(None, 0)), in_axes=(0, None)))(blocks, blocks)
+
+    else:
+        B_p = jnp.zeros((N+1, N+1)).at[:N, :N].set(B)
+        local = B_p[blocks[:, :, jnp.newaxis], blocks[:, jnp.newaxis, :]]
+
+    return jnp.where(mask[:, :, jnp.newaxis] & mask[:, jnp.newaxis, :], local, jnp.eye(n))
+
+
+def _incoming_min(values, sources, targets, starts, N):
+    """ Smallest of the values of the sources linked to each target (sorted by target, starting at starts), N if none """
+    smallest = np.full((N,), N)
+    if len(starts) > 0:
+        smallest[targets[starts]] = np.minimum.reduceat(values[sources], starts)
+    return smallest
+
+def _join_neighbours(aggregate_of, supports, capacity:int):
+    """ Free nodes join the aggregate of their closest taken neighbour that has room. Returns the new aggregate_of """
+    aggregate_of = aggregate_of.copy()
+    counts = np.bincount(aggregate_of[aggregate_of >= 0], minlength=aggregate_of.max()+1)
+
+    for k in range(supports.shape[1]):          ## Closest neighbours first
+        free = np.flatnonzero(aggregate_of < 0)
+        target = np.append(aggregate_of, -1)[supports[free, k]]
+        free, target = free[target >= 0], target[target >= 0]
+
+        order = np.argsort(target, kind="stable")
+        free, target = free[order], target[order]
+        starts = np.flatnonzero(np.diff(target, prepend=-1))
+        queue = np.arange(len(target)) - np.repeat(starts, np.diff(np.append(starts, len(target))))      ## Position in line
+        joins = counts[target] + queue < capacity
+
+        aggregate_of[free[joins]] = target[joins]
+        counts += np.bincount(target[joins], minlength=len(counts))
+
+    return aggregate_of
+
+def aggregate_supports(supports:np.ndarray, aggregate_size:int=8, seed:int=0):
+    """ Greedy non-overlapping aggregation, in rounds of array operations: each round, the free nodes that come first 
+        (in a fixed random order) among all the free nodes they are linked to by the supports, either way, become seeds 
+        and take their free neighbours. Lone seeds then join a neighbouring aggregate that has room. About five rounds, 
+        whatever the size of the cloud """
+    """ Returns the (nb_aggregates, aggregate_size+1) node ids, seeds first, padded with N, and the aggregate id of each node """
+    N = supports.shape[0]
+    supports = np.asarray(supports)[:, :aggregate_size]
+    rank = np.random.default_rng(seed).permutation(N)
+
+    ## Links i -> j for j in the support of i, also sorted by j to find the smallest incoming values
+    sources = np.repeat(np.arange(N), supports.shape[1])[supports.reshape(-1) < N]
+    targets = supports.reshape(-1)[supports.reshape(-1) < N]
+    order = np.argsort(targets, kind="stable")
+    sources, targets = sources[order], targets[order]
+    starts = np.flatnonzero(np.diff(targets, prepend=-1))
+    supports_p = np.where(supports < N, supports, N)
+
+    aggregate_of = -np.ones((N,), dtype=np.int32)
+    is_seed = np.zeros((N,), dtype=bool)
+    nb_aggregates = 0
+    while nb_aggregates == 0 or np.any(aggregate_of < 0):
+        free_rank = np.append(np.where(aggregate_of < 0, rank, N), N)          ## Taken nodes (and padding) never block a seed
+        first_linked = np.minimum(np.min(free_rank[supports_p], axis=1), _incoming_min(free_rank, sources, targets, starts, N))
+        seeds = np.flatnonzero((free_rank[:N] < N) & (free_rank[:N] < first_linked))
+
+        seed_rank = np.full((N+1,), N)             ## No two seeds are linked: the claimed neighbours are never seeds
+        seed_rank[seeds] = rank[seeds]
+        claimed_by = np.minimum(_incoming_min(seed_rank, sources, targets, starts, N), seed_rank[:N])
+
+        new_ids = np.full((N+1,), -1, dtype=np.int32)
+        new_ids[rank[seeds]] = nb_aggregates + np.arange(len(seeds), dtype=np.int32)
+        aggregate_of = np.where(aggregate_of < 0, new_ids[claimed_by], aggregate_of)
+        is_seed[seeds] = True
+        nb_aggregates += len(seeds)
+
+    ## Lone seeds join a neighbouring aggregate that has room, and the aggregates are renumbered
+    alone = np.bincount(aggregate_of, minlength=nb_aggregates)[aggregate_of] == 1
+    joined = _join_neighbours(np.where(alone, -1, aggregate_of), supports_p, aggregate_size+1)
+    is_seed &= ~(alone & (joined >= 0))         ## Lone seeds that found no room stay alone
+    _, aggregate_of = np.unique(np.where(joined >= 0, joined, aggregate_of), return_inverse=True)
+    aggregate_of = aggregate_of.astype(np.int32)
+    nb_aggregates = int(aggregate_of.max()) + 1
+
+    order = np.lexsort((~is_seed, aggregate_of))           ## By aggregate, seed first
+    counts = np.bincount(aggregate_of, minlength=nb_aggregates)
+    positions = np.arange(N) - np.repeat(np.cumsum(counts) - counts, counts)
+    aggregates = np.full((nb_aggregates, aggregate_size+1), N, dtype=np.int32)
+    aggregates[aggregate_of[order], positions] = order
+
+    return aggregates, aggregate_of
+
+
+def aggregate_local_supports(cloud:Cloud, aggregate_size:int=8):
+    """ Aggregates of the cloud's local supports, see aggregate_supports """
+    aggregates, aggregate_of = aggregate_supports(np.asarray(cloud.local_supports), aggregate_size)
+    return jnp.asarray(aggregates), jnp.asarray(aggregate_of)
+
+
+def _apply_block_jacobi(blocks, inv_blocks, x):
+    x_p = jnp.concatenate((x, jnp.zeros((1,), dtype=x.dtype)))
+    y = jnp.einsum("bij,bj->bi", inv_blocks, x_p[blocks])
+    return jnp.zeros_like(x).at[blocks].set(y, mode="drop")
+
+def block_jacobi_from_supports(B, supports:np.ndarray, aggregate_size:int=8, l1=False):
+    """ Block-Jacobi over non-overlapping aggregates of the supports (up to aggregate_size+1 nodes each) """
+    """ l1: adds the off-block absolute row sums to the block diagonals (signed like them), for a robust smoother """
+    blocks, _ = aggregate_supports(supports, aggregate_size)
+    blocks = jnp.asarray(blocks)
+    local = extract_blocks(B, blocks)
+
+    if l1:
+        N = B.shape[0]
+        abs_B = sparse.BCOO((jnp.abs(B.data), B.indices), shape=B.shape) if isinstance(B, sparse.BCOO) else jnp.abs(B)
+        row_sums = jnp.concatenate((abs_B @ jnp.ones((N,)), jnp.zeros((1,))))[blocks]
+        off_block = row_sums - jnp.sum(jnp.abs(local), axis=-1) * (blocks < N)
+        diag = jnp.diagonal(local, axis1=1, axis2=2)
+        local = local + jax.vmap(jnp.diag)(jnp.sign(diag) * off_block)
+
+    inv_blocks = jnp.linalg.inv(local)
+    return Partial(_apply_block_jacobi, blocks, inv_blocks)
+
+def block_jacobi_preconditioner(B, cloud:Cloud, aggregate_size:int=8):
+    """ Block-Jacobi over non-overlapping aggregates of the cloud's local supports """
+    return block_jacobi_from_supports(B, np.asarray(cloud.local_supports), aggregate_size)
+
+
+
+### Multigrid over nested point clouds ###
+
+def _coo_to_scipy(data, indices, shape):
+    keep = np.all(indices < np.asarray(shape), axis=-1)         ## Out of bound entries are BCOO padding
+    return sp.csr_matrix((data[keep], (indices[keep, 0], indices[keep, 1])), shape=shape)
+
+def _to_scipy(B):
+    if isinstance(B, sparse.BCOO):
+        return _coo_to_scipy(np.asarray(B.data), np.asarray(B.indices), B.shape)
+    return sp.csr_matrix(np.asarray(B))
+
+def _to_bcoo(B):
+    B = B.tocoo()
+    B.sum_duplicates()          ## Also sorts the entries row by row
+    indices = np.stack((B.row, B.col), axis=-1).astype(np.int32)
+    return sparse.BCOO((jnp.asarray(B.data), jnp.asarray(indices)), shape=B.shape, indices_sorted=True, unique_indices=True)
+
+
+def rbf_interpolation_matrix(fine_nodes:np.ndarray, coarse_nodes:np.ndarray, rbf:callable, nb_monomials:int, nb_neighbours:int):
+    """ Sparse (N_fine, N_coarse) RBF interpolation from the coarse to the fine nodes, over local coarse stencils """
+    nb_neighbours = min(nb_neighbours, coarse_nodes.shape[0])
+    _, stencils = cKDTree(coarse_nodes).query(fine_nodes, k=nb_neighbours, workers=-1)
+    stencils = stencils.reshape((fine_nodes.shape[0], nb_neighbours))
+
+    coarse_nodes = jnp.asarray(coarse_nodes)
+    mask = jnp.ones((nb_neighbours,), dtype=bool)
+
+    def local_weights(x, stencil):
+        x_s = coarse_nodes[stencil]
+        rhs = jnp.concatenate((jax.vmap(rbf, in_axes=(None, 0))(x, x_s), monomial_basis(x, nb_monomials)))
+        return jnp.linalg.solve(assemble_local_A(rbf, nb_monomials, x_s, mask), rhs)[:nb_neighbours]
+
+    weights = np.asarray(jax.jit(jax.vmap(local_weights))(jnp.asarray(fine_nodes), jnp.asarray(stencils)))
+    rows = np.repeat(np.arange(fine_nodes.shape[0]), nb_neighbours)
+
+    return sp.csr_matrix((weights.reshape(-1), (rows, stencils.reshape(-1))), shape=(fine_nodes.shape[0], coarse_nodes.shape[0]))
+
+
+def _smooth(B, S, omega, nb_smooth, r, x):
+    return jax.lax.fori_loop(0, nb_smooth, lambda _, x: x + omega * S(r - B @ x), x)
+
+def _vcycle(levels, coarse_factors, omega, nb_smooth, r):
+    """ One V-cycle approximating inv(B) r, with damped block-Jacobi smoothing and a direct solve at the bottom """
+    if len(levels) == 0:
+        return jax.scipy.linalg.lu_solve(coarse_factors, r)
+
+    (B, S, P, R), coarser_levels = levels[0], levels[1:]
+    x = _smooth(B, S, omega, nb_smooth, r, jnp.zeros_like(r))
+    x = x + P @ _vcycle(coarser_levels, coarse_factors, omega, nb_smooth, R @ (r - B @ x))
+    return _smooth(B, S, omega, nb_smooth, r, x)
+
+
+def _multigrid_cycle(inv_diag, levels, coarse_factors, B_ib, B_bi, boundary_factors, omega, nb_smooth, r):
+    """ Block elimination of the boundary nodes (direct solves), and a V-cycle for the internal Schur complement """
+    Ni = inv_diag.shape[0]
+    r_i, r_b = r[:Ni], r[Ni:]
+    x_b = jax.scipy.linalg.lu_solve(boundary_factors, r_b)
+    x_i = _vcycle(levels, coarse_factors, omega, nb_smooth, inv_diag * (r_i - B_ib @ x_b))
+    x_b = jax.scipy.linalg.lu_solve(boundary_factors, r_b - B_bi @ x_i)
+    return jnp.concatenate((x_i, x_b))
+
+
+def _eliminate_boundary(B_bb_lu, B_bi, chunk_size:int=256):
+    """ Sparse inv(B_bb) B_bi. Only the columns of the internal nodes coupled to the boundary are solved for, a chunk of 
+        columns at a time: the dense work space is (Nb, chunk_size), never (Nb, Ni) """
+    B_bi = B_bi.tocsc()
+    coupled = np.flatnonzero(np.diff(B_bi.indptr))
+    chunks = [sp.csc_matrix(B_bb_lu.solve(B_bi[:, coupled[k:k+chunk_size]].toarray())) for k in range(0, len(coupled), chunk_size)]
+    X = sp.hstack(chunks).tocoo() if chunks else sp.coo_matrix((B_bi.shape[0], 0))
+    return sp.csr_matrix((X.data, (X.row, coupled[X.col])), shape=B_bi.shape)
+
+
+def multigrid_preconditioner(B, cloud:Cloud, rbf:callable=polyharmonic, max_degree:int=1, 
+                            coarsest_size:int=200, aggregate_size:int=8, nb_neighbours:int=None, nb_smooth:int=2, omega:float=0.7):
+    """ Multigrid V-cycle over nested point clouds. Coarse nodes are the seeds of the aggregated local supports, """
+    """ transfers are local RBF interpolations between levels (P, and R = P^T), and coarse operators are R S P.
+        The (few) boundary nodes are eliminated first: S = B_ii - B_ib inv(B_bb) B_bi is the internal Schur
+        complement, only modified near the boundary. It is scaled by its diagonal before coarsening
+    """
+    """ Iterations are NOT flat under refinement. Measured on a Laplacian (GMRES to 1e-8, 900 to 14400 nodes): 21 to 24
+        with Dirichlet boundaries only (degrees 1 to 3), but 25 to 60 with two Neumann sides. Block Jacobi needs 140 to 
+        410 (Dirichlet, up to 6400 nodes). See tests/multigrid_test.py
+    """
+    nb_monomials = compute_nb_monomials(max_degree, cloud.dim)
+    nb_neighbours = max(10, 3*nb_monomials) if nb_neighbours is None else nb_neighbours    ## Fewer can be degenerate near boundaries
+    Ni = cloud.Ni
+
+    B_full = _to_scipy(B)
+    B_ii, B_ib = B_full[:Ni, :Ni], B_full[:Ni, Ni:]
+    B_bi, B_bb = B_full[Ni:, :Ni], B_full[Ni:, Ni:]
+
+    B_bb_lu = spla.splu(B_bb.tocsc())
+    B_l = (B_ii - B_ib @ _eliminate_boundary(B_bb_lu, B_bi)).tocsr()
+
+    nodes = np.asarray(cloud.sorted_nodes)[:Ni]
+    supports = np.asarray(cloud.local_supports)[:Ni]
+    supports = np.where(supports < Ni, supports, Ni)        ## Boundary neighbours become padding
+
+    diag = B_l.diagonal()
+    inv_diag = np.where(diag != 0., 1./np.where(diag != 0., diag, 1.), 1.)
+    B_l = (sp.diags(inv_diag) @ B_l).tocsr()
+
+    levels = []
+    while B_l.shape[0] > coarsest_size:
+        aggregates, _ = aggregate_supports(supports, aggregate_size)
+        coarse_ids = aggregates[:, 0]                   ## Seeds of the aggregates
+        coarse_nodes = nodes[coarse_ids]
+
+        P = rbf_interpolation_matrix(nodes, coarse_nodes, rbf, nb_monomials, nb_neighbours)
+        R = P.T.tocsr()
+
+        B_bcoo = _to_bcoo(B_l)
+        smoother = block_jacobi_from_supports(B_bcoo, supports, aggregate_size, l1=True)
+        levels.append((B_bcoo, smoother, _to_bcoo(P), _to_bcoo(R)))
+
+        B_l = (R @ B_l @ P).tocsr()
+        nodes = coarse_nodes
+        k = min(supports.shape[1], nodes.shape[0]-1)
+        supports = cKDTree(nodes).query(nodes, k=k+1, workers=-1)[1][:, 1:].astype(np.int32)
+
+    coarse_factors = jax.scipy.linalg.lu_factor(jnp.asarray(B_l.toarray()))
+    boundary_factors = jax.scipy.linalg.lu_factor(jnp.asarray(B_bb.toarray()))
+
+    return Partial(_multigrid_cycle, jnp.asarray(inv_diag), levels, coarse_factors, _to_bcoo(B_ib), _to_bcoo(B_bi), boundary_factors, omega, nb_smooth)
+
+
+PRECONDITIONERS = {"jacobi": jacobi_preconditioner,
+                   "block_jacobi": block_jacobi_preconditioner,
+                   "multigrid": multigrid_preconditioner}
+
+HOST_PRECONDITIONERS = ["block_jacobi", "multigrid"]      ## Their setup needs a concrete operator (not traceable)
+
+
+def make_preconditioner(name, B, cloud:Cloud, rbf:callable=polyharmonic, max_degree:int=1):
+    """ Builds a preconditioner by name (None, "jacobi", "block_jacobi" or "multigrid"). A user Partial x -> inv(B)x is returned as is """
+    """ rbf and max_degree should be the problem's: the multigrid transfers interpolate with them """
+    if name is None or callable(name):
+        return name
+    if name == "multigrid":
+        return multigrid_preconditioner(B, cloud, rbf=rbf, max_degree=max_degree)
+    return PRECONDITIONERS[name](B, cloud)
@@ -0,0 +1,71 @@
+# %%
+import jax
+import jax.numpy as jnp
+from updec import *
+"Adjoint gradients (one transposed solve) match autodiff through the solve, for boundary values, right hand sides and diff_args"
+
+RBF, MAX_DEGREE = polyharmonic, 2
+facet_types = {"South":"n", "West":"d", "North":"d", "East":"d"}
+cloud = SquareCloud(Nx=14, Ny=14, facet_types=facet_types, support_size=20, noise_key=jax.random.PRNGKey(3))
+
+def diff_operator(x, center=None, rbf=None, monomial=None, fields=None):
+    return nodal_laplacian(x, center, rbf, monomial)
+
+def rhs_operator(x, centers=None, rbf=None, fields=None):
+    return value(x, fields[:, 0], centers, rbf)
+
+zero = jax.jit(lambda x: 0.)
+north = cloud.facet_nodes["North"]
+north_vals = jnp.sin(jnp.pi*cloud.sorted_nodes[north, 0])
+source = jnp.cos(cloud.sorted_nodes[:, 0]) * cloud.sorted_nodes[:, 1]
+weights = jax.random.normal(jax.random.PRNGKey(5), (cloud.N,))
+
+
+# %%
+for method in ["global", "rbffd"]:
+
+    def loss(north_vals, source, adjoint):
+        bcs = {"South":zero, "West":zero, "North":north_vals, "East":zero}
+        sol = pde_solver(diff_operator, rhs_operator, cloud, bcs, RBF, MAX_DEGREE, rhs_args=[source], method=method, adjoint=adjoint)
+        return jnp.sum(weights * sol.vals**2)
+
+    grads = jax.grad(loss, argnums=(0, 1))(north_vals, source, False)
+    adjoint_grads = jax.grad(loss, argnums=(0, 1))(north_vals, source, True)
+
+    for g, g_adj, name in zip(grads, adjoint_grads, ["boundary values", "rhs_args"]):
+        error = float(jnp.abs(g - g_adj).max() / jnp.abs(g).max())
+        print(method, name, "relative error:", error)
+        assert error < 1e-8
+
+    ## And a finite difference check of the adjoint, along a random direction
+    direction = jax.random.normal(jax.random.PRNGKey(6), north_vals.shape)
+    h = 1e-4
+    fd = (loss(north_vals + h*direction, source, True) - loss(north_vals - h*direction, source, True)) / (2*h)
+    assert jnp.allclose(jnp.dot(adjoint_grads[0], direction), fd, rtol=1e-5)
+
+
+# %%
+## With respect to diff_args too: the operator depends on a reaction coefficient field
+def reaction_operator(x, center=None, rbf=None, monomial=None, fields=None):
+    return nodal_laplacian(x, center, rbf, monomial) - fields[0]*nodal_value(x, center, rbf, monomial)
+
+reaction = 1. + cloud.sorted_nodes[:, 0]**2
+
+for method in ["global", "rbffd"]:
+
+    def loss(reaction, north_vals, adjoint):
+        bcs = {"South":zero, "West":zero, "North":north_vals, "East":zero}
+        sol = pde_solver(reaction_operator, rhs_operator, cloud, bcs, RBF, MAX_DEGREE, diff_args=[reaction], rhs_args=[source], 
+                        method=method, adjoint=adjoint)
+        return jnp.sum(weights * sol.vals**2)
+
+    grads = jax.grad(loss, argnums=(0, 1))(reaction, north_vals, False)
+    adjoint_grads = jax.grad(loss, argnums=(0, 1))(reaction, north_vals, True)
+    assert jnp.abs(grads[0]).max() > 0.
+
+    for g, g_adj, name in zip(grads, adjoint_grads, ["diff_args", "boundary values"]):
+        error = float(jnp.abs(g - g_adj).max() / jnp.abs(g).max())
+        print(method, name, "relative error:", error)
+        assert error < 1e-8
+
+print("Adjoint gradients OK")
@@ -0,0 +1,28 @@
+# %%
+import jax
+import jax.numpy as jnp
+import numpy as np
+from updec import *
+from updec.utils import distance
+"Cloud metrics are exact on a regular grid, and the average spacing is the mean over all node pairs"
+
+facet_types = {"South":"d", "West":"d", "North":"d", "East":"d"}
+
+
+# %%
+cloud = SquareCloud(Nx=11, Ny=11, facet_types=facet_types, support_size=9)
+metrics = cloud_metrics(cloud)
+h = 0.1
+
+assert np.allclose(metrics.fill_distance.max(), h*np.sqrt(2)/2, atol=1e-12)
+assert np.allclose(metrics.separation_distance, h/2, atol=1e-12)
+assert np.allclose(metrics.mesh_ratio.max(), np.sqrt(2), atol=1e-12)
+assert np.allclose(fill_distances(cloud), metrics.fill_distance)
+assert np.allclose(separation_distances(cloud), metrics.separation_distance)
+
+## Same value as a loop over all pairs, each node paired with itself included
+cloud = SquareCloud(Nx=8, Ny=7, facet_types=facet_types, support_size=10, noise_key=jax.random.PRNGKey(0))
+pairs = [distance(cloud.nodes[i], cloud.nodes[j]) for i in range(cloud.N) for j in range(i, cloud.N)]
+assert np.allclose(cloud.average_spacing(), jnp.mean(jnp.array(pairs)), rtol=1e-14)
+
+print("Cloud metrics OK")
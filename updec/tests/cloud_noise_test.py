@@ -0,0 +1,39 @@
+# %%
+import jax
+import jax.numpy as jnp
+import numpy as np
+from updec import *
+"A noise key gives the same square cloud nodes as the node by node draw of earlier versions"
+
+facet_types = {"South":"n", "West":"d", "North":"d", "East":"d"}
+
+def loop_nodes(cloud, noise_key):
+    """ Reference: one key per node in the original numbering, split from noise_key, used by internal nodes only """
+    keys = jax.random.split(noise_key, cloud.N)
+    x, y = jnp.linspace(0, 1., cloud.Nx), jnp.linspace(0, 1., cloud.Ny)
+    delta_noise = min((x[1]-x[0], y[1]-y[0])) / 2.
+    nodes = np.zeros((cloud.N, 2))
+    for i in range(cloud.Nx):
+        for j in range(cloud.Ny):
+            global_id = int(cloud.global_indices[i,j])
+            original_id = int(cloud.renumbering[global_id])
+            node = jnp.array([x[i], y[j]])
+            if cloud.node_types[global_id] not in [NODE_TYPES["d"], NODE_TYPES["n"]]:
+                node = node + jax.random.uniform(keys[original_id], (2,), minval=-delta_noise, maxval=delta_noise)
+            nodes[global_id] = node
+    return nodes
+
+
+# %%
+for noise_key in [jax.random.PRNGKey(42), jax.random.key(42)]:
+    cloud = SquareCloud(Nx=6, Ny=5, facet_types=facet_types, support_size=10, noise_key=noise_key)
+    nodes = np.asarray(cloud.sorted_nodes)
+
+    ## Values from the node by node implementation
+    assert np.allclose(nodes[:3], [[0.21616606190563836, 0.2992132203646255],
+                                   [0.14795226290015362, 0.5822424387832605],
+                                   [0.2710247683957807, 0.6822795378672085]], rtol=0, atol=1e-15)
+
+    assert np.allclose(nodes, loop_nodes(cloud, noise_key), rtol=0, atol=1e-15)
+
+print("Cloud noise OK")
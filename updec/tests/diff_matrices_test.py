@@ -0,0 +1,41 @@
+# %%
+import jax
+import jax.numpy as jnp
+from updec import *
+from updec.assembly import assemble_diff_matrices, combine_diff_matrices
+"Combining the differentiation matrices gives the matrix B assembled from the operator"
+
+DT, NU = 0.1, 0.5
+RBF, MAX_DEGREE = polyharmonic, 2
+M = compute_nb_monomials(MAX_DEGREE, 2)
+
+def diff_operator(x, center=None, rbf=None, monomial=None, fields=None):
+    U = jnp.array([fields[0], fields[1]])
+    val = nodal_value(x, center, rbf, monomial)
+    grad = nodal_gradient(x, center, rbf, monomial)
+    lap = nodal_laplacian(x, center, rbf, monomial)
+    return val + DT*jnp.dot(U, grad) - DT*NU*lap
+
+facet_types = {"South":"n", "West":"d", "North":"d", "East":"n"}
+
+
+# %%
+for method, support in [("global", {"support_size":20}), ("rbffd", {"support_size":20}), ("rbffd", {"support_radius":0.25})]:
+    cloud = SquareCloud(Nx=14, Ny=14, facet_types=facet_types, noise_key=jax.random.PRNGKey(4), **support)
+    u, v = jnp.sin(cloud.sorted_nodes[:, 1]), jnp.cos(cloud.sorted_nodes[:, 0])
+
+    assemble = assemble_sparse_B if method == "rbffd" else assemble_B
+    B_ref = assemble(diff_operator, cloud, RBF, M, [u, v])
+
+    matrices = assemble_diff_matrices(cloud, RBF, M, method)
+    B = combine_diff_matrices(matrices, cloud, 1., DT*u, DT*v, -DT*NU)
+
+    if method == "rbffd":           ## Same sparsity pattern, entry by entry
+        assert jnp.array_equal(B.indices, B_ref.indices)
+        B, B_ref = B.todense(), B_ref.todense()
+
+    error = float(jnp.abs(B - B_ref).max() / jnp.abs(B_ref).max())
+    print(method, support, "relative error:", error)
+    assert error < 1e-8
+
+print("Combined differentiation matrices OK")
@@ -0,0 +1,34 @@
+# %%
+import jax
+import numpy as np
+from updec import *
+"A cloud derived with other facet types is the cloud built from scratch with them"
+
+facet_types_vel = {"North":"d", "South":"d", "East":"n", "West":"n"}
+facet_types_phi = {"South":"n", "West":"d", "North":"n", "East":"d"}
+
+def compare(cloud, reference):
+    for attribute in ["nodes", "node_types", "node_facets", "outward_normals", "local_supports", "renumbering", "renumbering_map"]:
+        assert np.allclose(np.asarray(getattr(cloud, attribute)), np.asarray(getattr(reference, attribute)), atol=1e-12), attribute
+    assert cloud.facet_offsets == reference.facet_offsets
+    assert (cloud.Ni, cloud.Nd, cloud.Nn, cloud.Nr) == (reference.Ni, reference.Nd, reference.Nn, reference.Nr)
+    assert all(np.array_equal(np.asarray(cloud.facet_nodes[f]), np.asarray(reference.facet_nodes[f])) for f in reference.facet_nodes)
+    assert cloud.geometry_key == reference.geometry_key and cloud == reference
+
+
+# %%
+for Nx, Ny, support_size in [(9, 7, 9), (14, 11, 20)]:
+    cloud_vel = SquareCloud(Nx=Nx, Ny=Ny, facet_types=facet_types_vel, support_size=support_size, noise_key=jax.random.PRNGKey(1))
+    cloud_phi = SquareCloud(Nx=Nx, Ny=Ny, facet_types=facet_types_phi, support_size=support_size, noise_key=jax.random.PRNGKey(1))
+
+    derived = cloud_vel.with_facet_types(facet_types_phi)
+    compare(derived, cloud_phi)
+    compare(derived.with_facet_types(facet_types_vel), cloud_vel)           ## And back
+
+    ## Transfers between the two numberings are exact gathers
+    to_phi, to_vel = CloudTransfer(cloud_vel, derived), CloudTransfer(derived, cloud_vel)
+    assert np.array_equal(np.asarray(to_phi(cloud_vel.nodes)), np.asarray(derived.nodes))
+    field = jax.random.normal(jax.random.PRNGKey(2), (cloud_vel.N, 3))
+    assert np.array_equal(np.asarray(to_vel(to_phi(field))), np.asarray(field))
+
+print("Derived facet types OK")
@@ -0,0 +1,26 @@
+# %%
+import jax
+import jax.numpy as jnp
+jax.config.update("jax_enable_x64", True)
+from updec import *
+"Monomials and their derivatives are finite, and match autodiff, at nodes on the axes"
+
+MAX_DEGREE = 3
+M = compute_nb_monomials(MAX_DEGREE, 2)
+monomials = make_all_monomials(M)
+
+# %%
+for x in [jnp.array([0., 0.3]), jnp.array([0.7, 0.]), jnp.array([0., 0.]), jnp.array([-0.4, 0.9])]:
+    grads = jnp.stack([nodal_gradient(x, monomial=m) for m in monomials])
+    laps = jnp.stack([nodal_laplacian(x, monomial=m) for m in monomials])
+
+    assert jnp.all(jnp.isfinite(grads)) and jnp.all(jnp.isfinite(laps)), "NaN monomial derivatives at "+str(x)
+    assert jnp.allclose(grads, monomial_basis_gradient(x, M))
+    assert jnp.allclose(laps, monomial_basis_laplacian(x, M))
+
+    ## Autodiff through the monomials themselves must be safe too
+    assert jnp.allclose(jax.jacfwd(monomial_basis)(x, M), grads)
+    hessians = jnp.stack([jax.hessian(m)(x) for m in monomials])
+    assert jnp.allclose(jnp.trace(hessians, axis1=1, axis2=2), laps)
+
+print("Monomial derivatives OK")
@@ -0,0 +1,148 @@
+# %%
+import os
+import struct
+import tempfile
+import numpy as np
+from updec import *
+from updec.cloud import read_msh
+"The bulk MSH reader gives the same mesh, and the same cloud, from MSH 4.0 and 4.1 files, in ASCII or binary"
+
+## A small unit square mesh, built by hand: corners 1-4, one curve (and physical group) per side, and a surface
+n = 6
+grid = {}
+coords, entity_nodes = [], {}
+def add_node(entity, i, j):
+    grid[(i, j)] = len(coords)+1
+    coords.append((i/n, j/n, 0.))
+    entity_nodes.setdefault(entity, []).append(grid[(i, j)])
+
+for tag, (i, j) in enumerate([(0, 0), (n, 0), (n, n), (0, n)], start=1):
+    add_node((0, tag), i, j)
+sides = {1:[(i, 0) for i in range(1, n)], 2:[(n, j) for j in range(1, n)], 3:[(i, n) for i in range(n-1, 0, -1)], 4:[(0, j) for j in range(n-1, 0, -1)]}
+for tag, ids in sides.items():
+    for i, j in ids:
+        add_node((1, tag), i, j)
+for i in range(1, n):
+    for j in range(1, n):
+        add_node((2, 1), i, j)
+
+ends = {1:(1, 2), 2:(2, 3), 3:(3, 4), 4:(4, 1)}
+lines = {tag:np.array([[a, b] for a, b in zip([ends[tag][0]]+[grid[ij] for ij in ids], [grid[ij] for ij in ids]+[ends[tag][1]])]) for tag, ids in sides.items()}
+triangles = np.array([tri for i in range(n) for j in range(n) for tri in ([grid[(i,j)], grid[(i+1,j)], grid[(i+1,j+1)]], [grid[(i,j)], grid[(i+1,j+1)], grid[(i,j+1)]])])
+element_blocks = [(1, tag, 1, conn) for tag, conn in lines.items()] + [(2, 1, 2, triangles)]
+
+names = {1:"South", 2:"East", 3:"North", 4:"West"}
+coords = np.array(coords)
+N = coords.shape[0]
+nb_elements = sum(len(conn) for *_, conn in element_blocks)
+
+
+# %%
+def write_msh(filename, version, binary):
+    with open(filename, "wb") as f:
+        w = lambda s: f.write(s.encode())
+        w("$MeshFormat\n%s %d 8\n" % (version, int(binary)))
+        if binary:
+            f.write(struct.pack("<i", 1)); w("\n")
+        w("$EndMeshFormat\n$PhysicalNames\n5\n")
+        for tag, name in names.items():
+            w('1 %d "%s"\n' % (tag, name))
+        w('2 5 "Fluid"\n$EndPhysicalNames\n$Entities\n')
+
+        if binary:
+            f.write(struct.pack("<4Q", 4, 4, 1, 0))
+            for tag in range(1, 5):
+                f.write(struct.pack("<i3dQ", tag, *coords[tag-1], 0))
+            for tag in range(1, 5):
+                f.write(struct.pack("<i6dQiQ2i", tag, 0, 0, 0, 1, 1, 0, 1, tag, 2, ends[tag][0], -ends[tag][1]))
+            f.write(struct.pack("<i6dQiQ4i", 1, 0, 0, 0, 1, 1, 0, 1, 5, 4, 1, 2, 3, 4))
+            w("\n")
+        else:
+            w("4 4 1 0\n")
+            for tag in range(1, 5):
+                x, y, z = coords[tag-1]
+                w(("%d %g %g %g 0\n" % (tag, x, y, z)) if version == "4.1" else ("%d %g %g %g %g %g %g 0\n" % (tag, x, y, z, x, y, z)))
+            for tag in range(1, 5):
+                w("%d 0 0 0 1 1 0 1 %d 2 %d %d\n" % (tag, tag, ends[tag][0], -ends[tag][1]))
+            w("1 0 0 0 1 1 0 1 5 4 1 2 3 4\n")
+
+        w("$EndEntities\n$Nodes\n")
+        if binary:
+            f.write(struct.pack("<4Q", len(entity_nodes), N, 1, N))
+            for (dim, tag), ids in entity_nodes.items():
+                ids = np.array(ids)
+                f.write(struct.pack("<3iQ", dim, tag, 0, len(ids)))
+                f.write(ids.astype("<u8").tobytes()); f.write(coords[ids-1].astype("<f8").tobytes())
+            w("\n")
+        else:
+            w(("%d %d 1 %d\n" % (len(entity_nodes), N, N)) if version == "4.1" else ("%d %d\n" % (len(entity_nodes), N)))
+            for (dim, tag), ids in entity_nodes.items():
+                if version == "4.1":
+                    w("%d %d 0 %d\n" % (dim, tag, len(ids)))
+                    w("".join("%d\n" % i for i in ids) + "".join("%.17g %.17g %.17g\n" % tuple(coords[i-1]) for i in ids))
+                else:
+                    w("%d %d 0 %d\n" % (tag, dim, len(ids)))
+                    w("".join("%d %.17g %.17g %.17g\n" % (i, *coords[i-1]) for i in ids))
+
+        w("$EndNodes\n$Elements\n")
+        if binary:
+            f.write(struct.pack("<4Q", len(element_blocks), nb_elements, 1, nb_elements))
+        else:
+            w(("%d %d 1 %d\n" % (len(element_blocks), nb_elements, nb_elements)) if version == "4.1" else ("%d %d\n" % (len(element_blocks), nb_elements)))
+        element_tag = 1
+        for dim, tag, kind, conn in element_blocks:
+            data = np.concatenate((np.arange(element_tag, element_tag+len(conn))[:, None], conn), axis=1)
+            element_tag += len(conn)
+            if binary:
+                f.write(struct.pack("<3iQ", dim, tag, kind, len(conn))); f.write(data.astype("<u8").tobytes())
+            else:
+                w(("%d %d %d %d\n" % (dim, tag, kind, len(conn))) if version == "4.1" else ("%d %d %d %d\n" % (tag, dim, kind, len(conn))))
+                w("".join(" ".join(str(v) for v in row)+"\n" for row in data))
+        if binary:
+            w("\n")
+        w("$EndElements\n")
+
+
+# %%
+folder = tempfile.mkdtemp()
+formats = {"4.0 ASCII":("4", False), "4.1 ASCII":("4.1", False), "4.1 binary":("4.1", True)}
+facet_types = {"South":"n", "East":"d", "North":"d", "West":"n"}
+clouds = {}
+
+for name, (version, binary) in formats.items():
+    filename = os.path.join(folder, name.replace(" ", "_")+".msh")
+    write_msh(filename, version, binary)
+
+    mesh = read_msh(filename)
+    assert mesh["physical_names"] == {**names, 5:"Fluid"}, name
+    assert mesh["curve_physical_tags"] == {1:1, 2:2, 3:3, 4:4}, name
+    assert mesh["nb_nodes"] == N, name
+
+    read_coords = np.zeros((N, 3))
+    for dim, tag, ids, block_coords in mesh["node_blocks"]:
+        assert np.array_equal(ids+1, entity_nodes[(dim, tag)]), name
+        read_coords[ids] = block_coords
+    assert np.array_equal(read_coords, coords), name
+
+    for (dim, tag, conn), (dim_, tag_, _, conn_) in zip(mesh["element_blocks"], element_blocks):
+        assert (dim, tag) == (dim_, tag_) and np.array_equal(conn+1, conn_), name
+
+    clouds[name] = GmshCloud(filename=filename, facet_types=facet_types, support_size=8)
+
+
+# %%
+reference = clouds["4.0 ASCII"]
+for name, cloud in clouds.items():
+    for attribute in ["nodes", "node_types", "node_facets", "outward_normals", "local_supports", "renumbering"]:
+        assert np.array_equal(np.asarray(getattr(cloud, attribute)), np.asarray(getattr(reference, attribute))), name+": "+attribute
+    assert cloud.facet_offsets == reference.facet_offsets, name
+
+## Sides and normals come out where the mesh puts them
+x, y = np.asarray(reference.nodes).T
+normals = np.asarray(reference.outward_normals)
+South, West = np.asarray(reference.facet_nodes["South"]), np.asarray(reference.facet_nodes["West"])
+assert np.allclose(y[South], 0.) and np.allclose(normals[South], [0., -1.])
+assert np.allclose(x[West], 0.) and np.allclose(normals[West], [-1., 0.])
+assert (reference.Ni, reference.Nd + reference.Nn) == ((n-1)**2, 4*n)
+
+print("MSH reader OK")
@@ -0,0 +1,45 @@
+# %%
+import jax
+import jax.numpy as jnp
+import numpy as np
+import scipy.sparse.linalg as spla
+from updec import *
+from updec.solvers import aggregate_supports, _to_scipy
+"Multigrid keeps GMRES iteration counts bounded as the cloud is refined, and aggregates partition the nodes"
+
+RBF, MAX_DEGREE = polyharmonic, 1
+facet_types = {"South":"d", "West":"d", "North":"d", "East":"d"}
+
+def diff_operator(x, center=None, rbf=None, monomial=None, fields=None):
+    return nodal_laplacian(x, center, rbf, monomial)
+
+def gmres_iterations(B, M, q):
+    B_sp = _to_scipy(B)
+    M_jit = jax.jit(lambda x: M(x))
+    M_op = spla.LinearOperator(B_sp.shape, matvec=lambda x: np.array(M_jit(jnp.asarray(x, dtype=float))), dtype=float)
+    residuals = []
+    x, _ = spla.gmres(B_sp, q, M=M_op, rtol=1e-8, restart=200, maxiter=5, callback=residuals.append, callback_type="pr_norm")
+    assert np.linalg.norm(B_sp @ x - q) <= 1e-7 * np.linalg.norm(q)
+    return len(residuals)
+
+
+# %%
+iterations = []
+for Nx in [20, 35, 60]:
+    cloud = SquareCloud(Nx=Nx, Ny=Nx, facet_types=facet_types, support_size=20)
+    N = cloud.N
+
+    aggregates, aggregate_of = aggregate_supports(np.asarray(cloud.local_supports), 8)
+    members = aggregates[aggregates < N]
+    assert np.array_equal(np.sort(members), np.arange(N))
+    assert np.all(aggregate_of[aggregates[:, 0]] == np.arange(aggregates.shape[0]))
+
+    B = assemble_sparse_B(diff_operator, cloud, RBF, compute_nb_monomials(MAX_DEGREE, 2), None)
+    M = make_preconditioner("multigrid", B, cloud, RBF, MAX_DEGREE)
+    q = np.random.default_rng(0).normal(size=N)
+    iterations.append(gmres_iterations(B, M, q))
+    print(N, "nodes:", iterations[-1], "iterations")
+
+assert max(iterations) <= 30 and iterations[-1] <= iterations[0] + 6, iterations
+
+print("Multigrid iterations OK")
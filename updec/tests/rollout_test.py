@@ -0,0 +1,47 @@
+# %%
+import math
+import jax
+import jax.numpy as jnp
+from updec import *
+"Every checkpoint schedule of rollout gives the values and gradients of a plain lax.scan"
+
+W = jax.random.normal(jax.random.PRNGKey(0), (6, 6)) / 3.
+
+def make_step(W):
+    def step(state, x):
+        new_state = jnp.tanh(W @ state + x)
+        return new_state, jnp.sum(new_state**2)
+    return step
+
+def loss(W, init_state, xs, nb_steps, **kwargs):
+    state, ys = rollout(make_step(W), init_state, nb_steps, xs=xs, **kwargs)
+    return jnp.sum(state) + jnp.sum(ys * jnp.arange(1, nb_steps+1))
+
+def reference_loss(W, init_state, xs, nb_steps):
+    state, ys = jax.lax.scan(make_step(W), init_state, xs, length=nb_steps)
+    return jnp.sum(state) + jnp.sum(ys * jnp.arange(1, nb_steps+1))
+
+
+# %%
+init_state = jax.random.normal(jax.random.PRNGKey(1), (6,))
+
+for nb_steps in [1, 7, 16, 37, 64]:
+    xs = jax.random.normal(jax.random.PRNGKey(nb_steps), (nb_steps, 6)) / 4.
+    ref_val, ref_grads = jax.value_and_grad(reference_loss, argnums=(0, 1, 2))(W, init_state, xs, nb_steps)
+
+    for checkpoint, branching in [(None, 4), ("step", 4), ("binomial", 2), ("binomial", 4), ("binomial", 8)]:
+        sizes = checkpoint_levels(nb_steps, branching)
+        assert math.prod(sizes) >= nb_steps
+
+        val, grads = jax.value_and_grad(loss, argnums=(0, 1, 2))(W, init_state, xs, nb_steps, checkpoint=checkpoint, branching=branching)
+        assert jnp.allclose(val, ref_val, rtol=1e-12), (nb_steps, checkpoint, branching)
+        for g, g_ref in zip(grads, ref_grads):
+            assert jnp.allclose(g, g_ref, rtol=1e-10, atol=1e-12), (nb_steps, checkpoint, branching)
+
+## Without per-step inputs
+step = lambda state, _: (0.9*state + 0.1, state[0])
+state, ys = rollout(step, init_state, 37, checkpoint="binomial")
+ref_state, ref_ys = jax.lax.scan(step, init_state, None, length=37)
+assert jnp.allclose(state, ref_state) and jnp.allclose(ys, ref_ys) and ys.shape == (37,)
+
+print("Rollout schedules OK")
@@ -0,0 +1,56 @@
+# %%
+import gc
+import weakref
+import jax
+import jax.numpy as jnp
+from updec import *
+from updec.assembly import FACTORIZATIONS, LOCAL_FACTORS
+from updec.cloud import CloudMetadata, _is_static
+"Repeated pde_solver calls on a cloud reuse its cached factors, and compiled solves keep no cloud alive"
+
+RBF, MAX_DEGREE = polyharmonic, 2
+facet_types = {"South":"n", "West":"d", "North":"d", "East":"d"}
+
+def diff_operator(x, center=None, rbf=None, monomial=None, fields=None):
+    return nodal_laplacian(x, center, rbf, monomial)
+
+def rhs_operator(x, centers=None, rbf=None, fields=None):
+    return value(x, fields[:, 0], centers, rbf)
+
+zero = jax.jit(lambda x: 0.)
+north = jax.jit(lambda x: jnp.sin(3*x[0]))
+bcs = {"South":zero, "West":zero, "North":north, "East":zero}
+
+
+# %%
+for method, cache in [("global", FACTORIZATIONS), ("rbffd", LOCAL_FACTORS)]:
+    cloud = SquareCloud(Nx=15, Ny=15, facet_types=facet_types, support_size=15, noise_key=jax.random.PRNGKey(0))
+    source = jnp.cos(cloud.sorted_nodes[:, 0])
+
+    hits, misses = cache.hits, cache.misses
+    sol1 = pde_solver(diff_operator, rhs_operator, cloud, bcs, RBF, MAX_DEGREE, rhs_args=[source], method=method)
+    sol2 = pde_solver(diff_operator, rhs_operator, cloud, bcs, RBF, MAX_DEGREE, rhs_args=[source], method=method)
+    print(method, "hits:", cache.hits - hits, "misses:", cache.misses - misses)
+    assert (cache.hits - hits, cache.misses - misses) == (1, 1)
+    assert jnp.array_equal(sol1.vals, sol2.vals)
+
+    reference = PDEProblem(diff_operator, rhs_operator, cloud, RBF, MAX_DEGREE, method=method).solve(bcs, rhs_args=[source])
+    assert jnp.allclose(sol1.vals, reference.vals, atol=1e-9)
+
+    ## A cloud with other coordinates: its own factors, and nothing kept once it is gone
+    other = SquareCloud(Nx=15, Ny=15, facet_types=facet_types, support_size=15, noise_key=jax.random.PRNGKey(1))
+    assert CloudMetadata(other) == CloudMetadata(cloud) and other != cloud
+    assert all(_is_static(value) for _, _, value in CloudMetadata(other).attributes)
+    sol = pde_solver(diff_operator, rhs_operator, other, bcs, RBF, MAX_DEGREE, rhs_args=[jnp.cos(other.sorted_nodes[:, 0])], method=method)
+    assert not jnp.allclose(sol.vals, sol1.vals)
+
+    other_ref = weakref.ref(other)
+    del other, sol
+    gc.collect()
+    assert other_ref() is None
+
+## Traced clouds: the factors are built inside the trace
+solve = jax.jit(lambda cloud, source: pde_solver(diff_operator, rhs_operator, cloud, bcs, RBF, MAX_DEGREE, rhs_args=[source], method="rbffd").vals)
+assert jnp.allclose(solve(cloud, source), sol1.vals, atol=1e-12)
+
+print("Solver caches OK")
@@ -14,6 +14,8 @@ plt.style.use("dark_background")
 
 import math
 import random
+import itertools
+import numpy as np
 
 ## Euclidian distance
 def distance(node1, node2):
@@ -57,6 +59,109 @@ def polyharmonic_func(r):
 def polyharmonic(x, center):
     return polyharmonic_func(distance(x, center))
 
+@jax.jit
+def polyharmonic5_func(r):
+    return r**5
+
+@jax.jit
+def polyharmonic5(x, center):
+    return polyharmonic5_func(distance(x, center))
+
+@jax.jit
+def polyharmonic7_func(r):
+    return r**7
+
+@jax.jit
+def polyharmonic7(x, center):
+    return polyharmonic7_func(distance(x, center))
+
+@jax.jit
+def inverse_multiquadric_func(r, eps=1.):
+    return 1. / jnp.sqrt(1 + (eps*r)**2)
+
+@jax.jit
+def inverse_multiquadric(x, center, eps=1.):
+    return inverse_multiquadric_func(distance(x, center), eps)
+
+@jax.jit
+def wendland_func(r, eps=1.):
+    """ Compactly supported Wendland C2 function, with support radius 1/eps """
+    s = jnp.minimum(eps*r, 1.)
+    return (1 - s)**4 * (4*s + 1)
+
+@jax.jit
+def wendland(x, center, eps=1.):
+    return wendland_func(distance(x, center), eps)
+
+
+
+## Kernel registry: closed-form radial derivatives phi'(r)/r and phi''(r) for each rbf
+## Gradient: (phi'(r)/r) * (x - center)         Laplacian: phi''(r) + (dim-1) * phi'(r)/r
+RBF_DERIVATIVES = {}
+
+def register_rbf(rbf, dphi_over_r, d2phi):
+    """ Registers the radial derivatives of rbf(x, center, **params), both functions of (r, **params) """
+    RBF_DERIVATIVES[rbf] = (dphi_over_r, d2phi)
+
+register_rbf(polyharmonic, lambda r: 3*r, lambda r: 6*r)
+register_rbf(polyharmonic5, lambda r: 5*r**3, lambda r: 20*r**3)
+register_rbf(polyharmonic7, lambda r: 7*r**5, lambda r: 42*r**5)
+register_rbf(gaussian,
+            lambda r, eps=1.: -2*eps**2 * gaussian_func(r, eps),
+            lambda r, eps=1.: (4*eps**4*r**2 - 2*eps**2) * gaussian_func(r, eps))
+register_rbf(multiquadric,
+            lambda r, eps=1.: eps**2 / multiquadric_func(r, eps),
+            lambda r, eps=1.: eps**2 / multiquadric_func(r, eps)**3)
+register_rbf(inverse_multiquadric,
+            lambda r, eps=1.: -eps**2 * inverse_multiquadric_func(r, eps)**3,
+            lambda r, eps=1.: (3*eps**4*r**2*inverse_multiquadric_func(r, eps)**2 - eps**2) * inverse_multiquadric_func(r, eps)**3)
+register_rbf(wendland,
+            lambda r, eps=1.: -20*eps**2 * (1 - jnp.minimum(eps*r, 1.))**3,
+            lambda r, eps=1.: 20*eps**2 * (1 - jnp.minimum(eps*r, 1.))**2 * (4*jnp.minimum(eps*r, 1.) - 1))
+
+
+def get_rbf_derivatives(rbf):
+    """ Radial derivatives of a registered rbf (possibly a partial with keyword parameters), or None """
+    if isinstance(rbf, partial) and not rbf.args and rbf.func in RBF_DERIVATIVES:
+        dphi_over_r, d2phi = RBF_DERIVATIVES[rbf.func]
+        return partial(dphi_over_r, **rbf.keywords), partial(d2phi, **rbf.keywords)
+    elif rbf in RBF_DERIVATIVES:
+        return RBF_DERIVATIVES[rbf]
+    else:
+        return None
+
+def safe_distance(node1, node2):
+    """ Euclidian distance with a zero (not NaN) derivative at 0 """
+    r2 = jnp.sum((node1 - node2)**2)
+    return jnp.where(r2 > 0., jnp.sqrt(jnp.where(r2 > 0., r2, 1.)), 0.)
+
+@cache
+def make_rbf_gradient(rbf):
+    """ Gradient of rbf(x, center) wrt x. Closed-form for registered kernels, autodiff otherwise """
+    derivatives = get_rbf_derivatives(rbf)
+    if derivatives is None:
+        grad_rbf = jax.grad(rbf)
+        return lambda x, center: jnp.nan_to_num(grad_rbf(x, center))       ## NaNs appear at r=0
+
+    dphi_over_r, _ = derivatives
+    def grad_rbf(x, center):
+        return dphi_over_r(safe_distance(x, center)) * (x - center)
+    return grad_rbf
+
+@cache
+def make_rbf_laplacian(rbf):
+    """ Laplacian of rbf(x, center) wrt x. Closed-form for registered kernels, autodiff otherwise """
+    derivatives = get_rbf_derivatives(rbf)
+    if derivatives is None:
+        hessian_rbf = jax.jacfwd(jax.grad(rbf))
+        return lambda x, center: jnp.nan_to_num(jnp.trace(hessian_rbf(x, center)))
+
+    dphi_over_r, d2phi = derivatives
+    def laplacian_rbf(x, center):
+        r = safe_distance(x, center)
+        return d2phi(r) + (x.shape[-1]-1) * dphi_over_r(r)
+    return laplacian_rbf
+
 # @jax.jit
 @Partial(jax.jit, static_argnums=2)
 def make_nodal_rbf(x, node, rbf):
@@ -69,42 +174,33 @@ def make_nodal_rbf(x, node, rbf):
     return func(distance(x, node))
 
 
+@cache
+def monomial_exponents(nb_monomials, dim=2):
+    """ Exponent table (nb_monomials, dim) of the monomials, by increasing total degree """
+    ## In 2D: 1, x, y, x^2, xy, y^2, x^3, x^2y, ... Any degree and any dimension are supported
+    exponents = []
+    degree = 0
+    while len(exponents) < nb_monomials:
+        exponents += sorted([e for e in itertools.product(range(degree+1), repeat=dim) if sum(e)==degree], reverse=True)
+        degree += 1
+    return np.array(exponents[:nb_monomials], dtype=int).reshape((nb_monomials, dim))
+
+
+def integer_powers(x, exponents):
+    """ prod_k x_k**e_k for each row of a (static) exponent table. Integer powers are exact, and so are their derivatives 
+        at x_k = 0, where x**array_exponents would differentiate to NaN """
+    exponents = np.asarray(exponents)
+    factors = []
+    for k in range(x.shape[-1]):
+        powers = jnp.stack([x[k]**p for p in range(int(exponents[..., k].max(initial=0))+1)])       ## Python int powers
+        factors.append(powers[exponents[..., k]])
+    return jnp.prod(jnp.stack(factors, axis=-1), axis=-1)
+
 @Partial(jax.jit, static_argnums=1)
 def make_monomial(x, id):
     """ Easy way to keep track of all monomials """
-    ## x is a 2D vector
-    if id == 0:
-        return 1.0
-    elif id == 1:
-        return x[0]
-    elif id == 2:
-        return x[1]
-    elif id == 3:
-        return x[0]**2
-    elif id == 4:
-        return x[0]*x[1]
-    elif id == 5:
-        return x[1]**2
-    elif id == 6:
-        return x[0]**3
-    elif id == 7:
-        return (x[0]**2)*x[1]
-    elif id == 8:
-        return x[0]*(x[1]**2)
-    elif id == 9:
-        return x[1]**3
-    elif id == 10:
-        return x[0]**4
-    elif id == 11:
-        return (x[0]**3)*x[1]
-    elif id == 12:
-        return (x[0]**2)*(x[1]**2)
-    elif id == 13:
-        return x[0]*(x[1]**3)
-    elif id == 14:
-        return x[1]**4
-    else:
-        pass        ## Higher order monomials not yet supported
+    exponents = monomial_exponents(id+1, x.shape[-1])[id]
+    return integer_powers(x, exponents)
 
 @cache
 def make_all_monomials(nb_monomials):
@@ -112,6 +208,27 @@ def make_all_monomials(nb_monomials):
     return [partial(make_monomial, id=j) for j in range(nb_monomials)]
 
 
+@Partial(jax.jit, static_argnums=1)
+def monomial_basis(x, nb_monomials):
+    """ Values of all the monomials at x, shape (nb_monomials,) """
+    exponents = monomial_exponents(nb_monomials, x.shape[-1])
+    return integer_powers(x, exponents)
+
+@Partial(jax.jit, static_argnums=1)
+def monomial_basis_gradient(x, nb_monomials):
+    """ Analytic gradients of all the monomials at x, shape (nb_monomials, dim) """
+    exponents = monomial_exponents(nb_monomials, x.shape[-1])
+    shifted = np.maximum(exponents[:, np.newaxis, :] - np.eye(x.shape[-1], dtype=int), 0)     ## d/dx_k lowers the k-th exponent
+    return exponents * integer_powers(x, shifted)
+
+@Partial(jax.jit, static_argnums=1)
+def monomial_basis_laplacian(x, nb_monomials):
+    """ Analytic laplacians of all the monomials at x, shape (nb_monomials,) """
+    exponents = monomial_exponents(nb_monomials, x.shape[-1])
+    shifted = np.maximum(exponents[:, np.newaxis, :] - 2*np.eye(x.shape[-1], dtype=int), 0)
+    return jnp.sum(exponents*(exponents-1) * integer_powers(x, shifted), axis=-1)
+
+
 
 def compute_nb_monomials(max_degree, problem_dimension):
     return math.comb(max_degree+problem_dimension, max_degree)